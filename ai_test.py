@@ -1,6 +1,18 @@
 import pytest
+import asyncio
+import time
 from unittest.mock import patch, MagicMock
-from backend.services.ai_service.ai import parse_ingredients, format_recipe, get_recipe
+from backend.services.ai_service.ai import parse_ingredients, format_recipe, get_recipe, GptClient, recipe_cache, normalize_recipe_query, IngredientStreamParser, build_recipe_request
+from backend.services.ai_service.scheduler import LlmScheduler, SchedulerOverloaded, request_tokens, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from backend.services.ai_service.mock_server import start_mock_server, REQUESTS, DEFAULT_RECIPE
+from backend.services.ai_service.recipe_text import parse_recipe_text, parse_ingredients_section, parse_ingredient_line, display_recipe
+from backend.services.recipe_service.recipe_service import RecipeIndex, split_portions
+
+@pytest.fixture(autouse=True)
+def clear_recipe_cache():
+    recipe_cache.clear()
+    yield
+    recipe_cache.clear()
 
 def test_parse_ingredients_with_ingredients_section():
     recipe = """
@@ -57,49 +69,398 @@ def test_format_recipe():
 # Test get_recipe
 @pytest.mark.asyncio
 async def test_get_recipe_success():
-    mock_response = MagicMock()
-    mock_response.json.return_value = {
-        'result': {
-            'alternatives': [{
-                'message': {
-                    'text': """
-                    Паста Карбонара:
-
-                    Ингредиенты:
-                    Спагетти - 200 г
-                    Сливки - 200 мл
-                    
-                    Приготовление:
-                    1. Сварить макароны
-                    
-                    Порций - 2
-                    """
-                }
-            }]
-        }
-    }
-    mock_response.raise_for_status = MagicMock()
-
-    with patch('requests.post', return_value=mock_response):
-        query = "карбонара на 2 порции"
-        user_dict = {
-            "allergies": ["бекон"],
-            "unliked_products": ["яйца", "сыр"]
-        }
-        
-        recipe, ingredients = await get_recipe(query, user_dict)
-        assert "Ингредиенты:" in recipe
-        assert ingredients == {
-            'спагетти': '200 г',
-            'сливки': '200 мл'
-        }
+    text = """
+    Паста Карбонара:
+
+    Ингредиенты:
+    Спагетти - 200 г
+    Сливки - 200 мл
+    
+    Приготовление:
+    1. Сварить макароны
+    
+    Порций - 2
+    """
+    runner, url = await start_mock_server(text=text)
+    client = GptClient(url=url)
+    try:
+        with patch('backend.services.ai_service.ai.gpt_client', client):
+            query = "карбонара на 2 порции"
+            user_dict = {
+                "allergies": ["бекон"],
+                "unliked_products": ["яйца", "сыр"]
+            }
+            
+            recipe, ingredients = await get_recipe(query, user_dict)
+            assert "Ингредиенты:" in recipe
+            assert ingredients == {
+                'спагетти': '200 г',
+                'сливки': '200 мл'
+            }
+            sent = runner.app[REQUESTS][0]
+            assert "бекон" in sent["messages"][0]["text"]
+    finally:
+        await client.close()
+        await runner.cleanup()
 
 @pytest.mark.asyncio
 async def test_get_recipe_error():
-    with patch('requests.post', side_effect=Exception("API Error")):
-        query = "карбонара"
-        user_dict = {}
-        
-        recipe, ingredients = await get_recipe(query, user_dict)
-        assert "Произошла ошибка" in recipe
-        assert ingredients == {}
\ No newline at end of file
+    runner, url = await start_mock_server(status=500)
+    client = GptClient(url=url, retry_base_delay=0.01)
+    try:
+        with patch('backend.services.ai_service.ai.gpt_client', client):
+            query = "карбонара"
+            user_dict = {}
+            
+            recipe, ingredients = await get_recipe(query, user_dict)
+            assert "Произошла ошибка" in recipe
+            assert ingredients == {}
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+@pytest.mark.asyncio
+async def test_get_recipe_read_timeout():
+    runner, url = await start_mock_server(delay=1)
+    client = GptClient(url=url, read_timeout=0.1)
+    try:
+        with patch('backend.services.ai_service.ai.gpt_client', client):
+            recipe, ingredients = await get_recipe("карбонара", {})
+            assert "Произошла ошибка" in recipe
+            assert ingredients == {}
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+# Пока модель думает, event loop свободен, а одновременных запросов не больше concurrency
+@pytest.mark.asyncio
+async def test_gpt_client_does_not_block_loop():
+    runner, url = await start_mock_server(delay=0.2)
+    client = GptClient(url=url, concurrency=2)
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    ticker_task = asyncio.create_task(ticker())
+    try:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(client.complete({"messages": []}) for _ in range(4)))
+        elapsed = time.perf_counter() - start
+
+        assert len(results) == 4
+        assert elapsed >= 0.4
+        assert ticks >= 20
+        assert len(runner.app[REQUESTS]) == 4
+    finally:
+        ticker_task.cancel()
+        await client.close()
+        await runner.cleanup()
+
+
+def test_normalize_recipe_query():
+    assert normalize_recipe_query("Борщ на две порции!") == normalize_recipe_query("борщ  на 2 порции")
+    assert normalize_recipe_query("борщ на 2 порции") != normalize_recipe_query("борщ на 3 порции")
+
+# Повторный запрос с теми же ограничениями не ходит в модель
+@pytest.mark.asyncio
+async def test_get_recipe_cache():
+    runner, url = await start_mock_server()
+    client = GptClient(url=url)
+    try:
+        with patch('backend.services.ai_service.ai.gpt_client', client):
+            first = await get_recipe("Борщ на две порции", {"allergies": ["бекон"], "unliked_products": []})
+            second = await get_recipe("борщ на 2 порции", {"allergies": [" Бекон"], "unliked_products": []})
+            assert first == second
+            assert len(runner.app[REQUESTS]) == 1
+
+            await get_recipe("борщ на 2 порции", {"allergies": ["сыр"], "unliked_products": []})
+            assert len(runner.app[REQUESTS]) == 2
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+@pytest.mark.asyncio
+async def test_get_recipe_errors_are_not_cached():
+    runner, url = await start_mock_server(status=500)
+    client = GptClient(url=url, max_retries=0)
+    try:
+        with patch('backend.services.ai_service.ai.gpt_client', client):
+            await get_recipe("борщ", {})
+            await get_recipe("борщ", {})
+            assert len(runner.app[REQUESTS]) == 2
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+# В режиме стриминга текст приходит кусками, а итог тот же, что и без него
+@pytest.mark.asyncio
+async def test_get_recipe_streaming():
+    runner, url = await start_mock_server(chunk_size=16)
+    client = GptClient(url=url)
+    partial = []
+
+    async def on_text(text):
+        partial.append(text)
+
+    try:
+        with patch('backend.services.ai_service.ai.gpt_client', client):
+            streamed = await get_recipe("карбонара на 2 порции", {}, on_text=on_text)
+            recipe_cache.clear()
+            plain = await get_recipe("карбонара на 2 порции", {})
+
+        assert streamed == plain
+        assert len(partial) > 1
+        assert all(partial[i + 1].startswith(partial[i]) for i in range(len(partial) - 1))
+        assert runner.app[REQUESTS][0]["completionOptions"]["stream"] is True
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+# Ингредиенты из стрима совпадают с parse_ingredients при любой нарезке текста
+@pytest.mark.parametrize("chunk_size", [1, 5, 16, 1000])
+def test_ingredient_stream_parser(chunk_size):
+    recipe = DEFAULT_RECIPE.replace("• Яйца - 2 шт", "• Яйца - 2 шт\n• Соль - по вкусу")
+    extractor = IngredientStreamParser()
+    found = []
+    for end in range(chunk_size, len(recipe) + chunk_size, chunk_size):
+        found += extractor.update(recipe[:end])
+
+    assert dict(found) == parse_ingredients(recipe)
+    assert len(found) == 4
+
+
+# Разбор текста рецепта одной функцией
+def test_parse_recipe_text():
+    formatted, ingredients = format_recipe("**[Борщ]:**\n\nИнгредиенты:\n* Свекла - 2 шт\n• Вода — 2 л\n\nПриготовление:\n1. Варить\n\nПорций – 3")
+    parsed = parse_recipe_text(formatted)
+    assert parsed.title is None  # название в звездочках re.match не находит, как и раньше
+    assert parsed.portions == 3
+    assert parsed.ingredients == ingredients == {'свекла': '2 шт', 'вода': '2 л'}
+    assert parsed.display == "[Борщ]:\n\n\nИнгредиенты:\n• Свекла - 2 шт\n• Вода — 2 л\n\n\nПриготовление:\n1. Варить\n\nПорций – 3"
+
+    parsed = parse_recipe_text(DEFAULT_RECIPE)
+    assert (parsed.title, parsed.portions) == ("Паста Карбонара", 2)
+    assert parsed.display.startswith("Паста Карбонара:\n\n\nИнгредиенты:")
+    assert parse_recipe_text("Борщ", with_ingredients=False) == (None, None, {}, "Борщ")
+
+# Весь список одной регуляркой дает то же, что разбор по строкам
+def test_parse_ingredients_section_matches_line_parser():
+    lines = [
+        "• Соль - 1 ч.", "Мука - 2 ст.л.", "* Сахар — 100 г;", "Перец - по вкусу", "**",
+        "  - Масло – 50 грамм.", "Сливки 20% - 200 мл", "Яйца - 2 шт", ". Вода - 1,5 литра", "Лук - 1 ч. л.",
+    ]
+    expected = dict(filter(None, map(parse_ingredient_line, lines)))
+    assert parse_ingredients_section("\n".join(lines)) == expected
+    # "1 ч." в конце строки после обрезки точки не единица - соль пропускается
+    assert len(expected) == 7
+
+
+# 429 и 5xx повторяются с паузой, остальные ошибки - нет
+@pytest.mark.asyncio
+@pytest.mark.parametrize("status, errors, requests, ok", [
+    (503, 2, 3, True),
+    (429, None, 3, False),
+    (400, None, 1, False),
+])
+async def test_gpt_client_retries(status, errors, requests, ok):
+    runner, url = await start_mock_server(status=status, errors=errors)
+    client = GptClient(url=url, max_retries=2, retry_base_delay=0.01)
+    try:
+        with patch('backend.services.ai_service.ai.gpt_client', client):
+            recipe, ingredients = await get_recipe("карбонара", {})
+        assert bool(ingredients) is ok
+        assert len(runner.app[REQUESTS]) == requests
+        assert client.retries == min(requests - 1, 2)
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+# Если первый запрос дольше обычного, второй такой же отвечает раньше
+@pytest.mark.asyncio
+@pytest.mark.parametrize("stream", [False, True])
+async def test_gpt_client_hedging(stream):
+    runner, url = await start_mock_server(delays=[2, 0])
+    client = GptClient(url=url)
+    client.latencies.extend([0.05] * 20)
+    client.first_chunk_latencies.extend([0.05] * 20)
+    partial = []
+
+    async def on_text(text):
+        partial.append(text)
+
+    try:
+        with patch('backend.services.ai_service.ai.gpt_client', client), \
+                patch('backend.services.ai_service.ai.GPT_HEDGE_MIN_DELAY', 0.1):
+            start = time.monotonic()
+            recipe, ingredients = await get_recipe("карбонара", {}, on_text=on_text if stream else None)
+            elapsed = time.monotonic() - start
+        assert ingredients
+        assert elapsed < 1
+        assert len(runner.app[REQUESTS]) == 2
+        stats = client.stats()
+        assert (stats["hedged"], stats["hedge_wins"], stats["hedge_rate"]) == (1, 1, 1.0)
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+@pytest.mark.asyncio
+async def test_gpt_client_fast_answer_is_not_hedged():
+    runner, url = await start_mock_server()
+    client = GptClient(url=url)
+    try:
+        with patch('backend.services.ai_service.ai.gpt_client', client):
+            await get_recipe("карбонара", {})
+        assert len(runner.app[REQUESTS]) == 1
+        assert client.stats()["hedged"] == 0
+        assert len(client.latencies) == 1
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+# Повторы и хеджи тратят тот же бюджет, что и первые запросы
+@pytest.mark.asyncio
+async def test_gpt_client_charges_retries_to_scheduler():
+    runner, url = await start_mock_server(status=503, errors=2)
+    scheduler = LlmScheduler(requests_per_minute=600, tokens_per_minute=10 ** 7, max_queue=10)
+    client = GptClient(url=url, max_retries=2, retry_base_delay=0.01, scheduler=scheduler)
+    try:
+        with patch('backend.services.ai_service.ai.gpt_client', client), \
+                patch('backend.services.ai_service.ai.llm_scheduler', scheduler):
+            recipe, ingredients = await get_recipe("карбонара", {})
+        assert ingredients
+        assert len(runner.app[REQUESTS]) == 3
+        stats = scheduler.stats()
+        assert (stats["dispatched"], stats["charged"]) == (1, 2)
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+@pytest.mark.asyncio
+async def test_gpt_client_does_not_hedge_without_budget():
+    runner, url = await start_mock_server(delays=[0.5, 0])
+    # Бюджета ровно на один запрос
+    scheduler = LlmScheduler(requests_per_minute=6, tokens_per_minute=10 ** 7, max_queue=10, burst=10)
+    client = GptClient(url=url, scheduler=scheduler)
+    client.latencies.extend([0.05] * 20)
+    try:
+        with patch('backend.services.ai_service.ai.gpt_client', client), \
+                patch('backend.services.ai_service.ai.llm_scheduler', scheduler), \
+                patch('backend.services.ai_service.ai.GPT_HEDGE_MIN_DELAY', 0.1):
+            recipe, ingredients = await get_recipe("карбонара", {})
+        assert ingredients
+        assert len(runner.app[REQUESTS]) == 1
+        stats = client.stats()
+        assert (stats["hedged"], stats["hedges_skipped"]) == (0, 1)
+        assert scheduler.stats()["charged"] == 0
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+# Очередь к модели: сначала интерактивные запросы, пользователи по кругу
+@pytest.mark.asyncio
+async def test_llm_scheduler_priority_and_fairness():
+    scheduler = LlmScheduler(requests_per_minute=1200, tokens_per_minute=10 ** 6, max_queue=10, burst=0.05)
+    order = []
+
+    async def request(name, user_id, priority=PRIORITY_INTERACTIVE):
+        await scheduler.acquire(user_id, 100, priority)
+        order.append(name)
+
+    await asyncio.gather(
+        request("warmup", "cache_warmup", PRIORITY_BACKGROUND),
+        request("a1", 1), request("a2", 1), request("a3", 1), request("b1", 2)
+    )
+    assert order == ["a1", "b1", "a2", "a3", "warmup"]
+    stats = scheduler.stats()
+    assert (stats["dispatched"], stats["queue_depth"]) == (5, 0)
+    assert stats["p95_wait"] >= 0.15
+
+@pytest.mark.asyncio
+async def test_llm_scheduler_token_budget():
+    # 600 токенов в минуту = 10 в секунду: второй запрос на 5 токенов ждет полсекунды
+    scheduler = LlmScheduler(requests_per_minute=600, tokens_per_minute=600, max_queue=10, burst=0.5)
+    assert await scheduler.acquire(1, 5) < 0.1
+    assert 0.3 < await scheduler.acquire(2, 5) < 0.8
+
+@pytest.mark.asyncio
+async def test_llm_scheduler_rejects_and_forgets_cancelled():
+    scheduler = LlmScheduler(requests_per_minute=1, tokens_per_minute=10 ** 6, max_queue=2, burst=1)
+    await scheduler.acquire(1, 1)
+    waiting = [asyncio.create_task(scheduler.acquire(user_id, 1)) for user_id in (1, 2)]
+    await asyncio.sleep(0)
+    assert scheduler.queue_depth == 2
+    with pytest.raises(SchedulerOverloaded):
+        await scheduler.acquire(3, 1)
+
+    for task in waiting:
+        task.cancel()
+    await asyncio.gather(*waiting, return_exceptions=True)
+    assert scheduler.queue_depth == 0
+    assert scheduler.stats()["rejected"] == 1
+
+@pytest.mark.asyncio
+async def test_get_recipe_when_queue_is_full():
+    scheduler = LlmScheduler(requests_per_minute=60, tokens_per_minute=10 ** 6, max_queue=0)
+    with patch('backend.services.ai_service.ai.llm_scheduler', scheduler):
+        recipe, ingredients = await get_recipe("борщ", {})
+    assert "слишком много запросов" in recipe
+    assert ingredients == {}
+
+def test_request_tokens():
+    assert request_tokens(build_recipe_request("борщ", {})) > 2000
+
+SAVED_RECIPE = {
+    "_id": "123456",
+    "name": "Паста карбонара на 2 порции",
+    "query": "паста карбонара на двоих",
+    "recipe": "Паста карбонара:\n\n\nИнгредиенты:\n• Спагетти - 200 г\n• Бекон - 100 г\n• Яйца - 2 шт",
+    "products": {"спагетти": "200 г", "бекон": "100 г", "яйца": "2 шт"},
+    "base_portions": 2
+}
+
+def test_split_portions():
+    assert split_portions("Борщ на две порции!") == ("борщ", 2)
+    assert split_portions("борщ на 2") == ("борщ", 2)
+    assert split_portions("Борщ") == ("борщ", None)
+
+def test_recipe_index_finds_near_duplicate():
+    index = RecipeIndex().build([SAVED_RECIPE])
+    assert index.find("Паста Карбонара на 2 порции", {}) == "123456"
+    assert index.find("паста карбонара, на двоих!", {}) == "123456"
+    # Другое число порций или другое блюдо - генерируем заново
+    assert index.find("паста карбонара на 4 порции", {}) is None
+    assert index.find("борщ на 2 порции", {}) is None
+
+@pytest.mark.parametrize("preferences", [
+    {"allergies": ["яйцо"]},
+    {"unliked_products": ["бекон"]},
+])
+def test_recipe_index_respects_restrictions(preferences):
+    index = RecipeIndex().build([SAVED_RECIPE])
+    assert index.find("паста карбонара на 2 порции", preferences) is None
+    assert index.find("паста карбонара на 2 порции", {"allergies": ["орехи"]}) == "123456"
+
+def test_recipe_index_skips_failed_generations():
+    error_recipe = {
+        "_id": "654321",
+        "name": "борщ на 2 порции",
+        "query": "борщ на 2 порции",
+        "recipe": "Произошла ошибка при получении рецепта: 503",
+        "products": {},
+        "base_portions": 1
+    }
+    index = RecipeIndex().build([error_recipe])
+    assert len(index) == 0
+    assert index.find("Борщ на две порции", {}) is None
+
+def test_display_recipe_is_idempotent():
+    text = display_recipe(DEFAULT_RECIPE)
+    assert display_recipe(text) == text
@@ -5,10 +5,13 @@ import json
 from pymongo.collection import Collection
 from pymongo.database import Database
 from pymongo import MongoClient
-from mongo_db import MongoDBManager
+from mongo_db import MongoDBManager, AsyncMongoDBManager, RECIPE_INDEXES
 from sql_db import DatabaseManager
+import sql_db
 import os
 import sqlite3
+import asyncio
+from contextlib import asynccontextmanager
 
 @pytest.fixture
 def mock_mongo_client():
@@ -50,6 +53,42 @@ def test_save_recipe(mongo_manager):
     assert len(recipe_id) == 6
     mongo_manager.recipes.insert_one.assert_called_once()
 
+def test_save_recipe_keeps_raw_offers(mongo_manager):
+    mongo_manager.recipes.find_one = Mock(return_value=None)
+    mongo_manager.recipes.insert_one = Mock()
+    raw_offers = {"молоко": [{"name": "Молоко 1 л", "price": 100.0, "link": "1"}]}
+
+    mongo_manager.save_recipe("Test Recipe", "Test instructions", {"молоко": "1 л"}, 123, {}, raw_offers=raw_offers, portions=2)
+
+    recipe_doc = mongo_manager.recipes.insert_one.call_args[0][0]
+    assert recipe_doc["raw_offers"] == raw_offers
+    assert recipe_doc["portions"] == 2
+    assert recipe_doc["base_portions"] == 2
+
+def test_save_recipe_keeps_query(mongo_manager):
+    mongo_manager.recipes.find_one = Mock(return_value=None)
+    mongo_manager.recipes.insert_one = Mock()
+
+    mongo_manager.save_recipe("Борщ на 2 порции", "Test instructions", {}, 123, query="борщ на двоих")
+
+    recipe_doc = mongo_manager.recipes.insert_one.call_args[0][0]
+    assert recipe_doc["query"] == "борщ на двоих"
+
+def test_recipes_for_index_skip_empty_products(mongo_manager):
+    mongo_manager.recipes.find = Mock(return_value=iter([]))
+    mongo_manager.get_recipes_for_index()
+    query = mongo_manager.recipes.find.call_args[0][0]
+    assert query == {"products": {"$exists": True, "$ne": {}}}
+
+def test_update_product_links(mongo_manager):
+    mongo_manager.recipes.update_one = Mock(return_value=Mock(matched_count=1))
+
+    assert mongo_manager.update_product_links("123456", {"total_cost": 10.0}, name="Блины на 3 порции", portions=3)
+    mongo_manager.recipes.update_one.assert_called_once_with(
+        {"_id": "123456"},
+        {"$set": {"product_links": {"total_cost": 10.0}, "name": "Блины на 3 порции", "portions": 3}}
+    )
+
 def test_get_recipe(mongo_manager):
     expected_recipe = {
         "_id": "123456",
@@ -95,6 +134,85 @@ def test_is_favorite(mongo_manager):
     assert mongo_manager.is_favorite("123456", 123) is True
     assert mongo_manager.is_favorite("123456", 456) is False
 
+@pytest.mark.asyncio
+async def test_async_manager_runs_off_event_loop(mongo_manager):
+    import threading
+    threads = []
+
+    def find_one(query):
+        threads.append(threading.current_thread().name)
+        return {"_id": query["_id"], "favorite_by": [123]}
+
+    mongo_manager.recipes.find_one = Mock(side_effect=find_one)
+    async_manager = AsyncMongoDBManager(manager=mongo_manager, max_workers=2)
+
+    recipes = await asyncio.gather(*(async_manager.get_recipe(str(i)) for i in range(5)))
+    assert [recipe["_id"] for recipe in recipes] == [str(i) for i in range(5)]
+    assert await async_manager.is_favorite("1", 123)
+    assert all(name.startswith("mongo") for name in threads)
+    assert threading.current_thread().name not in threads
+    async_manager.close()
+
+@pytest.mark.asyncio
+async def test_async_manager_reads_index_cursor(mongo_manager):
+    mongo_manager.recipes.find = Mock(return_value=iter([{"_id": "1"}, {"_id": "2"}]))
+    async_manager = AsyncMongoDBManager(manager=mongo_manager)
+
+    assert await async_manager.get_recipes_for_index() == [{"_id": "1"}, {"_id": "2"}]
+    async_manager.close()
+
+def test_ensure_indexes(mongo_manager):
+    mongo_manager.recipes.create_index = Mock()
+    mongo_manager.ensure_indexes()
+    mongo_manager.recipes.create_index.assert_any_call([("user_id", 1), ("timestamp", -1)], name="user_id_timestamp")
+    mongo_manager.recipes.create_index.assert_any_call([("favorite_by", 1)], name="favorite_by")
+
+@pytest.fixture
+def local_mongo_manager():
+    """Настоящий mongod (MONGO_TEST_URL или localhost) - для проверки планов запросов"""
+    client = MongoClient(os.environ.get("MONGO_TEST_URL", "mongodb://localhost:27017"), serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command('ping')
+    except Exception:
+        client.close()
+        pytest.skip("local mongod is not available")
+    manager = MongoDBManager.__new__(MongoDBManager)
+    manager.client = client
+    manager.db = client["recipe_bot_test"]
+    manager.recipes = manager.db["recipes"]
+    manager.recipes.drop()
+    manager.recipes.insert_many([
+        {"_id": str(i), "user_id": i % 10, "favorite_by": [i % 7, i % 5],
+         "timestamp": datetime.datetime(2024, 1, 1) + datetime.timedelta(minutes=i)}
+        for i in range(200)
+    ])
+    manager.ensure_indexes()
+    yield manager
+    client.drop_database("recipe_bot_test")
+    client.close()
+
+def plan_stages(plan: dict) -> list:
+    stages = [plan.get("stage")]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+    return stages
+
+def test_history_query_uses_index(local_mongo_manager):
+    plan = local_mongo_manager.recipes.find({"user_id": 3}).sort("timestamp", -1).skip(3).limit(3)\
+        .explain()["queryPlanner"]["winningPlan"]
+    stages = plan_stages(plan)
+    assert "IXSCAN" in stages
+    # Ни перебора коллекции, ни сортировки в памяти - порядок дает индекс
+    assert "COLLSCAN" not in stages and "SORT" not in stages
+
+def test_favorites_query_uses_index(local_mongo_manager):
+    plan = local_mongo_manager.recipes.find({"favorite_by": 3}).explain()["queryPlanner"]["winningPlan"]
+    stages = plan_stages(plan)
+    assert "IXSCAN" in stages and "COLLSCAN" not in stages
+
 class DatabaseManager:
     def __init__(self, db_name: str = "bot.db"):
         self.db_name = db_name
@@ -359,5 +477,159 @@ def test_database_connection_error():
             db_manager = DatabaseManager("test_bot.db")
             db_manager.add_user(1, "test_user", "en")
 
+@pytest.mark.asyncio
+async def test_pooled_database_manager(tmp_path):
+    manager = sql_db.DatabaseManager(str(tmp_path / "pool.db"), pool_size=2)
+    # Без явного start пул открывается при первом запросе
+    assert await manager.add_user(1, "test_user", "en") is True
+    await manager.update_user_preferences(1, allergies=["nuts"], max_price=1000)
+    users = await asyncio.gather(*(manager.get_user(1) for _ in range(10)))
+    assert all(user["allergies"] == ["nuts"] and user["max_price"] == 1000 for user in users)
+
+    async with manager._connection() as db:
+        cursor = await db.execute("PRAGMA journal_mode")
+        assert (await cursor.fetchone())[0] == "wal"
+    await manager.close()
+    assert manager._pool is None
+
+@pytest.mark.asyncio
+async def test_pooled_connection_rolls_back_after_error(tmp_path):
+    manager = sql_db.DatabaseManager(str(tmp_path / "pool.db"), pool_size=1)
+    await manager.add_user(1, "test_user", "en")
+    with pytest.raises(RuntimeError):
+        async with manager._connection() as db:
+            await db.execute("UPDATE users SET max_price = 5 WHERE user_id = 1")
+            raise RuntimeError("handler failed")
+    assert (await manager.get_user(1))["max_price"] == 0
+    await manager.close()
+
+@pytest.mark.asyncio
+async def test_recipe_lists_are_migrated_from_json(tmp_path):
+    db_path = str(tmp_path / "old.db")
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('''
+            CREATE TABLE users (
+                user_id INTEGER PRIMARY KEY, user_name TEXT, language TEXT,
+                recipe_history TEXT, favourite_recipes TEXT, allergies TEXT,
+                max_price INTEGER DEFAULT 0, unliked_products TEXT
+            )
+        ''')
+        conn.execute("INSERT INTO users VALUES (1, 'old_user', 'ru', ?, ?, '[]', 0, '[]')",
+                     (json.dumps(["r1", "r2", "r3"]), json.dumps(["r2"])))
+        conn.execute("INSERT INTO users VALUES (2, 'broken', 'ru', 'not json', '[]', '[]', 0, '[]')")
+
+    manager = sql_db.DatabaseManager(db_path, pool_size=1)
+    user = await manager.get_user(1)
+    assert user["recipe_history"] == ["r1", "r2", "r3"]
+    assert user["favourite_recipes"] == ["r2"]
+    assert (await manager.get_user(2))["recipe_history"] == []
+    await manager.close()
+
+    # Повторный старт не переносит списки второй раз
+    manager = sql_db.DatabaseManager(db_path, pool_size=1)
+    await manager.update_recipe_history(1, "r4")
+    assert (await manager.get_user(1))["recipe_history"] == ["r1", "r2", "r3", "r4"]
+    await manager.close()
+
+@pytest.mark.asyncio
+async def test_recipe_history_pages(tmp_path):
+    manager = sql_db.DatabaseManager(str(tmp_path / "pool.db"), pool_size=1)
+    await manager.add_user(1, "test_user", "en")
+    for recipe_id in ["r1", "r2", "r3", "r1"]:
+        await manager.update_recipe_history(1, recipe_id)
+    # Пользователя нет - ничего не пишется
+    await manager.update_favourite_recipes(2, "r1")
+
+    assert await manager.get_recipe_history(1, limit=2) == (["r3", "r2"], True)
+    assert await manager.get_recipe_history(1, offset=2, limit=2) == (["r1"], False)
+    assert await manager.get_favourite_recipes(2) == ([], False)
+    await manager.close()
+
+@pytest.mark.asyncio
+async def test_preference_writes_are_batched(tmp_path):
+    manager = sql_db.DatabaseManager(str(tmp_path / "pool.db"), pool_size=2)
+    for user_id in range(5):
+        await manager.add_user(user_id, f"user{user_id}", "en")
+
+    await asyncio.gather(*(manager.update_user_preferences(user_id, allergies=["nuts"], max_price=user_id * 100)
+                           for user_id in range(5)))
+    assert manager.preference_batches == 1
+    assert manager.preference_writes == 5
+    assert (await manager.get_user(3))["max_price"] == 300
+    await manager.close()
+
+@pytest.mark.asyncio
+async def test_write_behind_preferences(tmp_path):
+    db_path = str(tmp_path / "pool.db")
+    manager = sql_db.DatabaseManager(db_path, pool_size=1, write_delay=60, wait_for_commit=False)
+    await manager.add_user(1, "test_user", "en")
+    await manager.update_user_preferences(1, allergies=["nuts"])
+    await manager.update_user_preferences(1, max_price=500)
+    # Еще не записано, но уже видно
+    user = await manager.get_user(1)
+    assert user["allergies"] == ["nuts"] and user["max_price"] == 500
+    assert manager.preference_batches == 0
+    # При закрытии ожидающие изменения дописываются
+    await manager.close()
+
+    manager = sql_db.DatabaseManager(db_path, pool_size=1)
+    user = await manager.get_user(1)
+    assert user["allergies"] == ["nuts"] and user["max_price"] == 500
+    await manager.close()
+
+def slow_connections(manager, delay: float):
+    """Каждый запрос к базе сначала ждет delay секунд - чтобы застать flush посередине"""
+    original = manager._connection
+    started = asyncio.Event()
+
+    @asynccontextmanager
+    async def connection():
+        started.set()
+        await asyncio.sleep(delay)
+        async with original() as db:
+            yield db
+
+    manager._connection = connection
+    return started
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("wait_for_commit", [True, False])
+async def test_close_during_slow_flush(tmp_path, wait_for_commit):
+    db_path = str(tmp_path / "pool.db")
+    manager = sql_db.DatabaseManager(db_path, pool_size=1, wait_for_commit=wait_for_commit)
+    await manager.add_user(1, "test_user", "en")
+    started = slow_connections(manager, 0.2)
+
+    update = asyncio.create_task(manager.update_user_preferences(1, max_price=700))
+    await started.wait()
+    await manager.close()
+    # Ожидающий не зависает, изменение записано
+    await asyncio.wait_for(update, timeout=1)
+
+    manager = sql_db.DatabaseManager(db_path, pool_size=1)
+    assert (await manager.get_user(1))["max_price"] == 700
+    await manager.close()
+
+@pytest.mark.asyncio
+async def test_cancelled_flush_requeues_batch(tmp_path):
+    db_path = str(tmp_path / "pool.db")
+    manager = sql_db.DatabaseManager(db_path, pool_size=1)
+    await manager.add_user(1, "test_user", "en")
+    started = slow_connections(manager, 0.2)
+
+    update = asyncio.create_task(manager.update_user_preferences(1, max_price=700))
+    await started.wait()
+    manager._flush_task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await manager._flush_task
+    assert manager._pending_preferences == {1: {"max_price": 700}}
+    assert not update.done()
+
+    await manager.close()
+    await asyncio.wait_for(update, timeout=1)
+    manager = sql_db.DatabaseManager(db_path, pool_size=1)
+    assert (await manager.get_user(1))["max_price"] == 700
+    await manager.close()
+
 if __name__ == "__main__":
     pytest.main(["-v"])
\ No newline at end of file
@@ -1,8 +1,22 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, DESCENDING
 import certifi
 import random
 from typing import Optional, Dict, Any
 import datetime
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# Сколько запросов к MongoDB идут одновременно; остальные ждут свободный поток,
+# а event loop бота в это время занят другими пользователями
+MONGO_MAX_WORKERS = 8
+
+# Индексы коллекции рецептов: (ключи, имя). История - по пользователю от новых к старым,
+# избранное - multikey по массиву favorite_by
+RECIPE_INDEXES = [
+    ([("user_id", ASCENDING), ("timestamp", DESCENDING)], "user_id_timestamp"),
+    ([("favorite_by", ASCENDING)], "favorite_by"),
+]
 
 class MongoDBManager:
     def __init__(self, mongo_url: str, db_name: str = "recipe_bot", collection_name: str = "recipes"):
@@ -17,24 +31,10 @@ class MongoDBManager:
             print(f"MongoDB connection failed: {e}")
             raise
 
-    def save_recipe(self, recipe_name: str, recipe_text: str, products: Dict[str, str], user_id: int) -> str:
-        while True:
-            recipe_id = str(random.randint(100000, 999999))
-            existing = self.recipes.find_one({"_id": recipe_id})
-            if not existing:
-                break
-
-        recipe_doc = {
-            "_id": recipe_id,
-            "name": recipe_name,
-            "recipe": recipe_text,
-            "products": products,
-            "user_id": user_id,
-            "timestamp": datetime.datetime.now()
-        }
-
-        self.recipes.insert_one(recipe_doc)
-        return recipe_id
+    def ensure_indexes(self):
+        """Создает недостающие индексы; уже существующие create_index не трогает"""
+        for keys, name in RECIPE_INDEXES:
+            self.recipes.create_index(keys, name=name)
 
     def get_recipe(self, recipe_id: str) -> Optional[Dict[str, Any]]:
         return self.recipes.find_one({"_id": recipe_id})
@@ -52,7 +52,8 @@ class MongoDBManager:
         
         return recipes, has_more
     
-    def save_recipe(self, recipe_name: str, recipe_text: str, products: Dict[str, str], user_id: int, product_links: Dict = None) -> str:
+    def save_recipe(self, recipe_name: str, recipe_text: str, products: Dict[str, str], user_id: int, product_links: Dict = None,
+                    raw_offers: Dict[str, list] = None, portions: int = 1, query: str = None) -> str:
         while True:
             recipe_id = str(random.randint(100000, 999999))
             existing = self.recipes.find_one({"_id": recipe_id})
@@ -65,13 +66,37 @@ class MongoDBManager:
             "recipe": recipe_text,
             "products": products,
             "product_links": product_links or {},
+            # Все найденные предложения - чтобы пересобрать корзину без повторного поиска
+            "raw_offers": raw_offers or {},
+            "portions": portions,
+            "base_portions": portions,
             "user_id": user_id,
             "timestamp": datetime.datetime.now()
         }
+        if query:
+            # Исходный запрос пользователя - по нему ищутся похожие рецепты
+            recipe_doc["query"] = query
 
         self.recipes.insert_one(recipe_doc)
         return recipe_id
     
+    def get_recipes_for_index(self):
+        """Только поля, нужные индексу похожих рецептов, и только рецепты с ингредиентами"""
+        return self.recipes.find({"products": {"$exists": True, "$ne": {}}}, {"name": 1, "query": 1, "recipe": 1, "products": 1,
+                                      "portions": 1, "base_portions": 1})
+
+    def update_product_links(self, recipe_id: str, product_links: Dict, name: str = None,
+                             portions: int = None, base_portions: int = None) -> bool:
+        update = {"product_links": product_links}
+        if name is not None:
+            update["name"] = name
+        if portions is not None:
+            update["portions"] = portions
+        if base_portions is not None:
+            update["base_portions"] = base_portions
+        result = self.recipes.update_one({"_id": recipe_id}, {"$set": update})
+        return result.matched_count > 0
+
     def toggle_favorite(self, recipe_id: str, user_id: int) -> bool:
         recipe = self.recipes.find_one({"_id": recipe_id})
         if not recipe:
@@ -101,4 +126,52 @@ class MongoDBManager:
         return list(self.recipes.find({"favorite_by": user_id}))
 
     def close(self):
-        self.client.close()
\ No newline at end of file
+        self.client.close()
+
+
+class AsyncMongoDBManager:
+    """
+    Тот же интерфейс, что у MongoDBManager, но каждый вызов - корутина:
+    синхронный pymongo выполняется в своем пуле потоков и не блокирует event loop
+    """
+
+    def __init__(self, mongo_url: str = None, db_name: str = "recipe_bot", collection_name: str = "recipes",
+                 max_workers: int = MONGO_MAX_WORKERS, manager: MongoDBManager = None):
+        self.sync = manager or MongoDBManager(mongo_url, db_name=db_name, collection_name=collection_name)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mongo")
+
+    async def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+
+    async def ensure_indexes(self):
+        await self._run(self.sync.ensure_indexes)
+
+    async def get_recipe(self, recipe_id: str) -> Optional[Dict[str, Any]]:
+        return await self._run(self.sync.get_recipe, recipe_id)
+
+    async def get_user_recipes(self, user_id: int, skip: int = 0, limit: int = 10) -> tuple[list[Dict[str, Any]], bool]:
+        return await self._run(self.sync.get_user_recipes, user_id, skip=skip, limit=limit)
+
+    async def save_recipe(self, *args, **kwargs) -> str:
+        return await self._run(self.sync.save_recipe, *args, **kwargs)
+
+    async def get_recipes_for_index(self) -> list:
+        # Курсор читаем целиком в том же потоке - каждая следующая пачка это запрос к серверу
+        return await self._run(lambda: list(self.sync.get_recipes_for_index()))
+
+    async def update_product_links(self, *args, **kwargs) -> bool:
+        return await self._run(self.sync.update_product_links, *args, **kwargs)
+
+    async def toggle_favorite(self, recipe_id: str, user_id: int) -> bool:
+        return await self._run(self.sync.toggle_favorite, recipe_id, user_id)
+
+    async def is_favorite(self, recipe_id: str, user_id: int) -> bool:
+        return await self._run(self.sync.is_favorite, recipe_id, user_id)
+
+    async def get_user_favorites(self, user_id: int) -> list:
+        return await self._run(self.sync.get_user_favorites, user_id)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.sync.close()
@@ -1,41 +1,255 @@
-import sqlite3
+import asyncio
 import json
+import time
+from contextlib import asynccontextmanager
 from typing import List, Optional
 import aiosqlite
 
+# Соединения живут все время работы бота: без потока и открытия файла на каждый запрос.
+# В WAL читатели не ждут писателя, поэтому соединений несколько
+SQLITE_POOL_SIZE = 4
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_CACHE_SIZE_KB = 8192
+# Подготовленные запросы кэшируются в каждом соединении по тексту SQL
+SQLITE_STATEMENT_CACHE = 64
+
+# PRAGMA user_version: 1 - история и избранное в отдельных таблицах, а не JSON в users
+SCHEMA_VERSION = 1
+MIGRATION_BATCH_SIZE = 500
+
+# Изменения предпочтений копятся и пишутся одной транзакцией: через PREFERENCE_WRITE_DELAY
+# секунд после первого изменения или сразу, как наберется PREFERENCE_WRITE_BATCH_SIZE пользователей.
+# При 0 пачку собирает сама запись: пока коммитится одна, следующие изменения ждут и уходят вместе.
+# В WAL с synchronous=NORMAL коммит дешевый, и лишняя задержка только тормозит
+PREFERENCE_WRITE_DELAY = 0
+PREFERENCE_WRITE_BATCH_SIZE = 200
+# True - update_user_preferences возвращается после коммита своей пачки: ничего не теряется.
+# False - сразу, запись догоняет в фоне; при падении процесса теряется до PREFERENCE_WRITE_DELAY
+# секунд изменений, зато обработчик не ждет диска
+PREFERENCE_WAIT_FOR_COMMIT = True
+# Через сколько секунд повторять запись пачки после ошибки
+PREFERENCE_RETRY_DELAY = 1.0
+
+HISTORY_TABLE = "user_recipe_history"
+FAVOURITES_TABLE = "user_favourites"
+
+
+def _recipe_ids_json(table: str) -> str:
+    return (f"(SELECT json_group_array(recipe_id) FROM "
+            f"(SELECT recipe_id FROM {table} WHERE user_id = users.user_id ORDER BY added_at))")
+
+# Пользователь вместе со списками рецептов одним запросом - один переход в поток aiosqlite
+GET_USER_SQL = (
+    "SELECT user_id, user_name, language, allergies, max_price, unliked_products, "
+    f"{_recipe_ids_json(HISTORY_TABLE)} AS recipe_history, "
+    f"{_recipe_ids_json(FAVOURITES_TABLE)} AS favourite_recipes "
+    "FROM users WHERE user_id = ?"
+)
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    # В WAL при сбое питания теряется максимум последний коммит, целостность не страдает
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}",
+    f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+)
+
+
+def _preferences_update_sql(columns: tuple) -> str:
+    """Одно UPDATE на все измененные поля"""
+    return f"UPDATE users SET {', '.join(f'{column} = ?' for column in columns)} WHERE user_id = ?"
+
 class DatabaseManager:
-    def __init__(self, db_name: str = "bot.db"):
+    def __init__(self, db_name: str = "bot.db", pool_size: int = SQLITE_POOL_SIZE,
+                 write_delay: float = PREFERENCE_WRITE_DELAY, write_batch_size: int = PREFERENCE_WRITE_BATCH_SIZE,
+                 wait_for_commit: bool = PREFERENCE_WAIT_FOR_COMMIT):
         self.db_name = db_name
-        self._create_tables()
+        self.pool_size = pool_size
+        self.write_delay = write_delay
+        self.write_batch_size = write_batch_size
+        self.wait_for_commit = wait_for_commit
+        self._connections = []
+        self._pool = None
+        self._start_lock = asyncio.Lock()
+        # user_id -> {колонка: значение} - еще не записанные изменения предпочтений
+        self._pending_preferences = {}
+        # Пачка, которая сейчас пишется: до коммита get_user берет значения из нее
+        self._flushing_preferences = {}
+        self._commit_waiters = []
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._batch_full = asyncio.Event()
+        self._closing = False
+        self.preference_writes = 0
+        self.preference_batches = 0
+
+    async def _open(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.db_name, cached_statements=SQLITE_STATEMENT_CACHE)
+        for pragma in SQLITE_PRAGMAS:
+            await db.execute(pragma)
+        return db
+
+    async def start(self):
+        """Open the connection pool and create tables. Called on bot startup, or lazily on first query."""
+        async with self._start_lock:
+            if self._pool is not None:
+                return
+            connections = []
+            try:
+                for _ in range(self.pool_size):
+                    connections.append(await self._open())
+                await self._create_tables(connections[0])
+                await self._migrate(connections[0])
+            except Exception:
+                for db in connections:
+                    await db.close()
+                raise
+            pool = asyncio.Queue()
+            for db in connections:
+                pool.put_nowait(db)
+            self._connections = connections
+            self._pool = pool
 
-    def _create_tables(self):
+    async def close(self):
+        """Write pending preferences and close all pooled connections. Called on bot shutdown."""
+        # Фоновую запись не отменяем, а будим и дожидаемся: отмена посреди коммита теряла бы пачку.
+        # Остаток дописывает последний flush ниже, новая фоновая задача уже не ставится
+        self._closing = True
+        if self._flush_task is not None and not self._flush_task.done():
+            self._batch_full.set()
+            try:
+                await self._flush_task
+            except Exception as e:
+                print(f"Error writing preferences: {e}")
+        try:
+            await self.flush_preferences()
+        except Exception as e:
+            print(f"Error writing pending preferences: {e}")
+        async with self._start_lock:
+            connections, self._connections, self._pool = self._connections, [], None
+            for db in connections:
+                try:
+                    await db.close()
+                except Exception as e:
+                    print(f"Error closing database connection: {e}")
+            self._closing = False
+
+    @asynccontextmanager
+    async def _connection(self):
+        if self._pool is None:
+            await self.start()
+        pool = self._pool
+        db = await pool.get()
+        try:
+            yield db
+        finally:
+            try:
+                # Незавершенную после ошибки транзакцию не оставляем следующему запросу
+                if db.in_transaction:
+                    await db.rollback()
+            finally:
+                pool.put_nowait(db)
+
+    async def _create_tables(self, db: aiosqlite.Connection):
         """Create necessary tables if they don't exist."""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    user_name TEXT,
-                    language TEXT,
-                    recipe_history TEXT,
-                    favourite_recipes TEXT,
-                    allergies TEXT,
-                    max_price INTEGER DEFAULT 0,
-                    unliked_products TEXT
-                )
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                user_name TEXT,
+                language TEXT,
+                recipe_history TEXT,
+                favourite_recipes TEXT,
+                allergies TEXT,
+                max_price INTEGER DEFAULT 0,
+                unliked_products TEXT
+            )
+        ''')
+        # Колонки recipe_history и favourite_recipes остались от старой схемы и больше не пишутся.
+        # Порядок добавления - added_at, у перенесенных из JSON это позиция в списке
+        for table in (HISTORY_TABLE, FAVOURITES_TABLE):
+            await db.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    user_id INTEGER NOT NULL,
+                    recipe_id TEXT NOT NULL,
+                    added_at INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, recipe_id)
+                ) WITHOUT ROWID
             ''')
-            
-            conn.commit()
+            await db.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_added ON {table} (user_id, added_at)')
+        await db.commit()
+
+    async def _migrate(self, db: aiosqlite.Connection):
+        """Move JSON recipe lists from users into the relational tables."""
+        cursor = await db.execute('PRAGMA user_version')
+        version = (await cursor.fetchone())[0]
+        await cursor.close()
+        if version >= SCHEMA_VERSION:
+            return
+
+        # Пачками по user_id: запись не блокируется надолго, а прерванный перенос
+        # просто повторится - INSERT OR IGNORE не создаст дублей
+        last_user_id = None
+        while True:
+            cursor = await db.execute(
+                'SELECT user_id, recipe_history, favourite_recipes FROM users '
+                'WHERE ? IS NULL OR user_id > ? ORDER BY user_id LIMIT ?',
+                (last_user_id, last_user_id, MIGRATION_BATCH_SIZE)
+            )
+            rows = await cursor.fetchall()
+            await cursor.close()
+            if not rows:
+                break
+            for table, column in ((HISTORY_TABLE, 1), (FAVOURITES_TABLE, 2)):
+                values = []
+                for row in rows:
+                    try:
+                        recipe_ids = json.loads(row[column] or '[]')
+                    except ValueError as e:
+                        print(f"Error migrating {table} for user {row[0]}: {e}")
+                        continue
+                    values.extend((row[0], str(recipe_id), position) for position, recipe_id in enumerate(recipe_ids))
+                await db.executemany(
+                    f'INSERT OR IGNORE INTO {table} (user_id, recipe_id, added_at) VALUES (?, ?, ?)',
+                    values
+                )
+            await db.commit()
+            last_user_id = rows[-1][0]
+
+        await db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        await db.commit()
+
+    async def _add_recipe_id(self, table: str, user_id: int, recipe_id: str):
+        async with self._connection() as db:
+            # Только для существующего пользователя; повтор отсекает первичный ключ
+            await db.execute(
+                f'INSERT OR IGNORE INTO {table} (user_id, recipe_id, added_at) '
+                f'SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE user_id = ?)',
+                (user_id, recipe_id, time.time_ns(), user_id)
+            )
+            await db.commit()
+
+    async def _recipe_ids_page(self, table: str, user_id: int, offset: int, limit: int) -> tuple[List[str], bool]:
+        async with self._connection() as db:
+            # Берем на одну запись больше - так видно, есть ли следующая страница, без COUNT
+            cursor = await db.execute(
+                f'SELECT recipe_id FROM {table} WHERE user_id = ? ORDER BY added_at DESC LIMIT ? OFFSET ?',
+                (user_id, limit + 1, offset)
+            )
+            rows = await cursor.fetchall()
+            await cursor.close()
+        return [row[0] for row in rows[:limit]], len(rows) > limit
 
     async def add_user(self, user_id: int, user_name: str, language: str) -> bool:
         """Add new user to database if not exists."""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._connection() as db:
             cursor = await db.execute(
                 'SELECT user_id FROM users WHERE user_id = ?', 
                 (user_id,)
             )
             exists = await cursor.fetchone()
+            # Соединение живет долго - курсор закрываем сразу, чтобы не держать снимок чтения
+            await cursor.close()
             
             if not exists:
                 await db.execute('''
@@ -57,16 +271,18 @@ class DatabaseManager:
 
     async def get_user(self, user_id: int) -> Optional[dict]:
         """Get user data by user_id."""
-        async with aiosqlite.connect(self.db_name) as db:
-            cursor = await db.execute(
-                'SELECT * FROM users WHERE user_id = ?', 
-                (user_id,)
-            )
+        async with self._connection() as db:
+            cursor = await db.execute(GET_USER_SQL, (user_id,))
             user = await cursor.fetchone()
+            column_names = [description[0] for description in cursor.description]
+            await cursor.close()
             
             if user:
-                column_names = [description[0] for description in cursor.description]
                 user_dict = dict(zip(column_names, user))
+                # Еще не записанные изменения видны сразу
+                for pending in (self._flushing_preferences, self._pending_preferences):
+                    if user_id in pending:
+                        user_dict.update(pending[user_id])
                 user_dict['recipe_history'] = json.loads(user_dict['recipe_history'])
                 user_dict['favourite_recipes'] = json.loads(user_dict['favourite_recipes'])
                 user_dict['allergies'] = json.loads(user_dict['allergies'])
@@ -77,64 +293,122 @@ class DatabaseManager:
     async def update_user_preferences(self, user_id: int, allergies: List[str] = None, 
                                     max_price: int = None, unliked_products: List[str] = None):
         """Update user preferences."""
-        async with aiosqlite.connect(self.db_name) as db:
-            if allergies is not None:
-                await db.execute(
-                    'UPDATE users SET allergies = ? WHERE user_id = ?',
-                    (json.dumps(allergies), user_id)
-                )
-            
-            if max_price is not None:
-                await db.execute(
-                    'UPDATE users SET max_price = ? WHERE user_id = ?',
-                    (max_price, user_id)
-                )
-            
-            if unliked_products is not None:
-                await db.execute(
-                    'UPDATE users SET unliked_products = ? WHERE user_id = ?',
-                    (json.dumps(unliked_products), user_id)
-                )
-            
-            await db.commit()
+        changes = {}
+        if allergies is not None:
+            changes['allergies'] = json.dumps(allergies)
+        if max_price is not None:
+            changes['max_price'] = max_price
+        if unliked_products is not None:
+            changes['unliked_products'] = json.dumps(unliked_products)
+        if not changes:
+            return
+
+        self._pending_preferences.setdefault(user_id, {}).update(changes)
+        waiter = None
+        if self.wait_for_commit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._commit_waiters.append(waiter)
+        if len(self._pending_preferences) >= self.write_batch_size:
+            self._batch_full.set()
+        if self._closing:
+            # Пул уже закрывается - пишем сами, фоновая задача не нужна
+            await self.flush_preferences()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+        if waiter is not None:
+            await waiter
+
+    async def _flush_later(self):
+        if self.write_delay > 0:
+            try:
+                await asyncio.wait_for(self._batch_full.wait(), timeout=self.write_delay)
+            except asyncio.TimeoutError:
+                pass
+        else:
+            # Изменения из этой же итерации цикла событий попадут в ту же пачку
+            await asyncio.sleep(0)
+        try:
+            await self.flush_preferences()
+        except Exception as e:
+            print(f"Error writing preferences: {e}")
+            # Вернувшуюся в очередь пачку повторяем не сразу - база может быть недоступна
+            try:
+                await asyncio.wait_for(self._batch_full.wait(), timeout=PREFERENCE_RETRY_DELAY)
+            except asyncio.TimeoutError:
+                pass
+        # Пока писали, могли прийти новые изменения
+        if self._pending_preferences and not self._closing:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def flush_preferences(self):
+        """Commit all pending preference changes in one transaction."""
+        async with self._flush_lock:
+            pending, self._pending_preferences = self._pending_preferences, {}
+            waiters, self._commit_waiters = self._commit_waiters, []
+            self._batch_full.clear()
+            if not pending:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+                return
+
+            # Пользователи с одинаковым набором измененных полей - один executemany
+            groups = {}
+            for user_id, changes in pending.items():
+                columns = tuple(sorted(changes))
+                groups.setdefault(columns, []).append(tuple(changes[column] for column in columns) + (user_id,))
+
+            self._flushing_preferences = pending
+            try:
+                async with self._connection() as db:
+                    for columns, rows in groups.items():
+                        await db.executemany(_preferences_update_sql(columns), rows)
+                    await db.commit()
+            except asyncio.CancelledError:
+                # Пачка и ее ожидающие возвращаются в очередь - запишет следующий flush
+                self._requeue_preferences(pending)
+                self._commit_waiters = waiters + self._commit_waiters
+                raise
+            except Exception as e:
+                # Ожидающим сообщаем об ошибке - их изменения не записаны. В режиме без
+                # ожидания сообщить некому, поэтому пачка возвращается в очередь на повтор
+                if not self.wait_for_commit:
+                    self._requeue_preferences(pending)
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                raise
+            finally:
+                self._flushing_preferences = {}
+
+            self.preference_writes += len(pending)
+            self.preference_batches += 1
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    def _requeue_preferences(self, pending: dict):
+        """Незаписанная пачка обратно в очередь; пришедшие позже изменения главнее"""
+        for user_id, changes in pending.items():
+            merged = dict(changes)
+            merged.update(self._pending_preferences.get(user_id, {}))
+            self._pending_preferences[user_id] = merged
 
     async def update_recipe_history(self, user_id: int, recipe_id: str):
         """Add recipe to user's history."""
-        async with aiosqlite.connect(self.db_name) as db:
-            cursor = await db.execute(
-                'SELECT recipe_history FROM users WHERE user_id = ?',
-                (user_id,)
-            )
-            history_json = await cursor.fetchone()
-            
-            if history_json:
-                history = json.loads(history_json[0])
-                if recipe_id not in history:
-                    history.append(recipe_id)
-                    await db.execute(
-                        'UPDATE users SET recipe_history = ? WHERE user_id = ?',
-                        (json.dumps(history), user_id)
-                    )
-                    await db.commit()
+        await self._add_recipe_id(HISTORY_TABLE, user_id, recipe_id)
 
     async def update_favourite_recipes(self, user_id: int, recipe_id: str):
         """Add recipe to user's favourites."""
-        async with aiosqlite.connect(self.db_name) as db:
-            cursor = await db.execute(
-                'SELECT favourite_recipes FROM users WHERE user_id = ?',
-                (user_id,)
-            )
-            favourites_json = await cursor.fetchone()
-            
-            if favourites_json:
-                favourites = json.loads(favourites_json[0])
-                if recipe_id not in favourites:
-                    favourites.append(recipe_id)
-                    await db.execute(
-                        'UPDATE users SET favourite_recipes = ? WHERE user_id = ?',
-                        (json.dumps(favourites), user_id)
-                    )
-                    await db.commit()
+        await self._add_recipe_id(FAVOURITES_TABLE, user_id, recipe_id)
+
+    async def get_recipe_history(self, user_id: int, offset: int = 0, limit: int = 10) -> tuple[List[str], bool]:
+        """Page of user's history, newest first, and whether there are more."""
+        return await self._recipe_ids_page(HISTORY_TABLE, user_id, offset, limit)
+
+    async def get_favourite_recipes(self, user_id: int, offset: int = 0, limit: int = 10) -> tuple[List[str], bool]:
+        """Page of user's favourites, newest first, and whether there are more."""
+        return await self._recipe_ids_page(FAVOURITES_TABLE, user_id, offset, limit)
 
     async def get_formatted_preferences(self, user_id: int) -> str:
         """Get user preferences formatted as a readable message."""
@@ -1,70 +1,206 @@
 from .database.sql_db import DatabaseManager
-from .database.mongo_db import MongoDBManager
+from .database.mongo_db import AsyncMongoDBManager
 from .database.setting import connection
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton # type: ignore
 from bot.paste import RecipeCallback
+from .parser.stores import store_title
+from .parser.optimizer import optimize_basket
+from .parser.batch_pricing import reprice_baskets
+from .parser.units import parse_quantity, scale_quantity
+from .services.recipe_service.recipe_service import RecipeIndex
+from .utils.ttl_cache import TTLCache
 import re
+import asyncio
+
+# Бюджет, если пользователь не задал ограничение цены
+DEFAULT_MAX_PRICE = 20000000
+
+# Предпочтения читаются на каждый запрос рецепта и в каждом меню настроек,
+# а меняются только через update_* этого же Handler
+PREFERENCES_CACHE_SIZE = 4096
+PREFERENCES_CACHE_TTL = 10 * 60  # секунд
 
 
 class Handler:
     def __init__(self):
         self.user_db = DatabaseManager()
         mongo_url = connection
-        self.recipe_db = MongoDBManager(
+        self.recipe_db = AsyncMongoDBManager(
             mongo_url=mongo_url,
             db_name="recipe_bot",
             collection_name="recipes"
         )
+        self.recipe_index = RecipeIndex()
+        # ("user", user_id) -> строка пользователя, ("text", user_id) -> текст для меню предпочтений
+        self.preferences_cache = TTLCache(maxsize=PREFERENCES_CACHE_SIZE, ttl=PREFERENCES_CACHE_TTL)
+        self._preferences_writes = 0
+
+    async def build_recipe_index(self):
+        """Индекс похожих рецептов по всем сохраненным - один раз при старте"""
+        recipes = await self.recipe_db.get_recipes_for_index()
+        # Подписи считаются numpy - не в event loop
+        self.recipe_index = await asyncio.to_thread(RecipeIndex().build, recipes)
+        print(f"Recipe index: {len(self.recipe_index)} entries")
+
+    async def find_similar_recipe(self, query: str, preferences: dict):
+        """Уже сгенерированный рецепт по похожему запросу, подходящий пользователю, или None"""
+        recipe_id = self.recipe_index.find(query, preferences or {})
+        if recipe_id is None:
+            return None
+        recipe = await self.recipe_db.get_recipe(recipe_id)
+        # Рецепт без ингредиентов нечего показывать вместо генерации
+        if not recipe or not recipe.get('products'):
+            return None
+        return recipe
 
     async def get_recipe_history(self, user_id, offset: int = 0, limit: int = 3):
         """Get paginated recipe history for user directly from MongoDB"""
-        recipes, has_more = self.recipe_db.get_user_recipes(user_id, skip=offset, limit=limit)
+        recipes, has_more = await self.recipe_db.get_user_recipes(user_id, skip=offset, limit=limit)
         return recipes, has_more
 
-    async def new_recipe_handler(self, user_id, recipe_data):
+    def build_product_links(self, links: dict) -> dict:
+        """Корзина из knapsack -> product_links для документа рецепта"""
         product_links = {}
         total_cost = 0
-        
-        if 'links' in recipe_data:
-            for category, products in recipe_data['links'].items():
-                if category == "total_cost":
-                    continue
-                if category == "message":
+
+        for category, products in links.items():
+            if category == "total_cost":
+                continue
+            if category == "message":
+                continue
+                
+            if not isinstance(products, list):
+                continue
+                
+            for product in products:
+                if not isinstance(product, dict):
                     continue
                     
-                if not isinstance(products, list):
+                if 'message' in product:
+                    product_links[category] = product['message']
                     continue
                     
-                for product in products:
-                    if not isinstance(product, dict):
-                        continue
-                        
-                    if 'message' in product:
-                        product_links[category] = product['message']
-                        continue
-                        
-                    if product.get('name') and product.get('link'):
-                        product_links[product['name']] = {
-                            'link': product['link'],
-                            'price': product.get('price', 'Цена не указана')
-                        }
-                        if isinstance(product.get('price'), (int, float)):
-                            total_cost += float(product['price'])
-            
-            product_links['total_cost'] = total_cost
-            
-            if "message" in recipe_data['links']:
-                product_links['message'] = recipe_data['links']['message']
+                if product.get('name') and product.get('link'):
+                    product_links[product['name']] = {
+                        'link': product['link'],
+                        'price': product.get('price', 'Цена не указана')
+                    }
+                    if product.get('store'):
+                        product_links[product['name']]['store'] = product['store']
+                    if product.get('packs'):
+                        product_links[product['name']]['packs'] = product['packs']
+                    if isinstance(product.get('cost'), (int, float)):
+                        total_cost += float(product['cost'])
+                    elif isinstance(product.get('price'), (int, float)):
+                        total_cost += float(product['price'])
+        
+        product_links['total_cost'] = total_cost
+        
+        if "message" in links:
+            product_links['message'] = links['message']
+        return product_links
+
+    async def new_recipe_handler(self, user_id, recipe_data):
+        product_links = {}
+        if 'links' in recipe_data:
+            product_links = self.build_product_links(recipe_data['links'])
 
-        recipe_id = self.recipe_db.save_recipe(
+        recipe_id = await self.recipe_db.save_recipe(
             recipe_name=recipe_data['request'],
             recipe_text=recipe_data['text'],
             products=recipe_data['ingredients'],
             user_id=user_id,
-            product_links=product_links
+            product_links=product_links,
+            raw_offers=recipe_data.get('raw_offers'),
+            portions=int(recipe_data.get('portions', 1)),
+            query=recipe_data.get('query')
         )
+        # Повторно выданный рецепт в индексе уже есть, а ответ без ингредиентов - ошибка генерации
+        if not recipe_data.get('reused') and recipe_data['ingredients']:
+            try:
+                self.recipe_index.add({
+                    "_id": recipe_id,
+                    "name": recipe_data['request'],
+                    "query": recipe_data.get('query'),
+                    "recipe": recipe_data['text'],
+                    "products": recipe_data['ingredients'],
+                    "base_portions": int(recipe_data.get('portions', 1))
+                })
+            except Exception as e:
+                print(f"Error indexing recipe {recipe_id}: {e}")
         return recipe_id
-    
+
+    def recipe_quantities(self, recipe: dict, portions: int, base_portions: int) -> dict:
+        """Количества ингредиентов сохраненного рецепта на portions порций"""
+        return {
+            name: scale_quantity(parse_quantity(quantity), portions / base_portions)
+            for name, quantity in recipe.get('products', {}).items()
+        }
+
+    async def get_max_price(self, user_id: int) -> int:
+        preferences = await self.get_user_preferences(user_id)
+        return int(preferences['max_price']) if preferences and preferences['max_price'] else DEFAULT_MAX_PRICE
+
+    async def estimate_baskets(self, user_id: int, recipes: list) -> list:
+        """
+        Оценка корзин списка сохраненных рецептов (избранное) одной пачкой на NumPy:
+        для каждого рецепта (стоимость самой дешевой корзины, укладывается ли в бюджет)
+        или None, если предложения у рецепта не сохранены. Саму корзину собирает reoptimize_recipe
+        """
+        baskets = []
+        for recipe in recipes:
+            if recipe.get('raw_offers'):
+                portions = int(recipe.get('portions') or 1)
+                base_portions = int(recipe.get('base_portions') or portions)
+                baskets.append((recipe['raw_offers'], self.recipe_quantities(recipe, portions, base_portions)))
+        if not baskets:
+            return [None] * len(recipes)
+
+        max_price = await self.get_max_price(user_id)
+        priced = iter(await asyncio.to_thread(reprice_baskets, baskets, max_price))
+        estimates = []
+        for recipe in recipes:
+            if not recipe.get('raw_offers'):
+                estimates.append(None)
+                continue
+            basket, feasible = next(priced)
+            estimates.append((basket['total_cost'], feasible))
+        return estimates
+
+    async def reoptimize_recipe(self, user_id: int, recipe_id: str, portions_delta: int = 0):
+        """
+        Пересобирает корзину по сохраненным предложениям под текущий бюджет
+        пользователя и, если задано, другое число порций - без GPT и парсинга.
+        None - рецепт не найден или сохранен до того, как предложения стали храниться
+        """
+        recipe = await self.recipe_db.get_recipe(recipe_id)
+        if not recipe or not recipe.get('raw_offers'):
+            return None
+
+        current_portions = int(recipe.get('portions') or 1)
+        portions = max(1, current_portions + portions_delta)
+        # Количества в тексте рецепта - на исходное число порций
+        base_portions = int(recipe.get('base_portions') or current_portions)
+        quantities = self.recipe_quantities(recipe, portions, base_portions)
+
+        max_price = await self.get_max_price(user_id)
+        links = await asyncio.to_thread(optimize_basket, recipe['raw_offers'], quantities, max_price)
+        product_links = self.build_product_links(links)
+
+        portions_in_russian = "порций"
+        if 2 <= portions <= 4:
+            portions_in_russian = "порции"
+        if portions == 1:
+            portions_in_russian = "порцию"
+        name = re.sub(r'на \d+ порци[юией]+$', f'на {portions} {portions_in_russian}', recipe.get('name', ''))
+
+        recipe.update(product_links=product_links, name=name, portions=portions, base_portions=base_portions)
+        # Чужой рецепт из избранного пересчитываем, но не перезаписываем
+        if recipe.get('user_id') == user_id:
+            await self.recipe_db.update_product_links(recipe_id, product_links, name=name, portions=portions,
+                                                      base_portions=base_portions)
+        return recipe
+
     async def format_recipe_with_links(self, recipe: dict) -> str:
         base_text = f"{recipe['recipe']}"
         
@@ -83,6 +219,10 @@ class Handler:
                     base_text += f"{info}\n"
                 else:
                     base_text += f"Цена: {info.get('price', 'Цена не указана')}\n"
+                    if info.get('packs', 1) > 1:
+                        base_text += f"Количество: {info['packs']} уп.\n"
+                    if info.get('store'):
+                        base_text += f"Магазин: {store_title(info['store'])}\n"
                     base_text += f"Ссылка: {info.get('link', 'Ссылка отсутствует')}\n"
             
             if 'total_cost' in recipe['product_links']:
@@ -92,7 +232,10 @@ class Handler:
                 if int(portions) == 1:
                     portions_in_russian = "порцию"
                 
-                total_cost = float(recipe['product_links']['total_cost']) * int(portions)
+                total_cost = float(recipe['product_links']['total_cost'])
+                # В старых рецептах total_cost - цена одной упаковки каждого товара на порцию
+                if not any(isinstance(info, dict) and 'packs' in info for info in recipe['product_links'].values()):
+                    total_cost *= int(portions)
                 base_text += f"\n💰 Приблизительная итоговая стоимость на {portions} {portions_in_russian}: {total_cost:.2f} RUB"
             
             if 'message' in recipe['product_links']:
@@ -101,37 +244,58 @@ class Handler:
         return base_text
     
     async def toggle_favorite_recipe(self, user_id: int, recipe_id: str) -> bool:
-        return self.recipe_db.toggle_favorite(recipe_id, user_id)
+        return await self.recipe_db.toggle_favorite(recipe_id, user_id)
 
     async def is_recipe_favorite(self, user_id: int, recipe_id: str) -> bool:
-        return self.recipe_db.is_favorite(recipe_id, user_id)
+        return await self.recipe_db.is_favorite(recipe_id, user_id)
 
     async def get_favorite_recipes(self, user_id: int) -> list:
-        favorites = self.recipe_db.get_user_favorites(user_id)
+        favorites = await self.recipe_db.get_user_favorites(user_id)
         if not favorites:
             return []
         return favorites
 
     async def get_recipe_by_id(self, recipe_id: str):
-        return self.recipe_db.get_recipe(recipe_id)
+        return await self.recipe_db.get_recipe(recipe_id)
 
     async def add_new_user(self, user_id, user_name: str = "", language: str = "en"):
         await self.user_db.add_user(user_id, user_name, language)
+        self.invalidate_preferences(user_id)
+
+    def invalidate_preferences(self, user_id: int):
+        self._preferences_writes += 1
+        self.preferences_cache.pop(("user", user_id))
+        self.preferences_cache.pop(("text", user_id))
 
     async def get_user_preferences(self, user_id):
-        return await self.user_db.get_user(user_id)
+        user_data = self.preferences_cache.get(("user", user_id))
+        if user_data is not None:
+            return user_data
+        writes = self._preferences_writes
+        user_data = await self.user_db.get_user(user_id)
+        # Пока читали, предпочтения могли поменять - такое значение не кэшируем
+        if user_data is not None and writes == self._preferences_writes:
+            self.preferences_cache.set(("user", user_id), user_data)
+        return user_data
 
     async def update_user_allergies(self, user_id: int, allergies: list):
         await self.user_db.update_user_preferences(user_id, allergies=allergies)
+        self.invalidate_preferences(user_id)
 
     async def update_price_limit(self, user_id: int, price_limit: int):
         await self.user_db.update_user_preferences(user_id, max_price=price_limit)
+        self.invalidate_preferences(user_id)
 
     async def update_disliked_products(self, user_id: int, disliked_products: list):
         await self.user_db.update_user_preferences(user_id, unliked_products=disliked_products)
+        self.invalidate_preferences(user_id)
 
     async def get_formatted_preferences(self, user_id: int) -> str:
-        user_data = await self.user_db.get_user(user_id)
+        formatted = self.preferences_cache.get(("text", user_id))
+        if formatted is not None:
+            return formatted
+        writes = self._preferences_writes
+        user_data = await self.get_user_preferences(user_id)
         if not user_data:
             return "Предпочтения не найдены"
         
@@ -143,10 +307,14 @@ class Handler:
         
         price_text = f"\n\nОграничение цены:\n{user_data['max_price']} руб." if user_data['max_price'] else "\n\nОграничение цены:\nНе указано"
         
-        return allergies_text + unliked_text + price_text
+        formatted = allergies_text + unliked_text + price_text
+        if writes == self._preferences_writes:
+            self.preferences_cache.set(("text", user_id), formatted)
+        return formatted
     
-    def create_recipe_keyboard(self, recipe_id: str, user_id: int, show_full=True) -> InlineKeyboardMarkup:
-        is_favorite = self.recipe_db.is_favorite(recipe_id, user_id)
+    async def create_recipe_keyboard(self, recipe_id: str, user_id: int, show_full=True) -> InlineKeyboardMarkup:
+        recipe = await self.recipe_db.get_recipe(recipe_id) or {}
+        is_favorite = user_id in recipe.get('favorite_by', [])
         favorite_text = "❌ Убрать из избранного" if is_favorite else "⭐️ Добавить в избранное"
         
         buttons = []
@@ -164,6 +332,23 @@ class Handler:
                 callback_data=RecipeCallback(action="toggle_favorite", id=recipe_id).pack()
             )
         ])
+
+        if recipe.get('raw_offers'):
+            row = []
+            if int(recipe.get('portions') or 1) > 1:
+                row.append(InlineKeyboardButton(
+                    text="➖ порция",
+                    callback_data=RecipeCallback(action="remove_portion", id=recipe_id).pack()
+                ))
+            row.append(InlineKeyboardButton(
+                text="🔄 Пересчитать",
+                callback_data=RecipeCallback(action="reoptimize", id=recipe_id).pack()
+            ))
+            row.append(InlineKeyboardButton(
+                text="➕ порция",
+                callback_data=RecipeCallback(action="add_portion", id=recipe_id).pack()
+            ))
+            buttons.append(row)
         
         return InlineKeyboardMarkup(inline_keyboard=buttons)
     
@@ -0,0 +1,147 @@
+"""
+Пакетный пересчет многих корзин (история, избранное, популярные блюда) на NumPy.
+
+Это предварительный фильтр, а не замена optimize_basket: считается только самая
+дешевая полная корзина и укладывается ли она в бюджет. Какие товары взять
+(с учетом качества) и что выкинуть при нехватке бюджета, решает optimize_basket.
+
+Предложения всех корзин складываются в плоские массивы в CSR-виде:
+    prices[offer_offsets[i]:offer_offsets[i + 1]] - предложения ингредиента i,
+    ingredient_basket[i] - номер корзины, к которой относится ингредиент i
+"""
+import numpy as np
+
+from backend.parser.optimizer import NOT_FOUND_MESSAGE
+from backend.parser.units import packs_needed
+
+
+class BasketBatch:
+    """Корзины, упакованные в плоские массивы"""
+
+    def __init__(self, prices: np.ndarray, counts: np.ndarray, offer_offsets: np.ndarray,
+                 ingredient_basket: np.ndarray, n_baskets: int, names: list = None, offers: list = None):
+        self.prices = prices
+        self.counts = counts
+        self.offer_offsets = offer_offsets
+        self.ingredient_basket = ingredient_basket
+        self.n_baskets = n_baskets
+        # Исходные названия и товары нужны только чтобы собрать ответ как у knapsack
+        self.names = names
+        self.offers = offers
+
+    @classmethod
+    def from_baskets(cls, baskets: list[tuple[dict, dict]]) -> "BasketBatch":
+        """baskets - пары (products_data, quantities), как на входе knapsack"""
+        prices = []
+        counts = []
+        offer_offsets = [0]
+        ingredient_basket = []
+        names = []
+        offers = []
+
+        for b, (products_data, quantities) in enumerate(baskets):
+            for ingredient, quantity in quantities.items():
+                for product in products_data.get(ingredient, []):
+                    if isinstance(product.get('price'), (int, float)):
+                        prices.append(product['price'])
+                        counts.append(packs_needed(quantity, product.get('name', '')))
+                        offers.append(product)
+                offer_offsets.append(len(prices))
+                ingredient_basket.append(b)
+                names.append(ingredient)
+
+        return cls(
+            prices=np.asarray(prices, dtype=np.float64),
+            counts=np.asarray(counts, dtype=np.float64),
+            offer_offsets=np.asarray(offer_offsets, dtype=np.int64),
+            ingredient_basket=np.asarray(ingredient_basket, dtype=np.int64),
+            n_baskets=len(baskets),
+            names=names,
+            offers=offers
+        )
+
+
+def price_batch(batch: BasketBatch, budgets) -> dict[str, np.ndarray]:
+    """
+    Самое дешевое предложение на каждый ингредиент, стоимость корзин и
+    укладываются ли они в бюджет - без цикла по корзинам на Python
+    """
+    budgets = np.broadcast_to(np.asarray(budgets, dtype=np.float64), (batch.n_baskets,))
+    n_ingredients = len(batch.offer_offsets) - 1
+    lengths = np.diff(batch.offer_offsets)
+    found = lengths > 0
+
+    cost = batch.prices * batch.counts
+    cheapest_cost = np.zeros(n_ingredients)
+    cheapest_index = np.full(n_ingredients, -1, dtype=np.int64)
+    if cost.size:
+        # reduceat по началам непустых отрезков: пустые отрезки не содержат
+        # элементов, поэтому границы соседних непустых совпадают
+        starts = batch.offer_offsets[:-1][found]
+        cheapest_cost[found] = np.minimum.reduceat(cost, starts)
+
+        segment = np.repeat(np.arange(n_ingredients), lengths)
+        is_min = np.flatnonzero(cost == cheapest_cost[segment])
+        first_segments, first = np.unique(segment[is_min], return_index=True)
+        cheapest_index[first_segments] = is_min[first]
+
+    basket_cost = np.bincount(batch.ingredient_basket, weights=cheapest_cost, minlength=batch.n_baskets)
+    missing = np.bincount(batch.ingredient_basket, weights=~found, minlength=batch.n_baskets).astype(np.int64)
+
+    return {
+        "cheapest_index": cheapest_index,
+        "cheapest_cost": cheapest_cost,
+        "basket_cost": basket_cost,
+        "missing": missing,
+        "feasible": basket_cost <= budgets
+    }
+
+
+def price_padded(prices: np.ndarray, budgets, counts: np.ndarray = None) -> dict[str, np.ndarray]:
+    """
+    То же для выровненного массива prices[корзина, ингредиент, предложение],
+    где отсутствующие предложения - NaN
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    cost = prices if counts is None else prices * counts
+    cost = np.where(np.isnan(cost), np.inf, cost)
+
+    cheapest_index = np.argmin(cost, axis=2)
+    cheapest_cost = np.take_along_axis(cost, cheapest_index[..., None], axis=2)[..., 0]
+    found = np.isfinite(cheapest_cost)
+    cheapest_index = np.where(found, cheapest_index, -1)
+    cheapest_cost = np.where(found, cheapest_cost, 0.0)
+    basket_cost = cheapest_cost.sum(axis=1)
+
+    return {
+        "cheapest_index": cheapest_index,
+        "cheapest_cost": cheapest_cost,
+        "basket_cost": basket_cost,
+        "missing": (~found).sum(axis=1),
+        "feasible": basket_cost <= np.asarray(budgets, dtype=np.float64)
+    }
+
+
+def reprice_baskets(baskets: list[tuple[dict, dict]], budgets) -> list[tuple[dict, bool]]:
+    """
+    Пересчитывает корзины пачкой. Для каждой - пара (корзина, укладывается ли в бюджет):
+    корзина в формате knapsack (ингредиент -> [самый дешевый товар] или [{"message": ...}],
+    total_cost - стоимость самой дешевой полной корзины), но без сообщения о бюджете.
+    Для показа пользователю корзину собирает optimize_basket
+    """
+    batch = BasketBatch.from_baskets(baskets)
+    priced = price_batch(batch, budgets)
+
+    results = [{} for _ in range(batch.n_baskets)]
+    counts = batch.counts.tolist()
+    costs = priced["cheapest_cost"].tolist()
+    for i, (b, index) in enumerate(zip(batch.ingredient_basket.tolist(), priced["cheapest_index"].tolist())):
+        if index < 0:
+            results[b][batch.names[i]] = [{"message": NOT_FOUND_MESSAGE}]
+        else:
+            results[b][batch.names[i]] = [dict(batch.offers[index], packs=int(counts[index]), cost=costs[i])]
+
+    for b, result in enumerate(results):
+        result["total_cost"] = float(priced["basket_cost"][b])
+
+    return list(zip(results, priced["feasible"].tolist()))
@@ -0,0 +1,173 @@
+from selenium import webdriver
+from selenium.webdriver.common.by import By
+from selenium.webdriver.chrome.service import Service
+from webdriver_manager.chrome import ChromeDriverManager
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.chrome.options import Options
+from contextlib import contextmanager
+import queue
+import threading
+import time
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
+CITY_URL = "https://av.ru/"
+
+
+class PooledDriver:
+    """Chrome driver plus the bookkeeping the pool needs to recycle it"""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.created_at = time.monotonic()
+        self.pages = 0
+        self.broken = False
+
+    def open(self, url: str):
+        self.pages += 1
+        self.driver.get(url)
+
+
+class DriverPool:
+    """
+    Пул прогретых headless Chrome. Драйверы создаются один раз, сразу выбирают
+    город и дальше выдаются во временное пользование через lease()
+    """
+
+    def __init__(self, size: int = 2, max_pages: int = 100, max_age: float = 1800,
+                 lease_timeout: float = 60):
+        self.size = size
+        self.max_pages = max_pages
+        self.max_age = max_age
+        self.lease_timeout = lease_timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._driver_path = None
+        self._closed = False
+
+    def _options(self) -> Options:
+        options = Options()
+        options.add_argument('--headless')
+        options.add_argument(f"user-agent={USER_AGENT}")
+        return options
+
+    def _select_city(self, driver):
+        driver.get(CITY_URL)
+        try:
+            moscow_button = WebDriverWait(driver, 10).until(EC.element_to_be_clickable(
+                (By.XPATH, "//div[@class='button_content' and contains(text(), 'Москва')]")
+            ))
+            moscow_button.click()
+        except Exception as e:
+            print(f"Couldn't click Moscow button: {e}")
+
+    def _create(self) -> PooledDriver:
+        # ChromeDriverManager ходит в сеть, поэтому путь к драйверу запоминаем
+        if self._driver_path is None:
+            self._driver_path = ChromeDriverManager().install()
+        driver = webdriver.Chrome(service=Service(self._driver_path), options=self._options())
+        try:
+            self._select_city(driver)
+        except Exception:
+            driver.quit()
+            raise
+        return PooledDriver(driver)
+
+    def _destroy(self, pooled: PooledDriver):
+        try:
+            pooled.driver.quit()
+        except Exception as e:
+            print(f"Error quitting driver: {e}")
+        with self._lock:
+            self._created -= 1
+
+    def _is_healthy(self, pooled: PooledDriver) -> bool:
+        if pooled.broken:
+            return False
+        if pooled.pages >= self.max_pages:
+            return False
+        if time.monotonic() - pooled.created_at >= self.max_age:
+            return False
+        try:
+            pooled.driver.current_url
+        except Exception:
+            return False
+        return True
+
+    def _acquire(self) -> PooledDriver:
+        if self._closed:
+            raise RuntimeError("Driver pool is closed")
+        deadline = time.monotonic() + self.lease_timeout
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except queue.Empty:
+                pooled = None
+
+            if pooled is None:
+                with self._lock:
+                    can_create = self._created < self.size
+                    if can_create:
+                        self._created += 1
+                if can_create:
+                    try:
+                        return self._create()
+                    except Exception:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("No free browser in the driver pool")
+                try:
+                    pooled = self._idle.get(timeout=remaining)
+                except queue.Empty:
+                    raise TimeoutError("No free browser in the driver pool")
+
+            if self._is_healthy(pooled):
+                return pooled
+            self._destroy(pooled)
+
+    def _release(self, pooled: PooledDriver):
+        if self._closed or not self._is_healthy(pooled):
+            self._destroy(pooled)
+        else:
+            self._idle.put(pooled)
+
+    @contextmanager
+    def lease(self):
+        """Выдает драйвер на время запроса и возвращает его в пул"""
+        pooled = self._acquire()
+        try:
+            yield pooled
+        except Exception:
+            pooled.broken = True
+            raise
+        finally:
+            self._release(pooled)
+
+    def start(self):
+        """Прогревает пул до полного размера, чтобы первый запрос не ждал Chrome"""
+        self._closed = False
+        while True:
+            with self._lock:
+                if self._created >= self.size:
+                    break
+                self._created += 1
+            try:
+                pooled = self._create()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+            self._idle.put(pooled)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._destroy(pooled)
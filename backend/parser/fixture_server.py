@@ -0,0 +1,58 @@
+from aiohttp import web
+from pathlib import Path
+import asyncio
+import json
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+
+
+def load_pages(directory: Path = FIXTURES_DIR) -> dict[str, str]:
+    """Читает сохраненные страницы поиска: index.json связывает запрос с файлом"""
+    with open(directory / "index.json", encoding="utf-8") as f:
+        index = json.load(f)
+    pages = {}
+    for query, filename in index.items():
+        pages[query] = (directory / filename).read_text(encoding="utf-8")
+    return pages
+
+
+def create_app(pages: dict[str, str] = None, not_found_page: str = None, delay: float = 0,
+               status: int = 200, city_cookies: dict = None) -> web.Application:
+    """
+    Локальная копия поиска av.ru: отдает сохраненные страницы по параметру text,
+    для неизвестных запросов - страницу без товаров. status != 200 - сайт недоступен.
+    city_cookies - страницы есть только в этом городе, без cookie выдача пустая
+    """
+    if pages is None:
+        pages = load_pages()
+    if not_found_page is None:
+        not_found_page = (FIXTURES_DIR / "not_found.html").read_text(encoding="utf-8")
+
+    async def search(request: web.Request) -> web.Response:
+        if delay:
+            await asyncio.sleep(delay)
+        if status != 200:
+            return web.Response(status=status, text="Service Unavailable")
+        if city_cookies and any(request.cookies.get(name) != value for name, value in city_cookies.items()):
+            return web.Response(text=not_found_page, content_type="text/html")
+        query = request.query.get("text", "").strip().lower()
+        page = pages.get(query, not_found_page)
+        return web.Response(text=page, content_type="text/html")
+
+    app = web.Application()
+    app.router.add_get("/search/", search)
+    return app
+
+
+async def start_fixture_server(host: str = "127.0.0.1", port: int = 0, **kwargs) -> tuple[web.AppRunner, str]:
+    """Запускает сервер и возвращает runner и адрес страницы поиска"""
+    runner = web.AppRunner(create_app(**kwargs))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://{host}:{port}/search/"
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host="127.0.0.1", port=8081)
@@ -0,0 +1,98 @@
+import aiohttp
+import asyncio
+import html
+import re
+
+from backend.parser.driver_pool import USER_AGENT
+
+SEARCH_URL = "https://av.ru/search/"
+PRODUCT_URL = "https://av.ru/i/{}"
+# Город, который браузер выбирает кликом по "Москва" (DriverPool._select_city).
+# Без него сайт отдает цены и наличие для региона по умолчанию.
+# Имя и значение надо сверить с cookie, которую ставит сайт после выбора города,
+# до тех пор PARSER_ENGINE по умолчанию - selenium
+CITY_COOKIES = {"city": "moscow"}
+
+# Нас интересуют только открывающие теги карточек и их data-атрибуты,
+# поэтому вместо полноценного DOM хватает двух скомпилированных регулярок
+PRODUCT_TAG_RE = re.compile(r"""<div\b[^>]*?\bdata-digi-type\s*=\s*(["'])productsSearch\1[^>]*>""", re.IGNORECASE)
+PRODUCT_ATTR_RE = re.compile(r"""\bdata-digi-prod-(name|price|id)\s*=\s*(?:"([^"]*)"|'([^']*)')""", re.IGNORECASE)
+
+
+def parse_search_page(page: str, limit: int = 5) -> list[dict]:
+    """Достает товары из html страницы поиска av.ru"""
+    product_data = []
+
+    for tag in PRODUCT_TAG_RE.finditer(page):
+        attrs = {}
+        for attr in PRODUCT_ATTR_RE.finditer(tag.group(0)):
+            value = attr.group(2) if attr.group(2) is not None else attr.group(3)
+            attrs[attr.group(1).lower()] = html.unescape(value)
+
+        product_name = attrs.get("name")
+        product_price = attrs.get("price")
+        if not product_name or not product_price:
+            continue
+        try:
+            price = float(product_price)
+        except ValueError:
+            print(f"Error extracting product data: bad price {product_price!r}")
+            continue
+
+        product_data.append({
+            "name": product_name,
+            "price": price,
+            "link": PRODUCT_URL.format(attrs.get("id"))
+        })
+        if len(product_data) >= limit:
+            break
+
+    return product_data
+
+
+class HttpSearchEngine:
+    """
+    Поиск по av.ru без браузера: одна keep-alive сессия aiohttp на процесс,
+    город выбран cookie сессии
+    """
+
+    def __init__(self, search_url: str = SEARCH_URL, max_connections: int = 20,
+                 timeout: float = 10, cookies: dict = None):
+        self.search_url = search_url
+        self.cookies = CITY_COOKIES if cookies is None else cookies
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._session = None
+        self._loop = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        # Сессия привязана к event loop, в котором была создана
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"User-Agent": USER_AGENT},
+                cookies=self.cookies
+            )
+            self._loop = loop
+        return self._session
+
+    async def fetch(self, el: str) -> str:
+        session = await self._get_session()
+        # В названиях ингредиентов пробелы заменены на '+', как в ссылке поиска
+        async with session.get(self.search_url, params={"text": el.replace('+', ' ')}) as response:
+            response.raise_for_status()
+            return await response.text()
+
+    async def search(self, el: str) -> list[dict]:
+        print(f"Searching for: {el} at {self.search_url} (http)")
+        page = await self.fetch(el)
+        return parse_search_page(page)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._loop = None
@@ -0,0 +1,240 @@
+"""
+Подбор корзины как multiple-choice knapsack: для каждого ингредиента
+выбираем не больше одного предложения так, чтобы уложиться в бюджет,
+купить как можно больше ингредиентов и взять предложения получше
+"""
+import time
+from typing import Optional
+
+from backend.parser.units import packs_needed
+
+# Покрытие важнее качества: один купленный ингредиент ценнее
+# любого улучшения качества остальных
+COVERAGE_WEIGHT = 1000.0
+# Сколько секунд branch and bound может искать оптимум
+SOLVER_TIME_LIMIT = 0.05
+# Больше стольких вариантов сразу решаем жадно
+EXACT_MAX_OPTIONS = 5000
+
+NOT_FOUND_MESSAGE = "Товар отсутствует в данном магазине, попробуйте поискать в другом."
+OVER_BUDGET_MESSAGE = "Не помещается в бюджет."
+EPS = 1e-9
+
+
+def offer_quality(offer: dict, rank: int, cheapest: float, cost: float = None) -> float:
+    """
+    Качество предложения от 0 до 1: явное поле quality, если магазин его дал,
+    иначе среднее между местом в выдаче поиска и дешевизной.
+    cost - цена всех нужных упаковок, cheapest - самая дешевая такая цена
+    """
+    if isinstance(offer.get("quality"), (int, float)):
+        return max(0.0, min(1.0, float(offer["quality"])))
+    relevance = 1.0 / (1 + rank)
+    cost = offer["price"] if cost is None else cost
+    cheapness = cheapest / cost if cost > 0 else 1.0
+    return 0.5 * relevance + 0.5 * cheapness
+
+
+def _pareto(options: list[tuple[float, float, int]]) -> list[tuple[float, float, int]]:
+    """Оставляет варианты, для которых нет более дешевого и не худшего"""
+    front = []
+    for cost, value, index in sorted(options, key=lambda o: (o[0], -o[1])):
+        if not front or value > front[-1][1] + EPS:
+            front.append((cost, value, index))
+    return front
+
+
+def _hull_points(front: list[tuple[float, float, int]]) -> list[tuple[float, float, int]]:
+    """Верхняя выпуклая оболочка парето-фронта, начиная от пропуска группы (0, 0)"""
+    hull = []
+    for cost, value, index in front:
+        while hull:
+            c2, v2, _ = hull[-1]
+            c1, v1 = (hull[-2][0], hull[-2][1]) if len(hull) >= 2 else (0.0, 0.0)
+            # Средняя точка лежит не выше отрезка - выкидываем
+            if (v2 - v1) * (cost - c1) <= (value - v1) * (c2 - c1) + EPS:
+                hull.pop()
+            else:
+                break
+        hull.append((cost, value, index))
+    return hull
+
+
+def _hull_segments(front: list[tuple[float, float, int]]) -> list[tuple[float, float, int]]:
+    """Приращения (cost, value) между соседними точками оболочки"""
+    segments = []
+    prev_cost, prev_value = 0.0, 0.0
+    for cost, value, index in _hull_points(front):
+        segments.append((cost - prev_cost, value - prev_value, index))
+        prev_cost, prev_value = cost, value
+    return segments
+
+
+def _efficiency(dc: float, dv: float) -> float:
+    return dv / dc if dc > EPS else float("inf")
+
+
+def greedy_mckp(groups: list[list[tuple[float, float]]], budget: float) -> tuple[list[Optional[int]], float]:
+    """
+    Жадное решение: поднимаемся по выпуклым оболочкам групп в порядке
+    убывания ценности на рубль, пока позволяет бюджет
+    """
+    fronts = [_pareto([(c, v, i) for i, (c, v) in enumerate(group)]) for group in groups]
+    steps = []
+    for g, front in enumerate(fronts):
+        for step, (dc, dv, index) in enumerate(_hull_segments(front)):
+            steps.append((_efficiency(dc, dv), g, step, dc, index))
+    steps.sort(key=lambda s: -s[0])
+
+    chosen: list[Optional[int]] = [None] * len(groups)
+    level = [0] * len(groups)
+    spent = 0.0
+    for _, g, step, dc, index in steps:
+        # Шаг по оболочке возможен только после предыдущего шага той же группы
+        if step != level[g] or spent + dc > budget + EPS:
+            continue
+        chosen[g] = index
+        level[g] += 1
+        spent += dc
+
+    return chosen, _value(groups, chosen)
+
+
+def _value(groups, chosen) -> float:
+    return sum(groups[g][i][1] for g, i in enumerate(chosen) if i is not None)
+
+
+def solve_mckp(groups: list[list[tuple[float, float]]], budget: float,
+               time_limit: float = SOLVER_TIME_LIMIT) -> tuple[list[Optional[int]], float, bool]:
+    """
+    Branch and bound для multiple-choice knapsack.
+    groups - по группе на ингредиент, в группе варианты (cost, value).
+    Возвращает индекс выбранного варианта в каждой группе (None - пропуск),
+    суммарную ценность и флаг, доказан ли оптимум за time_limit
+    """
+    best_chosen, best_value = greedy_mckp(groups, budget)
+
+    fronts = [_pareto([(c, v, i) for i, (c, v) in enumerate(group) if c <= budget + EPS]) for group in groups]
+    if sum(len(front) for front in fronts) > EXACT_MAX_OPTIONS:
+        return best_chosen, best_value, False
+
+    # Для верхней оценки: приращения оболочек всех групп, по убыванию ценности на рубль
+    segments = []
+    for g, front in enumerate(fronts):
+        for dc, dv, _ in _hull_segments(front):
+            segments.append((_efficiency(dc, dv), g, dc, dv))
+    segments.sort(key=lambda s: -s[0])
+
+    n = len(groups)
+    deadline = time.perf_counter() + time_limit
+    chosen: list[Optional[int]] = [None] * n
+    nodes = 0
+    timed_out = False
+
+    def bound(depth: int, remaining: float) -> float:
+        # LP-релаксация по оставшимся группам
+        total = 0.0
+        for _, g, dc, dv in segments:
+            if g < depth:
+                continue
+            if dc <= remaining + EPS:
+                total += dv
+                remaining -= dc
+            else:
+                total += dv * remaining / dc
+                break
+        return total
+
+    def branch(depth: int, remaining: float, value: float):
+        nonlocal best_value, best_chosen, nodes, timed_out
+        if timed_out:
+            return
+        nodes += 1
+        if nodes % 256 == 0 and time.perf_counter() > deadline:
+            timed_out = True
+            return
+        if depth == n:
+            if value > best_value + EPS:
+                best_value = value
+                best_chosen = list(chosen)
+            return
+        if value + bound(depth, remaining) <= best_value + EPS:
+            return
+        # Сначала самые ценные варианты, пропуск группы - последним
+        for cost, option_value, index in sorted(fronts[depth], key=lambda o: -o[1]):
+            if cost <= remaining + EPS:
+                chosen[depth] = index
+                branch(depth + 1, remaining - cost, value + option_value)
+        chosen[depth] = None
+        branch(depth + 1, remaining, value)
+
+    branch(0, budget, 0.0)
+    return best_chosen, best_value, not timed_out
+
+
+def optimize_basket(products_data: dict[str, list[dict]], quantities: dict, budget: float,
+                    time_limit: float = SOLVER_TIME_LIMIT) -> dict:
+    """
+    Собирает корзину в формате knapsack: ингредиент -> [выбранный товар]
+    или [{"message": ...}], плюс total_cost и message, если бюджета не хватило.
+    quantities - количества из standardize_ingredients (или сразу число упаковок),
+    у выбранного товара проставляются packs и cost = price * packs
+    """
+    selected_products = {}
+    names = []
+    groups = []
+    offers = []
+    pack_counts = []
+    cheapest_cost = 0.0  # Стоимость самой дешевой полной корзины
+
+    for ingredient in quantities.keys():  # Перебираем только названия ингредиентов
+        valid_products = [
+            product for product in products_data.get(ingredient, [])
+            if isinstance(product.get('price'), (int, float))
+        ]
+        if not valid_products:
+            selected_products[ingredient] = [{"message": NOT_FOUND_MESSAGE}]
+            continue
+
+        packs = [packs_needed(quantities[ingredient], product.get('name', '')) for product in valid_products]
+        costs = [product['price'] * count for product, count in zip(valid_products, packs)]
+        cheapest = min(costs)
+        ranks = {}
+        group = []
+        for product, cost in zip(valid_products, costs):
+            store = product.get('store', '')
+            rank = ranks.get(store, 0)
+            ranks[store] = rank + 1
+            quality = offer_quality(product, rank, cheapest, cost)
+            group.append((cost, COVERAGE_WEIGHT + quality))
+
+        cheapest_cost += cheapest
+        names.append(ingredient)
+        groups.append(group)
+        offers.append(valid_products)
+        pack_counts.append(packs)
+
+    chosen, _, _ = solve_mckp(groups, budget, time_limit)
+
+    total_cost = 0.0
+    dropped = False
+    for ingredient, group, group_offers, group_packs, index in zip(names, groups, offers, pack_counts, chosen):
+        if index is None:
+            selected_products[ingredient] = [{"message": OVER_BUDGET_MESSAGE}]
+            dropped = True
+            continue
+        cost = group[index][0]
+        # Копия: сами предложения лежат в кэше цен и общие для всех пользователей
+        selected_products[ingredient] = [dict(group_offers[index], packs=group_packs[index], cost=cost)]
+        total_cost += cost
+
+    # Если мало денег
+    if dropped:
+        selected_products["message"] = (
+            f"Бюджета недостаточно для покупки всех ингредиентов. "
+            f"Итоговая стоимость всех продуктов: {cheapest_cost:.2f} RUB. "
+            f"Попробуйте увеличить бюджет."
+        )
+
+    selected_products["total_cost"] = total_cost
+    return selected_products
@@ -1,15 +1,45 @@
 from selenium import webdriver
 from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.chrome.options import Options
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
-import re
 
-executor = ThreadPoolExecutor(max_workers=1)
+from backend.parser.driver_pool import DriverPool, PooledDriver
+from backend.parser.http_engine import HttpSearchEngine
+from backend.parser.price_cache import PriceCache, cache_key
+from backend.parser.single_flight import SingleFlight
+from backend.parser.optimizer import optimize_basket, NOT_FOUND_MESSAGE
+from backend.parser.stores import StoreAdapter, StoreDeadlineExceeded, register_store, get_enabled_stores, close_stores
+from backend.parser.units import parse_quantity
+
+# "http" - поиск без браузера, "selenium" - через Chrome.
+# Для "http" город задается cookie (http_engine.CITY_COOKIES), пока она не сверена
+# с живым сайтом, по умолчанию ищем через браузер, который выбирает Москву сам.
+# Selenium остается запасным вариантом, если http не ответил (ошибка или не 200).
+# Пустой ответ - товара действительно нет, браузер его тоже не найдет.
+# Браузеры при старте прогреваются только для "selenium", запасным они создаются по первому запросу
+PARSER_ENGINE = "selenium"
+
+# Сколько ингредиентов ищем одновременно (по браузеру на каждый)
+PARSER_CONCURRENCY = 4
+
+# Настройки пула браузеров
+DRIVER_POOL_SIZE = PARSER_CONCURRENCY
+DRIVER_MAX_PAGES = 100  # после стольких страниц браузер пересоздается
+DRIVER_MAX_AGE = 30 * 60  # секунд
+
+# Кэш цен: в памяти и в sqlite-файле
+PRICE_CACHE_PATH = "price_cache.db"
+PRICE_CACHE_SIZE = 2048
+PRICE_CACHE_TTL = 6 * 60 * 60  # секунд
+
+executor = ThreadPoolExecutor(max_workers=PARSER_CONCURRENCY)
+driver_pool = DriverPool(size=DRIVER_POOL_SIZE, max_pages=DRIVER_MAX_PAGES, max_age=DRIVER_MAX_AGE)
+http_engine = HttpSearchEngine()
+price_cache = PriceCache(path=PRICE_CACHE_PATH, maxsize=PRICE_CACHE_SIZE, ttl=PRICE_CACHE_TTL)
+# Одинаковые ингредиенты от разных пользователей ищутся один раз
+inflight_searches = SingleFlight()
 
 async def get_input_text(ingredients: dict) -> list[str]:
     products = []
@@ -17,149 +47,212 @@ async def get_input_text(ingredients: dict) -> list[str]:
         products.append(key)
     return products
 
-async def convert_quantity_to_integer(quantity_str: str) -> int:
-    quantity_str = quantity_str.strip().lower()
-    
-    numeric_match = re.search(r'([\d.,]+)', quantity_str)
-    if not numeric_match:
-        return 1
-        
-    numeric_str = numeric_match.group(1).replace(',', '.')
-    try:
-        numeric_value = float(numeric_str)
-    except ValueError:
-        return 1
-    if 'кг' in quantity_str:
-        return 1
-    elif 'мл' in quantity_str:
-        return 1
-    elif 'л' in quantity_str:
-        return 1
-    elif 'ст' in quantity_str:
-        return 1
-    elif 'шт' in quantity_str:
-            return 1
-    else:
-        return 1
-    
 async def standardize_ingredients(ingredients_dict: dict) -> dict:
-    standardized = {}
-    for name, quantity in ingredients_dict.items():
-        int_quantity = await convert_quantity_to_integer(quantity)
-        standardized[name] = int_quantity
-    return standardized
-
-def parse_products_sync(ingredients: dict) -> dict[str, list[dict]]:
-    options = Options()
-    options.add_argument('--headless')
-    options.add_argument(
-        "user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
-    )
+    """
+    Количества из рецепта в базовых единицах: {'рис': '0,5 кг'} -> {'рис': Quantity(500, 'г')}.
+    None - количество не указано ('по вкусу'), покупаем одну упаковку
+    """
+    return {name: parse_quantity(quantity) for name, quantity in ingredients_dict.items()}
+
+def search_product_sync(pooled: PooledDriver, el: str) -> list[dict]:
+    """Ищет один продукт на уже прогретом драйвере"""
+    base_url = f"https://av.ru/search/?text={el}"
+    print(f"Searching for: {el} at {base_url}")
+
+    pooled.open(base_url)
+    driver = pooled.driver
+
+    wait = WebDriverWait(driver, 10)
+
+    try:
+        wait.until(EC.presence_of_element_located((By.XPATH, "//div[@data-digi-type='productsSearch']")))
+        products = driver.find_elements(By.XPATH, "//div[@data-digi-type='productsSearch']")
+    except Exception as e:
+        print(f"Error waiting for products: {e}")
+        products = []
+
+    product_data = []
+
+    for product in products[:5]:
+        try:
+            product_name = product.get_attribute("data-digi-prod-name")
+            product_price = product.get_attribute("data-digi-prod-price")
+            product_id = product.get_attribute("data-digi-prod-id")
+
+            product_link = f"https://av.ru/i/{product_id}"
+
+            if product_name and product_price:
+                product_data.append({
+                    "name": product_name,
+                    "price": float(product_price),
+                    "link": product_link
+                })
+        except Exception as e:
+            print(f"Error extracting product data: {e}")
+
+    return product_data
+
+def parse_products_sync(ingredients: list[str]) -> dict[str, list[dict]]:
     results = {}
 
-    driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
-    flag = True
-    for el in ingredients:
-        base_url = f"https://av.ru/search/?text={el}"
-        print(f"Searching for: {el} at {base_url}")
+    with driver_pool.lease() as pooled:
+        for el in ingredients:
+            product_data = search_product_sync(pooled, el)
 
-        driver.get(base_url)
+            if product_data:
+                results[el] = product_data
+            else:
+                results[el] = [{"message": NOT_FOUND_MESSAGE}]
 
-        wait = WebDriverWait(driver, 10)
+    return results
 
-        if flag:
-            try:
-                moscow_button = wait.until(EC.element_to_be_clickable(
-                    (By.XPATH, "//div[@class='button_content' and contains(text(), 'Москва')]")
-                ))
-                moscow_button.click()
-                flag = False
-            except Exception as e:
-                print(f"Couldn't click Moscow button: {e}")
+def parse_product_sync(el: str) -> list[dict]:
+    """Ищет один ингредиент на свободном браузере из пула"""
+    with driver_pool.lease() as pooled:
+        return search_product_sync(pooled, el)
+
+def start_driver_pool():
+    """Прогревает браузеры при старте бота (блокирующий вызов)"""
+    driver_pool.start()
 
+def close_driver_pool():
+    driver_pool.close()
+
+async def search_product(el: str, engine: str = None) -> list[dict]:
+    """Ищет один ингредиент выбранным движком, если http не ответил - через браузер"""
+    engine = engine or PARSER_ENGINE
+    if engine == "http":
         try:
-            wait.until(EC.presence_of_element_located((By.XPATH, "//div[@data-digi-type='productsSearch']")))
-            products = driver.find_elements(By.XPATH, "//div[@data-digi-type='productsSearch']")
+            return await http_engine.search(el)
         except Exception as e:
-            print(f"Error waiting for products: {e}")
-            products = []
+            print(f"HTTP search failed for {el}, falling back to selenium: {e}")
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, parse_product_sync, el)
 
-        product_data = []
+class AvStoreAdapter(StoreAdapter):
+    """Азбука Вкуса: http-движок или пул браузеров"""
 
-        for product in products[:5]:
-            try:
-                product_name = product.get_attribute("data-digi-prod-name")
-                product_price = product.get_attribute("data-digi-prod-price")
-                product_id = product.get_attribute("data-digi-prod-id")
+    name = "av"
+    title = "Азбука Вкуса"
+
+    async def search(self, el: str) -> list[dict]:
+        return await search_product(el)
 
-                product_link = f"https://av.ru/i/{product_id}"
+    async def close(self):
+        await http_engine.close()
 
-                if product_name and product_price:
-                    product_data.append({
-                        "name": product_name,
-                        "price": float(product_price),
-                        "link": product_link
-                    })
-            except Exception as e:
-                print(f"Error extracting product data: {e}")
+register_store(AvStoreAdapter())
 
+async def close_parser():
+    await close_stores()
+    await asyncio.to_thread(close_driver_pool)
+    await asyncio.to_thread(price_cache.close)
+
+async def search_store(store: StoreAdapter, el: str, semaphore: asyncio.Semaphore,
+                       raise_errors: bool = False) -> tuple[list[dict], bool]:
+    """Ищет ингредиент в одном магазине: кэш, затем общий с другими запросами поиск"""
+    cached = await price_cache.aget(el, store=store.name)
+    if cached is not None:
+        return cached, True
+
+    async def scrape() -> list[dict]:
+        # Пока ждали, такой же поиск мог закончиться и попасть в кэш
+        cached = price_cache.memory.get(cache_key(el, store.name))
+        if cached is not None:
+            return cached
+        async with semaphore:
+            # Не wait_for: TimeoutError изнутри поиска (пул браузеров занят) не должен выглядеть как дедлайн
+            search = asyncio.ensure_future(store.search(el))
+            try:
+                done, _ = await asyncio.wait({search}, timeout=store.deadline)
+            finally:
+                search.cancel()
+            if not done:
+                raise StoreDeadlineExceeded(f"{store.name} did not answer in {store.deadline} s")
+            product_data = search.result()
+        product_data = [dict(product, store=store.name) for product in product_data]
+        # Пустой результат не кэшируем, вдруг товар появится
         if product_data:
-            results[el] = product_data
-        else:
-            results[el] = [{"message": "Товар отсутствует в данном магазине, попробуйте поискать в другом."}]
+            await price_cache.aset(el, product_data, store=store.name)
+        return product_data
 
-    driver.quit()
-    return results
+    try:
+        return await inflight_searches.do(cache_key(el, store.name), scrape), False
+    except StoreDeadlineExceeded:
+        print(f"Store {store.name} did not answer for {el} in {store.deadline} s")
+    except Exception as e:
+        # Одна упавшая лавка не должна ломать корзину из остальных
+        if raise_errors:
+            raise
+        print(f"Error searching {el} in store {store.name}: {e}")
+    return [], False
 
-async def data_parser(ingredients: dict) -> dict[str, list[dict]]:
-    """Asynchronous wrapper for the parsing function"""
-    input_ingredients = await get_input_text(ingredients)
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(executor, parse_products_sync, input_ingredients)
+class IngredientSearch:
+    """
+    Поиск ингредиентов во всех магазинах с общим лимитом параллельности.
+    prefetch запускает поиск заранее (например, пока рецепт еще генерируется),
+    results дожидается нужных ингредиентов и отменяет лишние
+    """
 
-# Наш рюкзак
-async def knapsack(products_data: dict[str, list[dict]], quantities: dict, budget: float) -> dict:
-    selected_products = {}
-    total_cost = 0
-    final_cost = 0  # Итоговая стоимость
-    insufficient_budget = False
-
-    for ingredient in quantities.keys():  # Перебираем только названия ингредиентов
-        if ingredient in products_data:
-            valid_products = [
-                product for product in products_data[ingredient] if 'price' in product
-            ]
-
-            if valid_products:
-                best_product = min(valid_products, key=lambda x: x['price'])
-                selected_products[ingredient] = [best_product]
-                final_cost += best_product['price']
-
-                if total_cost + best_product['price'] <= budget:
-                    total_cost += best_product['price']
-                else:
-                    insufficient_budget = True
-            else:
-                selected_products[ingredient] = [
-                    {"message": "Товар отсутствует в данном магазине, попробуйте поискать в другом."}
-                ]
-        else:
-            selected_products[ingredient] = [
-                {"message": "Товар отсутствует в данном магазине, попробуйте поискать в другом."}
-            ]
+    def __init__(self, max_concurrency: int = PARSER_CONCURRENCY, stores: list[StoreAdapter] = None):
+        self.stores = stores if stores is not None else get_enabled_stores()
+        # Лимит параллельных поисков - отдельно для каждого магазина
+        self.semaphores = {store.name: asyncio.Semaphore(max_concurrency) for store in self.stores}
+        self.tasks: dict[str, asyncio.Task] = {}
+
+    async def _search(self, el: str) -> list[tuple[list[dict], bool]]:
+        return await asyncio.gather(*(
+            search_store(store, el, self.semaphores[store.name], raise_errors=len(self.stores) == 1)
+            for store in self.stores
+        ))
 
-    # Если мало денег
-    if insufficient_budget:
-        selected_products["message"] = (
-            f"Бюджета недостаточно для покупки всех ингредиентов. "
-            f"Итоговая стоимость всех продуктов: {final_cost:.2f} RUB. "
-            f"Попробуйте увеличить бюджет."
-        )
+    def prefetch(self, el: str) -> asyncio.Task:
+        if el not in self.tasks:
+            self.tasks[el] = asyncio.ensure_future(self._search(el))
+        return self.tasks[el]
 
-    selected_products["total_cost"] = final_cost
+    def cancel(self, keep=()):
+        for el, task in self.tasks.items():
+            if el not in keep and not task.done():
+                task.cancel()
 
+    async def results(self, ingredients: dict) -> dict[str, list[dict]]:
+        input_ingredients = await get_input_text(ingredients)
+        speculative = sum(1 for el in input_ingredients if el in self.tasks)
+        try:
+            found = await asyncio.gather(*(self.prefetch(el) for el in input_ingredients))
+        finally:
+            # Догадки, которых нет в итоговом списке, больше не нужны
+            self.cancel(keep=input_ingredients)
+
+        hits = sum(cached for store_results in found for _, cached in store_results)
+        lookups = len(input_ingredients) * len(self.stores)
+        print(f"Price cache: {hits} hits, {lookups - hits} misses, "
+              f"{speculative} started early, total {price_cache.stats()}")
 
-    return selected_products
+        results = {}
+        for el, store_results in zip(input_ingredients, found):
+            product_data = [product for store_data, _ in store_results for product in store_data]
+            if product_data:
+                results[el] = product_data
+            else:
+                results[el] = [{"message": NOT_FOUND_MESSAGE}]
+        return results
+
+
+async def data_parser(ingredients: dict, max_concurrency: int = PARSER_CONCURRENCY,
+                      stores: list[StoreAdapter] = None) -> dict[str, list[dict]]:
+    """
+    Asynchronous wrapper for the parsing function: searches every ingredient
+    in every enabled store in parallel and merges offers tagged with the store
+    """
+    return await IngredientSearch(max_concurrency, stores).results(ingredients)
+
+# Наш рюкзак
+async def knapsack(products_data: dict[str, list[dict]], quantities: dict, budget: float) -> dict:
+    """Выбирает по одному товару на ингредиент в пределах бюджета (см. optimizer.py)"""
+    # Перебор может занять весь SOLVER_TIME_LIMIT - не в event loop, чтобы не задерживать других пользователей
+    return await asyncio.to_thread(optimize_basket, products_data, quantities, budget)
 
 
 # # Тестил на яблочном штруделе
@@ -170,6 +263,7 @@ async def main():
     ingredients_example = await standardize_ingredients(ingredients)
     raw_data = await data_parser(ingredients_example)
     chosen_products = await knapsack(raw_data, ingredients_example, budget)
+    await close_parser()
     print(chosen_products)
 
     print("Продукты:")
@@ -1,6 +1,6 @@
 import unittest
 from unittest.mock import patch, MagicMock
-from parser import data_parser, get_input_text, knapsack
+from parser import data_parser, get_input_text, knapsack, standardize_ingredients
 from selenium.common.exceptions import TimeoutException, NoSuchElementException, WebDriverException
 import coverage
 from selenium import webdriver
@@ -8,10 +8,43 @@ from selenium.webdriver.chrome.service import Service
 from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver.common.by import By
 import asyncio
+import os
+import tempfile
+import threading
+import time
+import parser
+from backend.parser.driver_pool import DriverPool
+from backend.parser.http_engine import HttpSearchEngine, parse_search_page, CITY_COOKIES
+from backend.parser.fixture_server import start_fixture_server
+from backend.parser.price_cache import PriceCache, normalize_query
+from backend.parser.single_flight import SingleFlight
+from backend.parser.stores import StoreAdapter, register_store, get_enabled_stores
+from backend.parser.optimizer import solve_mckp, greedy_mckp, optimize_basket
+from backend.parser.units import Quantity, parse_quantity, parse_pack_size, packs_needed
+from backend.parser.batch_pricing import BasketBatch, price_batch, price_padded, reprice_baskets
+import itertools
+import random
+
+# Каждому тесту свой пул браузеров и пустой кэш, чтобы моки не переживали тест
+def isolate_parser(test: unittest.TestCase, engine: str = "selenium"):
+    patchers = [
+        patch('parser.driver_pool', DriverPool(size=1)),
+        patch('parser.PARSER_ENGINE', engine),
+        patch('parser.price_cache', PriceCache(path=":memory:")),
+        patch('parser.inflight_searches', SingleFlight()),
+        patch('backend.parser.driver_pool.ChromeDriverManager'),
+        patch('backend.parser.driver_pool.WebDriverWait'),
+    ]
+    for patcher in patchers:
+        patcher.start()
+        test.addCleanup(patcher.stop)
 
 # Юнит тесты
 class TestDataParser(unittest.TestCase):
 
+    def setUp(self):
+        isolate_parser(self)
+
     # Проверяем что происходит поск по нужной нам ссылке
     @patch('parser.webdriver.Chrome')
     @patch('parser.WebDriverWait')
@@ -171,6 +204,742 @@ class TestDataParser(unittest.TestCase):
                 # Проверяем, что ошибка была обработана и выведено соответствующее сообщение
                 self.assertEqual(str(e), "Ошибка загрузки страницы")
 
+class TestConcurrentDataParser(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        isolate_parser(self)
+
+    def fake_search(self, el):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+        if el == "нет":
+            return []
+        return [{"name": el, "price": 10.0, "link": f"https://av.ru/i/{el}"}]
+
+    # Ингредиенты ищутся параллельно, но не больше лимита
+    def test_fan_out_respects_cap(self):
+        ingredients = {f"продукт{i}": 1 for i in range(6)}
+
+        with patch('parser.parse_product_sync', side_effect=self.fake_search):
+            result = asyncio.run(data_parser(ingredients, max_concurrency=2))
+
+        self.assertEqual(self.max_active, 2)
+        self.assertEqual(list(result.keys()), list(ingredients.keys()))
+
+    # Результат собирается в прежний формат
+    def test_results_merged(self):
+        ingredients = {"молоко": 1, "нет": 1}
+
+        with patch('parser.parse_product_sync', side_effect=self.fake_search):
+            result = asyncio.run(data_parser(ingredients))
+
+        self.assertEqual(result["молоко"][0]["name"], "молоко")
+        self.assertEqual(result["нет"], [{"message": "Товар отсутствует в данном магазине, попробуйте поискать в другом."}])
+
+class TestHttpEngine(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        isolate_parser(self, engine="http")
+        self.runner, search_url = await start_fixture_server()
+        self.engine = HttpSearchEngine(search_url=search_url)
+
+    async def asyncTearDown(self):
+        await self.engine.close()
+        await self.runner.cleanup()
+
+    # Атрибуты карточек читаются так же, как через selenium
+    async def test_search_fixture_page(self):
+        result = await self.engine.search("молоко")
+
+        self.assertEqual(len(result), 5)
+        self.assertEqual(result[0], {
+            "name": "Молоко Азбука Вкуса пастеризованное 3,2% 930 мл",
+            "price": 129.9,
+            "link": "https://av.ru/i/5310"
+        })
+        self.assertEqual(result[2]["name"], "Молоко «Домик в деревне» 3,2% 1,4 л")
+
+    # Город выбирается cookie сессии, как кликом по "Москва" в браузере
+    async def test_search_sends_city_cookie(self):
+        runner, search_url = await start_fixture_server(city_cookies=CITY_COOKIES)
+        with_city = HttpSearchEngine(search_url=search_url)
+        without_city = HttpSearchEngine(search_url=search_url, cookies={})
+        try:
+            self.assertEqual(len(await with_city.search("молоко")), 5)
+            self.assertEqual(await without_city.search("молоко"), [])
+        finally:
+            await with_city.close()
+            await without_city.close()
+            await runner.cleanup()
+
+    # '+' в названии ингредиента означает пробел, как в ссылке поиска
+    async def test_search_plus_in_query(self):
+        page = '<div data-digi-type="productsSearch" data-digi-prod-name="Рис Nishiki" data-digi-prod-price="299" data-digi-prod-id="42"></div>'
+        runner, search_url = await start_fixture_server(pages={"рис для суши": page})
+        engine = HttpSearchEngine(search_url=search_url)
+        try:
+            result = await engine.search("рис+для+суши")
+        finally:
+            await engine.close()
+            await runner.cleanup()
+
+        self.assertEqual(result, [{"name": "Рис Nishiki", "price": 299.0, "link": "https://av.ru/i/42"}])
+
+    async def test_search_not_found(self):
+        self.assertEqual(await self.engine.search("asdkjlqwex"), [])
+
+    async def test_session_is_reused(self):
+        await self.engine.search("молоко")
+        session = self.engine._session
+        await self.engine.search("сахар")
+        self.assertIs(self.engine._session, session)
+
+    # Пустой ответ http - товара нет, браузер не запускаем
+    async def test_data_parser_does_not_fall_back_on_empty_result(self):
+        with patch('parser.http_engine', self.engine), \
+                patch('parser.parse_product_sync') as mock_selenium:
+            result = await data_parser({"молоко": 1, "asdkjlqwex": 1})
+
+        mock_selenium.assert_not_called()
+        self.assertEqual(result["молоко"][0]["link"], "https://av.ru/i/5310")
+        self.assertEqual(result["asdkjlqwex"], [{"message": "Товар отсутствует в данном магазине, попробуйте поискать в другом."}])
+
+    # Если сайт ответил ошибкой, ищем через браузер
+    async def test_data_parser_falls_back_to_selenium_on_error(self):
+        fallback = [{"name": "Продукт1", "price": 50.0, "link": "https://av.ru/i/1"}]
+        runner, search_url = await start_fixture_server(status=503)
+        engine = HttpSearchEngine(search_url=search_url)
+        try:
+            with patch('parser.http_engine', engine), \
+                    patch('parser.parse_product_sync', return_value=fallback) as mock_selenium:
+                result = await data_parser({"молоко": 1})
+        finally:
+            await engine.close()
+            await runner.cleanup()
+
+        mock_selenium.assert_called_once_with("молоко")
+        self.assertEqual(result["молоко"], [dict(fallback[0], store="av")])
+
+    def test_parse_search_page_skips_bad_cards(self):
+        page = (
+            '<div data-digi-type="productsSearch" data-digi-prod-name="Хлеб" data-digi-prod-price="oops" data-digi-prod-id="1"></div>'
+            "<div class='card' data-digi-type='productsSearch' data-digi-prod-price='45' data-digi-prod-id='2' data-digi-prod-name='Батон'></div>"
+            '<div data-digi-type="productsSearch" data-digi-prod-price="45" data-digi-prod-id="3"></div>'
+        )
+        self.assertEqual(parse_search_page(page), [{"name": "Батон", "price": 45.0, "link": "https://av.ru/i/2"}])
+
+class TestPriceCache(unittest.TestCase):
+
+    def setUp(self):
+        isolate_parser(self)
+        self.products = [{"name": "Сахар-песок Русский 1 кг", "price": 89.9, "link": "https://av.ru/i/4410"}]
+
+    def test_normalize_query(self):
+        self.assertEqual(normalize_query(" Рис+для  суши "), "рис для суши")
+        self.assertEqual(normalize_query("Ёжевика"), "ежевика")
+
+    def test_memory_hit(self):
+        cache = PriceCache(path=":memory:")
+        cache.set("сахар", self.products)
+
+        self.assertEqual(cache.get("Сахар"), self.products)
+        self.assertEqual(cache.stats(), {"memory_hits": 1, "disk_hits": 0, "misses": 0})
+
+    def test_expired_entry_is_miss(self):
+        cache = PriceCache(path=":memory:")
+        cache.set("сахар", self.products, ttl=-1)
+
+        self.assertIsNone(cache.get("сахар"))
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_memory_tier_is_bounded(self):
+        cache = PriceCache(path=":memory:", maxsize=2)
+        for el in ["соль", "сахар", "яйца"]:
+            cache.set(el, self.products)
+
+        self.assertEqual(len(cache.memory), 2)
+        # Вытесненная из памяти запись достается с диска
+        self.assertEqual(cache.get("соль"), self.products)
+        self.assertEqual(cache.stats()["disk_hits"], 1)
+
+    # Кэш на диске переживает перезапуск
+    def test_disk_tier_survives_restart(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "price_cache.db")
+            cache = PriceCache(path=path)
+            cache.set("сахар", self.products)
+            cache.close()
+
+            restarted = PriceCache(path=path)
+            self.assertEqual(restarted.get("сахар"), self.products)
+            self.assertEqual(restarted.stats(), {"memory_hits": 0, "disk_hits": 1, "misses": 0})
+            restarted.close()
+
+    # aget/aset не трогают SQLite в потоке event loop
+    def test_async_disk_tier_runs_off_event_loop(self):
+        cache = PriceCache(path=":memory:", maxsize=1)
+        threads = []
+        get_disk, set_disk = cache._get_disk, cache._set_disk
+        cache._get_disk = lambda *args: threads.append(threading.get_ident()) or get_disk(*args)
+        cache._set_disk = lambda *args: threads.append(threading.get_ident()) or set_disk(*args)
+
+        async def run():
+            await cache.aset("соль", self.products)
+            await cache.aset("сахар", self.products)
+            return await cache.aget("сахар"), await cache.aget("соль")
+
+        self.assertEqual(asyncio.run(run()), (self.products, self.products))
+        self.assertEqual(cache.stats(), {"memory_hits": 1, "disk_hits": 1, "misses": 0})
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(threading.get_ident(), threads)
+        cache.close()
+
+    # data_parser ищет только то, чего нет в кэше
+    def test_data_parser_searches_only_misses(self):
+        fresh = [{"name": "Соль Экстра 1 кг", "price": 29.0, "link": "https://av.ru/i/1"}]
+        parser.price_cache.set("сахар", self.products, store="av")
+
+        with patch('parser.parse_product_sync', return_value=fresh) as mock_search:
+            result = asyncio.run(data_parser({"сахар": 1, "соль": 1}))
+
+        mock_search.assert_called_once_with("соль")
+        fresh = [dict(fresh[0], store="av")]
+        self.assertEqual(result, {"сахар": self.products, "соль": fresh})
+        self.assertEqual(parser.price_cache.get("соль", store="av"), fresh)
+
+    def test_not_found_is_not_cached(self):
+        with patch('parser.parse_product_sync', return_value=[]):
+            asyncio.run(data_parser({"asdkjlqwex": 1}))
+
+        self.assertIsNone(parser.price_cache.get("asdkjlqwex", store="av"))
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        isolate_parser(self)
+        self.calls = 0
+
+    async def slow_search(self):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        return [{"name": "Соль", "price": 29.0, "link": "https://av.ru/i/1"}]
+
+    async def test_concurrent_calls_share_one_search(self):
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.do("соль", self.slow_search) for _ in range(5)))
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(flight.shared, 4)
+        self.assertTrue(all(result == results[0] for result in results))
+        self.assertEqual(len(flight), 0)
+
+    async def test_error_is_shared(self):
+        flight = SingleFlight()
+
+        async def broken():
+            await asyncio.sleep(0.01)
+            raise WebDriverException("boom")
+
+        results = await asyncio.gather(flight.do("соль", broken), flight.do("соль", broken), return_exceptions=True)
+        self.assertTrue(all(isinstance(result, WebDriverException) for result in results))
+
+        # После ошибки ключ освобождается и следующий вызов ищет заново
+        self.assertEqual(await flight.do("соль", self.slow_search), await self.slow_search())
+
+    # Отмена одного ожидающего не ломает поиск для остальных
+    async def test_cancelled_waiter_does_not_cancel_search(self):
+        flight = SingleFlight()
+        first = asyncio.ensure_future(flight.do("соль", self.slow_search))
+        second = asyncio.ensure_future(flight.do("соль", self.slow_search))
+        await asyncio.sleep(0)
+        first.cancel()
+
+        self.assertEqual((await second)[0]["name"], "Соль")
+        self.assertEqual(self.calls, 1)
+
+    # Два пользователя одновременно ищут одно и то же - браузер работает один раз
+    async def test_data_parser_coalesces_users(self):
+        def fake_search(el):
+            time.sleep(0.05)
+            return [{"name": el, "price": 10.0, "link": f"https://av.ru/i/{el}"}]
+
+        with patch('parser.parse_product_sync', side_effect=fake_search) as mock_search:
+            first, second = await asyncio.gather(
+                data_parser({"соль": 1, "сахар": 1}),
+                data_parser({"Соль": 1, "яйца": 1}),
+            )
+
+        self.assertEqual(mock_search.call_count, 3)
+        self.assertEqual(first["соль"], second["Соль"])
+
+class FakeStoreAdapter(StoreAdapter):
+    """Магазин из словаря, с задержкой ответа (общей или по запросам) и возможностью упасть"""
+
+    def __init__(self, name, catalog, delay=0, error=None):
+        self.name = name
+        self.title = name
+        self.catalog = catalog
+        self.delay = delay
+        self.error = error
+        self.calls = []
+
+    async def search(self, el):
+        self.calls.append(el)
+        await asyncio.sleep(self.delay.get(el, 0) if isinstance(self.delay, dict) else self.delay)
+        if self.error:
+            raise self.error
+        return [
+            {"name": name, "price": price, "link": f"https://{self.name}.test/{i}"}
+            for i, (name, price) in enumerate(self.catalog.get(el, []))
+        ]
+
+class TestStores(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        isolate_parser(self)
+        self.cheap = FakeStoreAdapter("cheap", {"сахар": [("Сахар 1 кг", 70.0)], "соль": [("Соль 1 кг", 20.0)]})
+        self.fancy = FakeStoreAdapter("fancy", {"сахар": [("Сахар тростниковый 900 г", 229.0)]})
+
+    # Предложения из всех магазинов сливаются и помечаются магазином
+    async def test_offers_merged_and_tagged(self):
+        result = await data_parser({"сахар": 1, "соль": 1}, stores=[self.cheap, self.fancy])
+
+        self.assertEqual([product["store"] for product in result["сахар"]], ["cheap", "fancy"])
+        self.assertEqual(result["соль"], [{"name": "Соль 1 кг", "price": 20.0, "link": "https://cheap.test/0", "store": "cheap"}])
+
+    # Магазины опрашиваются параллельно
+    async def test_stores_queried_concurrently(self):
+        slow_a = FakeStoreAdapter("a", {"сахар": [("Сахар", 70.0)]}, delay=0.1)
+        slow_b = FakeStoreAdapter("b", {"сахар": [("Сахар", 80.0)]}, delay=0.1)
+
+        start = time.monotonic()
+        await data_parser({"сахар": 1}, stores=[slow_a, slow_b])
+
+        self.assertLess(time.monotonic() - start, 0.18)
+
+    # Медленный магазин отсекается по дедлайну, остальные отвечают
+    async def test_store_deadline(self):
+        slow = FakeStoreAdapter("slow", {"сахар": [("Сахар", 1.0)]}, delay=1)
+        slow.deadline = 0.05
+
+        result = await data_parser({"сахар": 1}, stores=[self.cheap, slow])
+
+        self.assertEqual([product["store"] for product in result["сахар"]], ["cheap"])
+
+    # Таймаут внутри магазина (нет свободного браузера) - ошибка магазина, а не его дедлайн
+    async def test_inner_timeout_is_not_deadline(self):
+        busy = FakeStoreAdapter("busy", {}, error=TimeoutError("No free browser in the driver pool"))
+
+        with self.assertRaisesRegex(TimeoutError, "No free browser"):
+            await parser.search_store(busy, "сахар", asyncio.Semaphore(1), raise_errors=True)
+        with patch('builtins.print') as mock_print:
+            result = await parser.search_store(busy, "сахар", asyncio.Semaphore(1))
+
+        self.assertEqual(result, ([], False))
+        self.assertIn("Error searching сахар in store busy", mock_print.call_args[0][0])
+
+    async def test_failing_store_is_skipped(self):
+        broken = FakeStoreAdapter("broken", {}, error=WebDriverException("boom"))
+
+        result = await data_parser({"сахар": 1}, stores=[broken, self.cheap])
+
+        self.assertEqual(result["сахар"][0]["store"], "cheap")
+
+    # Заранее начатые поиски переиспользуются, лишние отменяются, итог как у data_parser
+    async def test_prefetch(self):
+        slow = FakeStoreAdapter("slow", {"сахар": [("Сахар", 70.0)], "соль": [("Соль", 20.0)]},
+                                delay={"сахар": 0.1, "соль": 0.1, "перец": 1})
+        search = parser.IngredientSearch(stores=[slow])
+        search.prefetch("сахар")
+        unused = search.prefetch("перец")
+        await asyncio.sleep(0.05)
+
+        result = await search.results({"сахар": 1, "соль": 1})
+
+        self.assertEqual(slow.calls, ["сахар", "перец", "соль"])
+        with self.assertRaises(asyncio.CancelledError):
+            await unused
+        self.assertEqual(result, {
+            "сахар": [{"name": "Сахар", "price": 70.0, "link": "https://slow.test/0", "store": "slow"}],
+            "соль": [{"name": "Соль", "price": 20.0, "link": "https://slow.test/0", "store": "slow"}],
+        })
+
+    async def test_not_found_anywhere(self):
+        result = await data_parser({"нори": 1}, stores=[self.cheap, self.fancy])
+
+        self.assertEqual(result, {"нори": [{"message": "Товар отсутствует в данном магазине, попробуйте поискать в другом."}]})
+
+    # knapsack выбирает самое дешевое предложение среди всех магазинов
+    async def test_knapsack_picks_across_stores(self):
+        result = await data_parser({"сахар": 1}, stores=[self.fancy, self.cheap])
+        basket = await knapsack(result, {"сахар": 1}, 1000)
+
+        self.assertEqual(basket["сахар"][0]["store"], "cheap")
+        self.assertEqual(basket["total_cost"], 70.0)
+
+    async def test_registry(self):
+        with patch.dict('backend.parser.stores.stores', clear=True):
+            register_store(self.cheap)
+            register_store(self.fancy)
+            with patch('backend.parser.stores.ENABLED_STORES', ["fancy"]):
+                self.assertEqual(get_enabled_stores(), [self.fancy])
+            self.assertEqual(get_enabled_stores(), [self.cheap, self.fancy])
+
+class TestKnapsack(unittest.TestCase):
+
+    def brute_force(self, groups, budget):
+        best = 0.0
+        for choice in itertools.product(*[[None] + list(range(len(group))) for group in groups]):
+            cost = sum(groups[g][i][0] for g, i in enumerate(choice) if i is not None)
+            value = sum(groups[g][i][1] for g, i in enumerate(choice) if i is not None)
+            if cost <= budget + 1e-9:
+                best = max(best, value)
+        return best
+
+    # На маленьких корзинах branch and bound совпадает с полным перебором
+    def test_solver_is_optimal(self):
+        rnd = random.Random(7)
+        for _ in range(200):
+            groups = [
+                [(rnd.randint(10, 300), rnd.choice([1000, 1000.5, 1001])) for _ in range(rnd.randint(1, 4))]
+                for _ in range(rnd.randint(1, 5))
+            ]
+            budget = rnd.randint(0, 900)
+            chosen, value, exact = solve_mckp(groups, budget, time_limit=1)
+
+            self.assertTrue(exact)
+            self.assertAlmostEqual(value, self.brute_force(groups, budget))
+            cost = sum(groups[g][i][0] for g, i in enumerate(chosen) if i is not None)
+            self.assertLessEqual(cost, budget)
+
+    def test_greedy_is_feasible(self):
+        rnd = random.Random(3)
+        groups = [[(rnd.uniform(10, 500), 1000 + rnd.random()) for _ in range(20)] for _ in range(100)]
+        chosen, _ = greedy_mckp(groups, 5000)
+
+        cost = sum(groups[g][i][0] for g, i in enumerate(chosen) if i is not None)
+        self.assertLessEqual(cost, 5000)
+
+    # Вместо самого дешевого всего - другой выбор, чтобы купить все ингредиенты
+    def test_knapsack_covers_more_ingredients(self):
+        products = {
+            "сыр": [{"name": "Пармезан", "price": 300.0, "link": "1"}, {"name": "Сыр плавленый", "price": 90.0, "link": "2"}],
+            "паста": [{"name": "Спагетти", "price": 100.0, "link": "3"}],
+        }
+        result = asyncio.run(knapsack(products, {"сыр": 1, "паста": 1}, 200))
+
+        self.assertEqual(result["сыр"][0]["name"], "Сыр плавленый")
+        self.assertEqual(result["паста"][0]["name"], "Спагетти")
+        self.assertEqual(result["total_cost"], 190.0)
+        self.assertNotIn("message", result)
+
+    def test_knapsack_prefers_quality_within_budget(self):
+        products = {
+            "сыр": [{"name": "Пармезан", "price": 300.0, "link": "1", "quality": 1.0},
+                    {"name": "Сыр плавленый", "price": 90.0, "link": "2", "quality": 0.1}],
+        }
+        result = asyncio.run(knapsack(products, {"сыр": 1}, 1000))
+
+        self.assertEqual(result["сыр"][0]["name"], "Пармезан")
+
+    # Долгий перебор не останавливает event loop: остальные корутины работают
+    def test_knapsack_does_not_block_event_loop(self):
+        def slow_solver(products_data, quantities, budget):
+            time.sleep(0.2)
+            return {"total_cost": 0.0}
+
+        async def run():
+            ticks = 0
+
+            async def ticker():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            task = asyncio.create_task(ticker())
+            result = await knapsack({}, {}, 100)
+            task.cancel()
+            return result, ticks
+
+        with patch('parser.optimize_basket', slow_solver):
+            result, ticks = asyncio.run(run())
+
+        self.assertEqual(result, {"total_cost": 0.0})
+        self.assertGreater(ticks, 5)
+
+    # Если всего не купить, часть ингредиентов помечается, как в старом формате
+    def test_knapsack_over_budget(self):
+        products = {
+            "сыр": [{"name": "Пармезан", "price": 300.0, "link": "1"}],
+            "паста": [{"name": "Спагетти", "price": 100.0, "link": "3"}],
+            "нори": [{"message": "Товар отсутствует в данном магазине, попробуйте поискать в другом."}],
+        }
+        result = asyncio.run(knapsack(products, {"сыр": 1, "паста": 1, "нори": 1}, 150))
+
+        self.assertEqual(result["паста"][0]["name"], "Спагетти")
+        self.assertIn("message", result["сыр"][0])
+        self.assertIn("message", result["нори"][0])
+        self.assertIn("Бюджета недостаточно", result["message"])
+        self.assertIn("400.00 RUB", result["message"])
+        self.assertEqual(result["total_cost"], 100.0)
+
+    # На большой корзине решатель укладывается в лимит времени
+    def test_time_limit(self):
+        rnd = random.Random(11)
+        groups = [[(rnd.uniform(50, 500), 1000 + rnd.random()) for _ in range(30)] for _ in range(150)]
+
+        start = time.perf_counter()
+        chosen, _, _ = solve_mckp(groups, 20000, time_limit=0.05)
+
+        self.assertLess(time.perf_counter() - start, 1)
+        cost = sum(groups[g][i][0] for g, i in enumerate(chosen) if i is not None)
+        self.assertLessEqual(cost, 20000)
+
+class TestUnits(unittest.TestCase):
+
+    def test_parse_quantity(self):
+        cases = {
+            "200 г": Quantity(200, "г"),
+            "0,5 кг": Quantity(500, "г"),
+            "300 граммов": Quantity(300, "г"),
+            "1 л": Quantity(1000, "мл"),
+            "2 ст.": Quantity(30, "мл"),
+            "2 ст. л.": Quantity(30, "мл"),
+            "0,5 ч.": Quantity(2.5, "мл"),
+            "1/2 стакана": Quantity(100, "мл"),
+            "1-2 шт": Quantity(2, "шт"),
+            "3": Quantity(3, "шт"),
+        }
+        for text, expected in cases.items():
+            quantity = parse_quantity(text)
+            self.assertEqual(quantity.unit, expected.unit, text)
+            self.assertAlmostEqual(quantity.amount, expected.amount, msg=text)
+        self.assertIsNone(parse_quantity("по вкусу"))
+
+    def test_parse_pack_size(self):
+        self.assertEqual(parse_pack_size("Молоко 3,2% 930 мл"), Quantity(930, "мл"))
+        self.assertEqual(parse_pack_size("Сахар белый 1 кг"), Quantity(1000, "г"))
+        self.assertEqual(parse_pack_size("Йогурт 4x100 г"), Quantity(400, "г"))
+        self.assertEqual(parse_pack_size("Яйца куриные С0 10шт"), Quantity(10, "шт"))
+        self.assertIsNone(parse_pack_size("Огурцы короткоплодные"))
+
+    def test_packs_needed(self):
+        self.assertEqual(packs_needed(Quantity(500, "г"), "Рис 300 г"), 2)
+        self.assertEqual(packs_needed(Quantity(900, "г"), "Рис 900г"), 1)
+        self.assertEqual(packs_needed(Quantity(12, "шт"), "Яйца 10 шт"), 2)
+        self.assertEqual(packs_needed(Quantity(3, "шт"), "Лимоны"), 3)
+        self.assertEqual(packs_needed(Quantity(30, "мл"), "Сахар 1 кг"), 1)
+        self.assertEqual(packs_needed(Quantity(2, "шт"), "Молоко 1 л"), 1)
+        self.assertEqual(packs_needed(None, "Соль 1 кг"), 1)
+        self.assertEqual(packs_needed(2), 2)
+
+    # Стоимость корзины считается по числу упаковок, которые надо купить
+    def test_knapsack_counts_packs(self):
+        quantities = asyncio.run(standardize_ingredients({"молоко": "1,5 л", "соль": "по вкусу"}))
+        products = {
+            "молоко": [{"name": "Молоко 1 л", "price": 100.0, "link": "1"},
+                       {"name": "Молоко 2 л", "price": 180.0, "link": "2"}],
+            "соль": [{"name": "Соль 1 кг", "price": 30.0, "link": "3"}],
+        }
+        result = asyncio.run(knapsack(products, quantities, 210))
+
+        self.assertEqual(result["молоко"][0]["name"], "Молоко 2 л")
+        self.assertEqual(result["молоко"][0]["packs"], 1)
+        self.assertEqual(result["соль"][0]["cost"], 30.0)
+        self.assertEqual(result["total_cost"], 210.0)
+        self.assertNotIn("packs", products["молоко"][1])
+
+        result = asyncio.run(knapsack({"молоко": products["молоко"][:1]}, quantities, 1000))
+        self.assertEqual(result["молоко"][0]["packs"], 2)
+        self.assertEqual(result["total_cost"], 200.0)
+
+class TestBatchPricing(unittest.TestCase):
+
+    def random_baskets(self, rnd, count):
+        baskets = []
+        for b in range(count):
+            products = {}
+            for i in range(rnd.randint(0, 6)):
+                products[f"ингредиент {i}"] = [
+                    {"name": f"товар {b}-{i}-{j}", "price": float(rnd.randint(10, 300)), "link": str(j)}
+                    for j in range(rnd.randint(0, 4))
+                ]
+            quantities = {name: rnd.choice([1, 2, "по вкусу"]) for name in products}
+            baskets.append((products, quantities))
+        return baskets
+
+    # Пакетный пересчет совпадает с поштучным подсчетом самых дешевых товаров
+    def test_matches_per_basket_loop(self):
+        rnd = random.Random(5)
+        baskets = self.random_baskets(rnd, 300)
+        budgets = [rnd.randint(0, 1500) for _ in baskets]
+
+        results = reprice_baskets(baskets, budgets)
+
+        for (products, quantities), budget, (result, feasible) in zip(baskets, budgets, results):
+            total = 0.0
+            for name, quantity in quantities.items():
+                multiplier = quantity if isinstance(quantity, int) else 1
+                if products[name]:
+                    cheapest = min(products[name], key=lambda x: x["price"])
+                    self.assertEqual(result[name][0]["price"], cheapest["price"])
+                    total += cheapest["price"] * multiplier
+                else:
+                    self.assertIn("message", result[name][0])
+            self.assertAlmostEqual(result["total_cost"], total)
+            self.assertEqual(feasible, total <= budget)
+
+    # feasible совпадает с тем, соберет ли optimize_basket корзину без выкинутых ингредиентов
+    def test_feasible_matches_optimize_basket(self):
+        rnd = random.Random(7)
+        baskets = self.random_baskets(rnd, 200)
+        budgets = [rnd.randint(0, 1500) for _ in baskets]
+
+        results = reprice_baskets(baskets, budgets)
+
+        for (products, quantities), budget, (result, feasible) in zip(baskets, budgets, results):
+            basket = optimize_basket(products, quantities, budget)
+            self.assertEqual(feasible, "message" not in basket)
+            self.assertEqual(set(result), set(basket) - {"message"})
+            if feasible:
+                self.assertLessEqual(basket["total_cost"], budget)
+
+    def test_padded_matches_csr(self):
+        nan = float("nan")
+        prices = [
+            [[100, 50, nan], [nan, nan, nan]],
+            [[30, 30, 10], [5, nan, nan]],
+        ]
+        padded = price_padded(prices, [40, 40])
+
+        batch = BasketBatch.from_baskets([
+            ({"a": [{"price": 100}, {"price": 50}], "b": []}, {"a": 1, "b": 1}),
+            ({"a": [{"price": 30}, {"price": 30}, {"price": 10}], "b": [{"price": 5}]}, {"a": 1, "b": 1}),
+        ])
+        csr = price_batch(batch, [40, 40])
+
+        self.assertEqual(padded["basket_cost"].tolist(), [50.0, 15.0])
+        self.assertEqual(csr["basket_cost"].tolist(), [50.0, 15.0])
+        self.assertEqual(padded["missing"].tolist(), csr["missing"].tolist())
+        self.assertEqual(padded["feasible"].tolist(), [False, True])
+        self.assertEqual(csr["feasible"].tolist(), [False, True])
+        self.assertEqual(padded["cheapest_index"].tolist(), [[1, -1], [2, 0]])
+        self.assertEqual(csr["cheapest_index"].tolist(), [1, -1, 4, 5])
+
+    def test_empty_batch(self):
+        self.assertEqual(reprice_baskets([], []), [])
+        self.assertEqual(reprice_baskets([({}, {})], 100), [({"total_cost": 0.0}, True)])
+
+class TestDriverPool(unittest.TestCase):
+
+    def setUp(self):
+        patchers = [
+            patch('backend.parser.driver_pool.ChromeDriverManager'),
+            patch('backend.parser.driver_pool.WebDriverWait'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    # Браузер переиспользуется между запросами
+    @patch('backend.parser.driver_pool.webdriver.Chrome')
+    def test_driver_is_reused(self, mock_webdriver):
+        pool = DriverPool(size=1)
+
+        with pool.lease() as first:
+            first.open("https://av.ru/search/?text=молоко")
+        with pool.lease() as second:
+            second.open("https://av.ru/search/?text=хлеб")
+
+        mock_webdriver.assert_called_once()
+        self.assertIs(first, second)
+        self.assertEqual(second.pages, 2)
+
+    # Город выбирается один раз при создании браузера
+    @patch('backend.parser.driver_pool.webdriver.Chrome')
+    def test_city_selected_on_create(self, mock_webdriver):
+        pool = DriverPool(size=1)
+        pool.start()
+
+        mock_webdriver.return_value.get.assert_called_once_with("https://av.ru/")
+
+        with pool.lease() as pooled:
+            pooled.open("https://av.ru/search/?text=молоко")
+        self.assertEqual(mock_webdriver.return_value.get.call_count, 2)
+
+    # Браузер пересоздается после лимита страниц
+    @patch('backend.parser.driver_pool.webdriver.Chrome')
+    def test_recycle_after_max_pages(self, mock_webdriver):
+        mock_webdriver.side_effect = [MagicMock(), MagicMock()]
+        pool = DriverPool(size=1, max_pages=1)
+
+        with pool.lease() as first:
+            first.open("https://av.ru/search/?text=молоко")
+        with pool.lease() as second:
+            pass
+
+        self.assertIsNot(first, second)
+        first.driver.quit.assert_called_once()
+        self.assertEqual(mock_webdriver.call_count, 2)
+
+    # Браузер пересоздается после лимита по возрасту
+    @patch('backend.parser.driver_pool.webdriver.Chrome')
+    def test_recycle_after_max_age(self, mock_webdriver):
+        mock_webdriver.side_effect = [MagicMock(), MagicMock()]
+        pool = DriverPool(size=1, max_age=0)
+
+        with pool.lease() as first:
+            pass
+        with pool.lease() as second:
+            pass
+
+        self.assertIsNot(first, second)
+        first.driver.quit.assert_called_once()
+
+    # Упавший браузер не возвращается в пул
+    @patch('backend.parser.driver_pool.webdriver.Chrome')
+    def test_broken_driver_is_replaced(self, mock_webdriver):
+        mock_webdriver.side_effect = [MagicMock(), MagicMock()]
+        pool = DriverPool(size=1)
+
+        with self.assertRaises(WebDriverException):
+            with pool.lease() as first:
+                raise WebDriverException()
+        with pool.lease() as second:
+            pass
+
+        self.assertIsNot(first, second)
+        first.driver.quit.assert_called_once()
+
+    # Если все браузеры заняты, ждем освобождения не дольше lease_timeout
+    @patch('backend.parser.driver_pool.webdriver.Chrome')
+    def test_lease_timeout(self, mock_webdriver):
+        pool = DriverPool(size=1, lease_timeout=0.05)
+
+        with pool.lease():
+            with self.assertRaises(TimeoutError):
+                with pool.lease():
+                    pass
+
+    @patch('backend.parser.driver_pool.webdriver.Chrome')
+    def test_close_quits_idle_drivers(self, mock_webdriver):
+        pool = DriverPool(size=2)
+        pool.start()
+        pool.close()
+
+        self.assertEqual(mock_webdriver.return_value.quit.call_count, 2)
+        with self.assertRaises(RuntimeError):
+            with pool.lease():
+                pass
+
 # E2E тесты
 class TestE2EDataParser(unittest.TestCase):
 
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import re
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from backend.utils.ttl_cache import TTLCache
+
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_query(el: str) -> str:
+    """'Рис+для  суши' и 'рис для суши' - один и тот же ключ кэша"""
+    el = el.replace('+', ' ').lower().replace('ё', 'е')
+    return _SPACES_RE.sub(' ', el).strip()
+
+
+def cache_key(el: str, store: str = "") -> str:
+    key = normalize_query(el)
+    return f"{store}:{key}" if store else key
+
+
+class PriceCache:
+    """
+    Кэш найденных товаров в два уровня: LRU в памяти процесса и SQLite на диске,
+    чтобы цены переживали перезапуск бота
+    """
+
+    def __init__(self, path: str = "price_cache.db", maxsize: int = 2048, ttl: float = 6 * 60 * 60):
+        self.path = path
+        self.ttl = ttl
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl, timer=time.time)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS price_cache (
+                    query TEXT PRIMARY KEY,
+                    products TEXT,
+                    expires_at REAL
+                )
+            ''')
+            self._conn.commit()
+        return self._conn
+
+    def _get_memory(self, key: str) -> Optional[list[dict]]:
+        products = self.memory.get(key)
+        if products is not None:
+            self.memory_hits += 1
+        return products
+
+    def _get_disk(self, key: str) -> Optional[list[dict]]:
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            row = db.execute(
+                'SELECT products, expires_at FROM price_cache WHERE query = ?', (key,)
+            ).fetchone()
+            if row and row[1] <= now:
+                db.execute('DELETE FROM price_cache WHERE query = ?', (key,))
+                db.commit()
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+
+        products = json.loads(row[0])
+        self.memory.set(key, products, ttl=row[1] - now)
+        return products
+
+    def _set_disk(self, key: str, products: list[dict], ttl: float):
+        with self._lock:
+            db = self._db()
+            db.execute(
+                'INSERT OR REPLACE INTO price_cache (query, products, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(products, ensure_ascii=False), time.time() + ttl)
+            )
+            db.commit()
+
+    def get(self, el: str, store: str = "") -> Optional[list[dict]]:
+        key = cache_key(el, store)
+        products = self._get_memory(key)
+        if products is None:
+            products = self._get_disk(key)
+        return products
+
+    def set(self, el: str, products: list[dict], ttl: float = None, store: str = ""):
+        key = cache_key(el, store)
+        ttl = self.ttl if ttl is None else ttl
+        self.memory.set(key, products, ttl=ttl)
+        self._set_disk(key, products, ttl)
+
+    # Для event loop: память проверяется сразу, SQLite (чтение, commit) - в отдельном потоке
+    async def aget(self, el: str, store: str = "") -> Optional[list[dict]]:
+        key = cache_key(el, store)
+        products = self._get_memory(key)
+        if products is None:
+            products = await asyncio.to_thread(self._get_disk, key)
+        return products
+
+    async def aset(self, el: str, products: list[dict], ttl: float = None, store: str = ""):
+        key = cache_key(el, store)
+        ttl = self.ttl if ttl is None else ttl
+        self.memory.set(key, products, ttl=ttl)
+        await asyncio.to_thread(self._set_disk, key, products, ttl)
+
+    def stats(self) -> dict:
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,29 @@
+import asyncio
+from typing import Awaitable, Callable
+
+
+class SingleFlight:
+    """
+    Схлопывает одинаковые запросы: пока поиск по ключу выполняется,
+    остальные вызовы с тем же ключом ждут его результат, а не запускают свой
+    """
+
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Task] = {}
+        self.started = 0
+        self.shared = 0
+
+    async def do(self, key: str, func: Callable[[], Awaitable]):
+        task = self._inflight.get(key)
+        if task is None:
+            self.started += 1
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.shared += 1
+        # shield: если один из ожидающих отменен, поиск для остальных продолжается
+        return await asyncio.shield(task)
+
+    def __len__(self) -> int:
+        return len(self._inflight)
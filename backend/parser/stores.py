@@ -0,0 +1,66 @@
+from typing import Optional
+
+# Сколько секунд ждем ответа одного магазина, прежде чем считать, что товаров там нет
+STORE_DEADLINE = 30
+
+
+class StoreDeadlineExceeded(Exception):
+    """Магазин не ответил за deadline. Свои таймауты магазина (например, нет свободного браузера) - не она"""
+
+
+class StoreAdapter:
+    """
+    Магазин, в котором data_parser ищет ингредиенты.
+    Наследник задает name/title и реализует search
+    """
+
+    name = ""
+    title = ""
+    deadline = STORE_DEADLINE
+
+    async def search(self, el: str) -> list[dict]:
+        """Возвращает до 5 предложений вида {"name", "price", "link"}"""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+# Реестр магазинов: name -> адаптер
+stores: dict[str, StoreAdapter] = {}
+# None - ищем во всех зарегистрированных магазинах
+ENABLED_STORES: Optional[list[str]] = None
+
+
+def register_store(adapter: StoreAdapter) -> StoreAdapter:
+    if not adapter.name:
+        raise ValueError("Store adapter must have a name")
+    stores[adapter.name] = adapter
+    return adapter
+
+
+def unregister_store(name: str):
+    stores.pop(name, None)
+
+
+def get_store(name: str) -> Optional[StoreAdapter]:
+    return stores.get(name)
+
+
+def store_title(name: str) -> str:
+    adapter = stores.get(name)
+    return adapter.title if adapter and adapter.title else name
+
+
+def get_enabled_stores() -> list[StoreAdapter]:
+    if ENABLED_STORES is None:
+        return list(stores.values())
+    return [stores[name] for name in ENABLED_STORES if name in stores]
+
+
+async def close_stores():
+    for adapter in stores.values():
+        try:
+            await adapter.close()
+        except Exception as e:
+            print(f"Error closing store {adapter.name}: {e}")
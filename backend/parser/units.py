@@ -0,0 +1,162 @@
+"""
+Количества из рецепта и размеры упаковок из названий товаров.
+
+Все приводится к базовым единицам: граммы, миллилитры, штуки.
+Ложки и стаканы считаем по объему, а граммы и миллилитры взаимозаменяемыми
+(плотность 1) - для подсчета упаковок этой точности хватает
+"""
+import math
+import re
+from functools import lru_cache
+from typing import NamedTuple, Optional
+
+GRAM = "г"
+MILLILITER = "мл"
+PIECE = "шт"
+
+
+class Quantity(NamedTuple):
+    amount: float
+    unit: str
+
+
+# Единица из текста -> (базовая единица, множитель). Шаблон - начало слова,
+# окончание может быть любым ("грамм", "граммов", "стакана").
+# Порядок важен: первое совпадение выигрывает
+UNITS = [
+    (r"кг|килограмм", GRAM, 1000.0),
+    (r"мг|миллиграмм", GRAM, 0.001),
+    (r"мл|миллилитр", MILLILITER, 1.0),
+    (r"шт|уп|пуч|головк|горст|банк|пач", PIECE, 1.0),
+    (r"г", GRAM, 1.0),
+    (r"л(?![а-яё])|литр", MILLILITER, 1000.0),
+    (r"ст\.?\s*л|столов", MILLILITER, 15.0),
+    (r"ч\.?\s*л|чайн|ч(?![а-яё])", MILLILITER, 5.0),
+    (r"стакан", MILLILITER, 200.0),
+    (r"ст(?![а-яё])", MILLILITER, 15.0),
+    (r"щепот", GRAM, 1.0),
+    # В головке чеснока около десяти зубчиков
+    (r"зубч", PIECE, 0.1),
+]
+_UNIT_WORDS = [rf"(?:{pattern})[а-яё]*\.?" for pattern, _, _ in UNITS]
+_UNIT_TABLE = [(re.compile(word), base, factor) for word, (_, base, factor) in zip(_UNIT_WORDS, UNITS)]
+
+# Единицы, в которых продаются упаковки
+PACK_UNITS = {
+    "кг": (GRAM, 1000.0),
+    "г": (GRAM, 1.0),
+    "гр": (GRAM, 1.0),
+    "мг": (GRAM, 0.001),
+    "л": (MILLILITER, 1000.0),
+    "мл": (MILLILITER, 1.0),
+    "шт": (PIECE, 1.0),
+}
+
+_NUMBER = r"\d+(?:[.,]\d+)?"
+QUANTITY_RE = re.compile(
+    rf"(?P<number>{_NUMBER}(?:\s*/\s*\d+)?|[½¼¾])(?:\s*[-–]\s*(?P<upper>{_NUMBER}))?"
+    rf"\s*(?P<unit>{'|'.join(_UNIT_WORDS)})?"
+)
+PACK_RE = re.compile(
+    rf"(?:(?P<count>\d+)\s*[xх×*]\s*)?(?P<number>{_NUMBER})\s*"
+    rf"(?P<unit>{'|'.join(sorted(PACK_UNITS, key=len, reverse=True))})(?![а-яё])"
+)
+FRACTIONS = {"½": 0.5, "¼": 0.25, "¾": 0.75}
+
+
+def _number(text: str) -> float:
+    if text in FRACTIONS:
+        return FRACTIONS[text]
+    if "/" in text:
+        numerator, denominator = text.split("/")
+        return float(numerator.replace(",", ".")) / float(denominator) if float(denominator) else 0.0
+    return float(text.replace(",", "."))
+
+
+@lru_cache(maxsize=4096)
+def parse_quantity(quantity_str: str) -> Optional[Quantity]:
+    """
+    '200 г' -> Quantity(200, 'г'), '0,5 кг' -> Quantity(500, 'г'),
+    '2 ст.' -> Quantity(30, 'мл'), '1-2 шт' -> Quantity(2, 'шт').
+    Без числа ('по вкусу') - None
+    """
+    if not isinstance(quantity_str, str):
+        return None
+    match = QUANTITY_RE.search(quantity_str.strip().lower())
+    if not match:
+        return None
+
+    try:
+        amount = _number(match.group("number"))
+        if match.group("upper"):
+            amount = max(amount, _number(match.group("upper")))
+    except ValueError:
+        return None
+    if amount <= 0:
+        return None
+
+    unit = match.group("unit")
+    if unit is None:
+        # Просто число - считаем, что это штуки
+        return Quantity(amount, PIECE)
+    for pattern, base, factor in _UNIT_TABLE:
+        if pattern.fullmatch(unit):
+            return Quantity(amount * factor, base)
+    return Quantity(amount, PIECE)
+
+
+@lru_cache(maxsize=16384)
+def parse_pack_size(product_name: str) -> Optional[Quantity]:
+    """
+    Размер упаковки из названия товара: 'Молоко 3,2% 930 мл' -> Quantity(930, 'мл'),
+    'Йогурт 4x100 г' -> Quantity(400, 'г'). Берем последнее совпадение
+    """
+    if not isinstance(product_name, str):
+        return None
+    pack = None
+    for match in PACK_RE.finditer(product_name.lower()):
+        pack = match
+    if pack is None:
+        return None
+
+    amount = float(pack.group("number").replace(",", "."))
+    if pack.group("count"):
+        amount *= int(pack.group("count"))
+    if amount <= 0:
+        return None
+    base, factor = PACK_UNITS[pack.group("unit")]
+    return Quantity(amount * factor, base)
+
+
+def scale_quantity(quantity, factor: float):
+    """Количество на другое число порций"""
+    if isinstance(quantity, Quantity):
+        return quantity._replace(amount=quantity.amount * factor)
+    if isinstance(quantity, (int, float)) and not isinstance(quantity, bool):
+        return quantity * factor
+    return quantity
+
+
+def _comparable(a: str, b: str) -> bool:
+    return a == b or {a, b} == {GRAM, MILLILITER}
+
+
+def packs_needed(quantity, product_name: str = "") -> int:
+    """
+    Сколько упаковок товара купить под количество из рецепта.
+    Старый формат (число) - это уже число упаковок
+    """
+    if isinstance(quantity, (int, float)) and not isinstance(quantity, bool):
+        return max(1, math.ceil(quantity)) if quantity > 0 else 1
+    if not isinstance(quantity, Quantity):
+        return 1
+
+    pack = parse_pack_size(product_name)
+    if pack is None:
+        # Размер упаковки неизвестен, зато штуки без упаковки считаются поштучно
+        if quantity.unit == PIECE and product_name:
+            return max(1, math.ceil(quantity.amount - 1e-9))
+        return 1
+    if not _comparable(quantity.unit, pack.unit):
+        return 1
+    return max(1, math.ceil(quantity.amount / pack.amount - 1e-9))
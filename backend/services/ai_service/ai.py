@@ -1,58 +1,378 @@
 import aiohttp
 import asyncio
 import json
+import random
 import re
 import ssl
-import requests
+import time
+from collections import deque
 
+from backend.services.ai_service.recipe_text import find_ingredients, parse_ingredient_line
+from backend.services.ai_service.scheduler import LlmScheduler, SchedulerOverloaded, request_tokens, PRIORITY_INTERACTIVE
 from backend.services.ai_service.settings import GPT_API_KEY
+from backend.utils.ttl_cache import TTLCache
+
+GPT_URL = 'https://llm.api.cloud.yandex.net/foundationModels/v1/completion'
+GPT_MODEL_URI = "gpt://b1gjsebilk1g8hvtc07c/yandexgpt-lite"
+
+# Настройки клиента YandexGPT
+GPT_CONNECT_TIMEOUT = 5  # секунд на установку соединения
+GPT_READ_TIMEOUT = 60  # секунд ожидания ответа, генерация бывает долгой
+GPT_MAX_CONNECTIONS = 20
+GPT_CONCURRENCY = 10  # сколько запросов к модели одновременно
+# Повторы при 429 и 5xx: задержка случайная от 0 до base * 2^попытка, но не больше max
+GPT_MAX_RETRIES = 2
+GPT_RETRY_BASE_DELAY = 0.5  # секунд
+GPT_RETRY_MAX_DELAY = 8  # секунд
+GPT_RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Хеджирование: если ответа нет дольше, чем GPT_HEDGE_PERCENTILE процентов прошлых
+# ответов, отправляем второй такой же запрос и берем тот, что ответит раньше.
+# None - не хеджировать
+GPT_HEDGE_PERCENTILE = 95
+GPT_HEDGE_MIN_SAMPLES = 20  # пока замеров меньше, ждем GPT_HEDGE_INITIAL_DELAY
+GPT_HEDGE_INITIAL_DELAY = 15  # секунд
+GPT_HEDGE_MIN_DELAY = 1  # секунд
+GPT_LATENCY_WINDOW = 200  # сколько последних замеров помнить
+# Общий бюджет на все запросы бота, сверх него запросы ждут в очереди
+GPT_REQUESTS_PER_MINUTE = 300
+GPT_TOKENS_PER_MINUTE = 600000  # на запрос резервируется maxTokens плюс оценка промпта
+GPT_QUEUE_SIZE = 200  # сколько запросов может ждать, остальным сразу отказ
+
+# Кэш готовых рецептов
+RECIPE_CACHE_SIZE = 512
+RECIPE_CACHE_TTL = 6 * 60 * 60  # секунд
+
+
+class GptClient:
+    """
+    Асинхронный клиент YandexGPT: одна keep-alive сессия aiohttp на процесс
+    и ограничение числа одновременных запросов, чтобы не упираться в квоты.
+    Медленные ответы хеджируются вторым запросом, 429 и 5xx повторяются с джиттером.
+    Каждый повтор и хедж списывается с бюджета scheduler - первую отправку
+    оплачивает LlmScheduler.acquire в get_recipe. Хеджа нет, когда бюджета не хватает
+    """
+
+    def __init__(self, url: str = GPT_URL, connect_timeout: float = GPT_CONNECT_TIMEOUT,
+                 read_timeout: float = GPT_READ_TIMEOUT, max_connections: int = GPT_MAX_CONNECTIONS,
+                 concurrency: int = GPT_CONCURRENCY, max_retries: int = GPT_MAX_RETRIES,
+                 retry_base_delay: float = GPT_RETRY_BASE_DELAY, retry_max_delay: float = GPT_RETRY_MAX_DELAY,
+                 hedge_percentile: float = GPT_HEDGE_PERCENTILE, scheduler: LlmScheduler = None):
+        self.url = url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_connections = max_connections
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.hedge_percentile = hedge_percentile
+        self.scheduler = scheduler
+        # Время полного ответа и время до первого куска стрима - для порога хеджирования
+        self.latencies = deque(maxlen=GPT_LATENCY_WINDOW)
+        self.first_chunk_latencies = deque(maxlen=GPT_LATENCY_WINDOW)
+        self.requests = 0
+        self.retries = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.hedges_skipped = 0
+        self._session = None
+        self._semaphore = None
+        self._loop = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        # Сессия и семафор привязаны к event loop, в котором были созданы
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            )
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._loop = loop
+        return self._session
+
+    def _headers(self) -> dict:
+        return {
+            'Authorization': f'Api-Key {GPT_API_KEY}',
+            'Content-Type': 'application/json'
+        }
+
+    def _retry_delay(self, attempt: int, error: aiohttp.ClientResponseError) -> float:
+        # На 429 сервер может сам сказать, сколько ждать
+        retry_after = error.headers.get('Retry-After') if error.headers else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.retry_max_delay)
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
+
+    async def _retrying(self, attempt_factory, tokens: int):
+        """Повторяет запрос при 429 и 5xx, остальные ошибки отдает сразу"""
+        for attempt in range(self.max_retries + 1):
+            if attempt and self.scheduler is not None:
+                self.scheduler.charge(tokens)
+            try:
+                return await attempt_factory()
+            except aiohttp.ClientResponseError as e:
+                if e.status not in GPT_RETRY_STATUSES or attempt == self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt, e)
+                self.retries += 1
+                print(f"YandexGPT answered {e.status}, retry {attempt + 1}/{self.max_retries} in {delay:.1f} s")
+                await asyncio.sleep(delay)
+
+    def hedge_delay(self, latencies: deque) -> float:
+        """Через сколько секунд без ответа отправлять второй запрос"""
+        if len(latencies) < GPT_HEDGE_MIN_SAMPLES:
+            return GPT_HEDGE_INITIAL_DELAY
+        ordered = sorted(latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))
+        return max(GPT_HEDGE_MIN_DELAY, ordered[index])
+
+    def _can_hedge(self, tokens: int) -> bool:
+        if self.scheduler is None:
+            return True
+        if not self.scheduler.has_budget(tokens):
+            # Бюджет на исходе или очередь не пуста - второй запрос отнял бы место у других
+            self.hedges_skipped += 1
+            return False
+        self.scheduler.charge(tokens)
+        return True
+
+    async def _hedged(self, attempt_factory, latencies: deque, tokens: int):
+        """
+        Запускает запрос, а если он не ответил за hedge_delay - еще один такой же.
+        Результат - первый успешный ответ, второй запрос отменяется.
+        attempt_factory(sent) - корутина запроса, sent выставляется, когда запрос прошел
+        семафор: порог и замеры считаем от отправки, а не от ожидания в очереди
+        """
+        sent = asyncio.Event()
+        first = asyncio.ensure_future(self._retrying(lambda: attempt_factory(sent), tokens))
+        tasks = {first}
+        try:
+            waiter = asyncio.ensure_future(sent.wait())
+            await asyncio.wait({first, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            start = time.monotonic()
+
+            if self.hedge_percentile is not None:
+                done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay(latencies))
+                if not done and self._can_hedge(tokens):
+                    self.hedged += 1
+                    tasks.add(asyncio.ensure_future(self._retrying(lambda: attempt_factory(asyncio.Event()), tokens)))
+
+            while True:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                winner = done.pop()
+                tasks.discard(winner)
+                if winner.exception() is None or not tasks:
+                    break
+                # Один из двух упал - ждем второй
+            result = winner.result()
+            if winner is not first:
+                self.hedge_wins += 1
+            latencies.append(time.monotonic() - start)
+            return result
+        finally:
+            for task in tasks:
+                if task.done() and not task.cancelled():
+                    task.exception()  # ошибка проигравшего уже не нужна, но должна быть прочитана
+                else:
+                    task.cancel()
+
+    async def _complete_once(self, data: dict, sent: asyncio.Event) -> dict:
+        session = await self._get_session()
+        async with self._semaphore:
+            sent.set()
+            async with session.post(self.url, headers=self._headers(), json=data) as response:
+                response.raise_for_status()
+                return await response.json()
+
+    async def complete(self, data: dict) -> dict:
+        self.requests += 1
+        return await self._hedged(lambda sent: self._complete_once(data, sent), self.latencies, request_tokens(data))
+
+    async def _open_stream(self, data: dict, sent: asyncio.Event):
+        """Начинает стриминговый ответ и ждет первого куска текста: (генератор, первый кусок)"""
+        chunks = self._stream_once(data, sent)
+        try:
+            first_chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            first_chunk = ""
+        except BaseException:
+            await chunks.aclose()
+            raise
+        return chunks, first_chunk
+
+    async def _stream_once(self, data: dict, sent: asyncio.Event):
+        session = await self._get_session()
+        async with self._semaphore:
+            sent.set()
+            async with session.post(self.url, headers=self._headers(), json=data) as response:
+                response.raise_for_status()
+                text = ""
+                async for line in response.content:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    result = json.loads(line)
+                    current = result['result']['alternatives'][0]['message']['text']
+                    if current.startswith(text):
+                        chunk = current[len(text):]
+                        text = current
+                    else:
+                        chunk = current
+                        text += current
+                    if chunk:
+                        yield chunk
+
+    async def stream(self, data: dict):
+        """
+        Стриминговый ответ: модель присылает JSON-объекты построчно,
+        в каждом - весь текст на текущий момент. Отдаем только приращения.
+        Повторы и хеджирование - только до первого куска текста, дальше его уже видит пользователь
+        """
+        data = dict(data, completionOptions=dict(data.get("completionOptions", {}), stream=True))
+        self.requests += 1
+        opened = []
+
+        async def open_stream(sent: asyncio.Event):
+            chunks, first_chunk = await self._open_stream(data, sent)
+            opened.append(chunks)
+            return chunks, first_chunk
+
+        try:
+            chunks, first_chunk = await self._hedged(open_stream, self.first_chunk_latencies, request_tokens(data))
+            # Проигравший в хеджировании стрим мог успеть открыться - закрываем сразу,
+            # чтобы не держать соединение, пока идет ответ победителя
+            for other in opened:
+                if other is not chunks:
+                    await other.aclose()
+            if first_chunk:
+                yield first_chunk
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            for chunks in opened:
+                await chunks.aclose()
+
+    def stats(self) -> dict:
+        hedging = self.hedge_percentile is not None
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "hedges_skipped": self.hedges_skipped,
+            "hedge_rate": self.hedged / self.requests if self.requests else 0.0,
+            "hedge_delay": self.hedge_delay(self.latencies) if hedging else None,
+            "first_chunk_hedge_delay": self.hedge_delay(self.first_chunk_latencies) if hedging else None
+        }
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._semaphore = None
+        self._loop = None
+
+
+llm_scheduler = LlmScheduler(GPT_REQUESTS_PER_MINUTE, GPT_TOKENS_PER_MINUTE, GPT_QUEUE_SIZE)
+gpt_client = GptClient(scheduler=llm_scheduler)
+
+
+async def close_gpt_client():
+    print(f"YandexGPT client stats: {gpt_client.stats()}, queue: {llm_scheduler.stats()}")
+    await gpt_client.close()
+
+
+recipe_cache = TTLCache(maxsize=RECIPE_CACHE_SIZE, ttl=RECIPE_CACHE_TTL)
+
+_QUERY_JUNK_RE = re.compile(r"[^\w\s]")
+_SPACES_RE = re.compile(r"\s+")
+# Числительные и слова про порции, чтобы "Борщ на две порции" и "борщ на 2 порции" совпадали
+QUERY_WORDS = {
+    "одну": "1", "одна": "1", "один": "1", "одного": "1",
+    "две": "2", "два": "2", "двоих": "2",
+    "три": "3", "троих": "3",
+    "четыре": "4", "четверых": "4",
+    "пять": "5", "пятерых": "5",
+    "шесть": "6", "шестерых": "6",
+    "семь": "7", "восемь": "8", "девять": "9", "десять": "10",
+    "порцию": "порц", "порция": "порц", "порции": "порц", "порций": "порц",
+    "человек": "порц", "человека": "порц", "персоны": "порц", "персон": "порц",
+}
+
+
+def normalize_recipe_query(query: str) -> str:
+    """'Борщ на две порции!' -> 'борщ на 2 порц'"""
+    query = _QUERY_JUNK_RE.sub(" ", query.lower().replace("ё", "е"))
+    words = [QUERY_WORDS.get(word, word) for word in _SPACES_RE.split(query) if word]
+    return " ".join(words)
+
+
+def _restriction_set(items) -> frozenset:
+    return frozenset(item.strip().lower() for item in items or [] if item and item.strip())
+
+
+def recipe_cache_key(query: str, user_dict: dict) -> tuple:
+    return (
+        normalize_recipe_query(query),
+        _restriction_set(user_dict.get('allergies')),
+        _restriction_set(user_dict.get('unliked_products'))
+    )
+
  
 def parse_ingredients(recipe: str) -> dict:
     """
     Парсит ингредиенты из рецепта в словарь
     """
-    ingredients_dict = {}
- 
-    # Находим секцию с ингредиентами
-    ingredients_section = ""
-    if "Ингредиенты:" in recipe:
-        sections = recipe.split("Приготовление:")
-        if len(sections) > 0:
-            ingredients_section = sections[0].split("Ингредиенты:")[1].strip()
-    else:
-        sections = recipe.split("\n\n")
-        if len(sections) > 0:
-            ingredients_section = sections[0]
- 
-    if not ingredients_section:
-        return ingredients_dict
- 
-    # Разбиваем на отдельные строки
-    lines = ingredients_section.split('\n')
- 
-    for line in lines:
-        line = line.strip()
-        if not line or line == "**":  # Пропускаем пустые строки и **
-            continue
- 
-        # Убираем звездочки, точки с запятой и точки в конце
-        line = line.strip('*., ;')
- 
-        # Паттерн для извлечения названия и количества
-        pattern = r'^(.*?)(?:[-—–]\s*)([\d.,]+\s*(?:г|кг|мл|л|шт|ст\.|ч\.|ст\.л\.|ч\.л\.|штук|грамм|грамма|граммов|литр|литра|литров|зубчик|зубчика|штуки|пучок|пучка|банка|упаковка|стакан|стакана)|\s*по\s*вкусу)'
- 
-        match = re.match(pattern, line, re.IGNORECASE)
-        if match:
-            name, amount = match.groups()
-            name = name.strip('* ')  # Убираем звездочки и пробелы
- 
-            # Если количество "по вкусу", пропускаем этот ингредиент
-            if 'по вкусу' in amount.lower():
-                continue
- 
-            ingredients_dict[name.lower()] = amount.strip()
- 
-    return ingredients_dict
+    return find_ingredients(recipe)
+
+
+class IngredientStreamParser:
+    """
+    Достает ингредиенты из рецепта, пока он еще генерируется: каждая строка
+    секции "Ингредиенты:" отдается, как только пришел ее перевод строки.
+    Окончательный список все равно дает parse_ingredients по полному тексту
+    """
+
+    def __init__(self):
+        self.consumed = 0
+        self.buffer = ""
+        self.started = False
+        self.done = False
+
+    def update(self, text: str) -> list[tuple[str, str]]:
+        """text - весь полученный на данный момент текст рецепта"""
+        if self.done:
+            return []
+        self.buffer += text[self.consumed:]
+        self.consumed = len(text)
+
+        if not self.started:
+            index = self.buffer.find("Ингредиенты:")
+            if index < 0:
+                return []
+            self.buffer = self.buffer[index + len("Ингредиенты:"):]
+            self.started = True
+
+        found = []
+        while "\n" in self.buffer or "Приготовление:" in self.buffer:
+            line, separator, rest = self.buffer.partition("\n")
+            if "Приготовление:" in line:
+                line = line.split("Приготовление:")[0]
+                self.done = True
+            elif not separator:
+                # "Приготовление:" дальше по буферу, но строка еще не закончилась
+                line = self.buffer.split("Приготовление:")[0]
+                self.done = True
+            self.buffer = rest
+            ingredient = parse_ingredient_line(line)
+            if ingredient:
+                found.append(ingredient)
+            if self.done:
+                break
+        return found
  
  
  
@@ -75,20 +395,8 @@ def format_recipe(raw_recipe: str) -> tuple:
  
     return formatted, ingredients
    
-async def get_recipe(query: str, user_dict: dict) -> tuple:
-        """
-        Получает запрос вида "борщ на 2 порции" и возвращает рецепт от YandexGPT,
-        словарь ингредиентов и количество порций
-        """
-        # Извлекаем количество порций из запроса
-        API_KEY = GPT_API_KEY
-        URL = 'https://llm.api.cloud.yandex.net/foundationModels/v1/completion'
-
-        headers = {
-            'Authorization': f'Api-Key {API_KEY}',
-            'Content-Type': 'application/json'
-        }
-
+def build_recipe_request(query: str, user_dict: dict, stream: bool = False) -> dict:
+        """Тело запроса к YandexGPT для рецепта с учетом ограничений пользователя"""
         # Формируем дополнительные ограничения для рецепта
         restrictions = []
         if user_dict.get('allergies'):
@@ -121,9 +429,9 @@ async def get_recipe(query: str, user_dict: dict) -> tuple:
         
         # print(system_prompt)
         data = {
-            "modelUri": "gpt://b1gjsebilk1g8hvtc07c/yandexgpt-lite",
+            "modelUri": GPT_MODEL_URI,
             "completionOptions": {
-                "stream": False,
+                "stream": stream,
                 "temperature": 0.6,
                 "maxTokens": 2000
             },
@@ -138,21 +446,63 @@ async def get_recipe(query: str, user_dict: dict) -> tuple:
                 }
             ]
         }
+        return data
+
+
+async def stream_recipe(query: str, user_dict: dict):
+    """Текст рецепта по кусочкам, по мере генерации моделью"""
+    async for chunk in gpt_client.stream(build_recipe_request(query, user_dict, stream=True)):
+        yield chunk
+
+
+async def get_recipe(query: str, user_dict: dict, on_text=None,
+                     user_id=None, priority: int = PRIORITY_INTERACTIVE) -> tuple:
+        """
+        Получает запрос вида "борщ на 2 порции" и возвращает рецепт от YandexGPT,
+        словарь ингредиентов и количество порций.
+        on_text - корутина, которую вызываем с уже полученным текстом рецепта по мере стриминга.
+        user_id и priority - место в общей очереди запросов к модели
+        """
+        # Тот же запрос с теми же ограничениями уже спрашивали - обходимся без модели
+        cache_key = recipe_cache_key(query, user_dict)
+        cached = recipe_cache.get(cache_key)
+        if cached is not None:
+            print(f"Recipe cache hit: {cache_key[0]}")
+            formatted_recipe, ingredients_dict = cached
+            if on_text is not None:
+                await on_text(formatted_recipe)
+            return formatted_recipe, dict(ingredients_dict)
 
         try:
-            response = requests.post(URL, headers=headers, json=data)
-            response.raise_for_status()
+            request = build_recipe_request(query, user_dict)
+            wait = await llm_scheduler.acquire(user_id, request_tokens(request), priority)
+            if wait > 1:
+                print(f"Recipe request waited {wait:.1f} s in LLM queue, {llm_scheduler.stats()}")
 
-            result = response.json()
-            recipe = result['result']['alternatives'][0]['message']['text']
+            if on_text is None:
+                result = await gpt_client.complete(request)
+                recipe = result['result']['alternatives'][0]['message']['text']
+            else:
+                recipe = ""
+                async for chunk in stream_recipe(query, user_dict):
+                    recipe += chunk
+                    await on_text(recipe)
 
             # Форматируем и получаем словарь ингредиентов
             formatted_recipe, ingredients_dict = format_recipe(recipe)
+            # Ответы без ингредиентов не кэшируем - вдруг модель ответила не по формату
+            if ingredients_dict:
+                recipe_cache.set(cache_key, (formatted_recipe, dict(ingredients_dict)))
             return formatted_recipe, ingredients_dict
 
+        except SchedulerOverloaded as e:
+            print(f"Recipe request rejected: {e}")
+            return "Сейчас слишком много запросов к нейросети. Попробуйте еще раз через минуту", {}
         except Exception as e:
+            print(f"Error getting recipe after retries: {e!r}, {gpt_client.stats()}")
             return f"Произошла ошибка при получении рецепта: {str(e)}", {}
 
+
 def main():
     query = "карбонара на 1 человека"
     user_dict = {
@@ -162,6 +512,7 @@ def main():
 
     loop = asyncio.get_event_loop()
     formatted_recipe, ingredients_dict = loop.run_until_complete(get_recipe(query, user_dict))
+    loop.run_until_complete(close_gpt_client())
     print("рецепт", formatted_recipe, '\n\n')
     print("ингредиенты: ", ingredients_dict, '\n\n')
 
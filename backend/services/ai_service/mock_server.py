@@ -0,0 +1,100 @@
+from aiohttp import web
+import argparse
+import asyncio
+import json
+
+COMPLETION_PATH = "/foundationModels/v1/completion"
+# app[REQUESTS] - тела полученных запросов
+REQUESTS = web.AppKey("requests", list)
+
+DEFAULT_RECIPE = """[Паста Карбонара]:
+
+Ингредиенты:
+• Спагетти - 200 г
+• Сливки - 200 мл
+• Бекон - 100 г
+• Яйца - 2 шт
+
+Приготовление:
+1. Сварить макароны
+2. Обжарить бекон и смешать со сливками и яйцами
+
+Порций - 2
+"""
+
+
+def completion_response(text: str, final: bool = True) -> dict:
+    """Ответ в формате YandexGPT foundationModels/v1/completion"""
+    return {
+        "result": {
+            "alternatives": [{
+                "message": {"role": "assistant", "text": text},
+                "status": "ALTERNATIVE_STATUS_FINAL" if final else "ALTERNATIVE_STATUS_PARTIAL"
+            }],
+            "usage": {"inputTextTokens": "0", "completionTokens": "0", "totalTokens": "0"},
+            "modelVersion": "mock"
+        }
+    }
+
+
+def create_app(text: str = DEFAULT_RECIPE, delay: float = 0, status: int = 200,
+               chunk_size: int = 40, chunk_delay: float = 0, delays: list = None,
+               errors: int = None) -> web.Application:
+    """
+    Локальная замена YandexGPT для тестов и нагрузочных прогонов:
+    на любой запрос через delay секунд отвечает одним и тем же рецептом.
+    Если в запросе stream=true - отдает текст построчными JSON по chunk_size
+    символов каждые chunk_delay секунд, как настоящий стриминг.
+    delays - задержки для первых запросов по порядку, errors - сколько первых
+    запросов ответят кодом status (None - все)
+    """
+    app = web.Application()
+    app[REQUESTS] = []
+
+    async def completion(request: web.Request) -> web.Response:
+        body = await request.json()
+        number = len(app[REQUESTS])
+        app[REQUESTS].append(body)
+        request_delay = delays[number] if delays and number < len(delays) else delay
+        if request_delay:
+            await asyncio.sleep(request_delay)
+        if status != 200 and (errors is None or number < errors):
+            return web.json_response({"error": {"message": "mock error"}}, status=status)
+        chunks = range(chunk_size, len(text) + chunk_size, chunk_size)
+        if not body.get("completionOptions", {}).get("stream"):
+            # Без стриминга ответ приходит, когда сгенерирован весь текст
+            if chunk_delay:
+                await asyncio.sleep(chunk_delay * len(chunks))
+            return web.json_response(completion_response(text))
+
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+        for end in chunks:
+            if chunk_delay:
+                await asyncio.sleep(chunk_delay)
+            # Как и YandexGPT, в каждой строке весь текст на текущий момент
+            line = json.dumps(completion_response(text[:end], final=end >= len(text)), ensure_ascii=False)
+            await response.write(line.encode("utf-8") + b"\n")
+        await response.write_eof()
+        return response
+
+    app.router.add_post(COMPLETION_PATH, completion)
+    return app
+
+
+async def start_mock_server(host: str = "127.0.0.1", port: int = 0, **kwargs) -> tuple[web.AppRunner, str]:
+    """Запускает сервер и возвращает runner и адрес completion"""
+    runner = web.AppRunner(create_app(**kwargs))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://{host}:{port}{COMPLETION_PATH}"
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--port", type=int, default=8082)
+    arg_parser.add_argument("--delay", type=float, default=1.0, help="секунд на один ответ")
+    args = arg_parser.parse_args()
+    web.run_app(create_app(delay=args.delay), host="127.0.0.1", port=args.port)
@@ -0,0 +1,165 @@
+"""
+Разбор текста рецепта от модели одной функцией: название, порции,
+ингредиенты и текст для показа пользователю.
+
+Все шаблоны скомпилированы заранее. Порции ищутся один раз с конца текста,
+ингредиенты достаются одним findall многострочной регулярки по секции
+"Ингредиенты:" - без split на строки и re.match на каждую из них, а текст
+для показа собирается одним split по всем заменяемым маркерам
+"""
+import re
+from typing import NamedTuple, Optional
+
+INGREDIENTS_HEADING = "Ингредиенты:"
+STEPS_HEADING = "Приготовление:"
+
+UNITS_PATTERN = r'г|кг|мл|л|шт|ст\.|ч\.|ст\.л\.|ч\.л\.|штук|грамм|грамма|граммов|литр|литра|литров|зубчик|зубчика|штуки|пучок|пучка|банка|упаковка|стакан|стакана'
+
+# Паттерн для извлечения названия и количества из одной строки
+INGREDIENT_LINE_RE = re.compile(
+    rf'^(.*?)(?:[-—–]\s*)([\d.,]+\s*(?:{UNITS_PATTERN})|\s*по\s*вкусу)',
+    re.IGNORECASE
+)
+# То же для всего списка сразу. Пробелы не переходят через перевод строки, а
+# "ч." или "ст." в самом конце строки не считаются единицей - как после
+# line.strip('*., ;') в построчном разборе
+_SPACE = r"[^\S\n]"
+INGREDIENTS_RE = re.compile(
+    rf"^{_SPACE}*[*., ;]*(.*?)[-—–]{_SPACE}*"
+    rf"([\d.,]+{_SPACE}*(?:{UNITS_PATTERN})(?:(?<!\.)|(?![*., ;]*{_SPACE}*$))|{_SPACE}*по{_SPACE}*вкусу)",
+    re.IGNORECASE | re.MULTILINE
+)
+TITLE_RE = re.compile(r"\[(.*?)\]")
+# Что меняется в тексте для показа: пустые строки, markdown-звездочки и заголовки разделов
+DISPLAY_RE = re.compile(rf"(\n\n+|\*\*?|{INGREDIENTS_HEADING}|{STEPS_HEADING})")
+DISPLAY_REPLACEMENTS = {
+    "**": "",
+    "*": "•",
+    INGREDIENTS_HEADING: "\n\n" + INGREDIENTS_HEADING,
+    STEPS_HEADING: "\n\n" + STEPS_HEADING,
+}
+# "Порций - 2", "Порций — 2", "порций: 2". Ищем с конца по "орций" через str.rfind,
+# а регуляркой только проверяем найденное место
+PORTIONS_WORD = "орций"
+PORTIONS_RE = re.compile(r"[Пп]орций\s*[-—–:]?\s*(\d+)")
+
+NUMBER_CHARS = "0123456789.,"
+# Маркеры списка и markdown вокруг названия продукта
+NAME_STRIP = "*•·- \t"
+
+
+class ParsedRecipe(NamedTuple):
+    title: Optional[str]
+    portions: Optional[int]
+    ingredients: dict
+    display: str
+
+
+def _ingredient(name: str, amount: str):
+    name = name.strip(NAME_STRIP)  # Убираем маркеры списка, звездочки и пробелы
+    # Если количество "по вкусу", пропускаем этот ингредиент
+    if 'по вкусу' in amount.lower():
+        return None
+    return name.lower(), amount.strip()
+
+
+def parse_ingredient_line(line: str):
+    """
+    Одна строка списка ингредиентов -> (название, количество) или None
+    """
+    line = line.strip()
+    if not line or line == "**":  # Пропускаем пустые строки и **
+        return None
+
+    # Убираем звездочки, точки с запятой и точки в конце
+    line = line.strip('*., ;')
+
+    match = INGREDIENT_LINE_RE.match(line)
+    if not match:
+        return None
+    return _ingredient(*match.groups())
+
+
+def parse_ingredients_section(section: str) -> dict:
+    """Все строки списка ингредиентов одним findall"""
+    # Количество из цифр - ветка с единицами, иначе это "по вкусу", такое пропускаем
+    return {
+        name.strip(NAME_STRIP).lower(): amount.strip()
+        for name, amount in INGREDIENTS_RE.findall(section)
+        if amount[0] in NUMBER_CHARS
+    }
+
+
+def _find_portions(text: str):
+    index = text.rfind(PORTIONS_WORD)
+    while index > 0:
+        match = PORTIONS_RE.match(text, index - 1)
+        if match:
+            return match
+        index = text.rfind(PORTIONS_WORD, 0, index)
+    return None
+
+
+def _display_scan(text: str) -> str:
+    # split с группой: на нечетных местах - найденные маркеры, их и заменяем.
+    # Все пустые строки сразу - иначе повторный разбор готового текста
+    # (например, рецепта из базы) добавлял бы отступы
+    parts = DISPLAY_RE.split(text)
+    parts[1::2] = [DISPLAY_REPLACEMENTS.get(marker, "\n") for marker in parts[1::2]]
+    return "".join(parts)
+
+
+def display_recipe(text: str, title: str = None, portions_match: re.Match = None) -> str:
+    """
+    Текст для сообщения в Telegram: без markdown и пустых строк, с отступами перед разделами
+    и строкой порций. title и portions_match - уже найденные parse_recipe_text,
+    все замены - за один split по DISPLAY_RE
+    """
+    portions_start = portions_match.start() if portions_match else -1
+    head = ""
+    position = 0
+    title_marker = f"[{title}]"
+    # Название в звездочках после их удаления уже не совпадет с [title] - как и раньше, не трогаем
+    if title is not None and '*' not in title and text.startswith(title_marker) \
+            and not 0 <= portions_start < len(title_marker):
+        head = title
+        position = len(title_marker)
+
+    if portions_start < position:
+        return head + _display_scan(text[position:])
+    # Перед строкой порций - отступ
+    return f"{head}{_display_scan(text[position:portions_start])}\n{_display_scan(text[portions_start:])}"
+
+
+def find_ingredients(text: str) -> dict:
+    """
+    Ингредиенты берутся из секции "Ингредиенты:" до "Приготовление:",
+    а если заголовка нет - из первого абзаца
+    """
+    ingredients_start = text.find(INGREDIENTS_HEADING)
+    if ingredients_start < 0:
+        paragraph_end = text.find("\n\n")
+        return parse_ingredients_section(text if paragraph_end < 0 else text[:paragraph_end])
+
+    ingredients_start += len(INGREDIENTS_HEADING)
+    steps_start = text.find(STEPS_HEADING)
+    if steps_start < 0:
+        return parse_ingredients_section(text[ingredients_start:])
+    if steps_start < ingredients_start:
+        return {}
+    return parse_ingredients_section(text[ingredients_start:steps_start])
+
+
+def parse_recipe_text(text: str, with_ingredients: bool = True) -> ParsedRecipe:
+    """
+    Название, порции, ингредиенты и текст для показа.
+    with_ingredients=False - когда ингредиенты уже известны (например, из get_recipe)
+    """
+    title_match = TITLE_RE.match(text)
+    title = title_match.group(1) if title_match else None
+
+    portions_match = _find_portions(text)
+    portions = int(portions_match.group(1)) if portions_match else None
+
+    ingredients = find_ingredients(text) if with_ingredients else {}
+    return ParsedRecipe(title, portions, ingredients, display_recipe(text, title, portions_match))
@@ -0,0 +1,182 @@
+"""
+Очередь запросов к YandexGPT: общий бюджет запросов и токенов в минуту,
+приоритеты и справедливость между пользователями.
+
+Запрос ждет в очереди своего приоритета, внутри приоритета пользователи
+обслуживаются по кругу - один пользователь с десятком запросов не задержит
+остальных. Следующий запрос уходит, когда на него хватает бюджета
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+# Приоритеты: меньше - раньше
+PRIORITY_INTERACTIVE = 0  # пользователь ждет ответа
+PRIORITY_BACKGROUND = 1  # фоновая работа, пользователь ответа не ждет
+
+WAIT_WINDOW = 500  # сколько последних ожиданий помнить для статистики
+# Сколько секунд бюджета можно потратить разом. Минутный бюджет целиком
+# за одну секунду провайдер все равно не пропустит
+BURST_SECONDS = 10
+
+
+class SchedulerOverloaded(Exception):
+    """Очередь заполнена - запрос не принят"""
+
+
+def request_tokens(data: dict) -> int:
+    """
+    Сколько токенов резервировать под запрос: maxTokens ответа плюс грубая
+    оценка промпта (в русском тексте около трех символов на токен)
+    """
+    prompt = sum(len(message.get("text", "")) for message in data.get("messages", []))
+    return int(data.get("completionOptions", {}).get("maxTokens", 0)) + prompt // 3
+
+
+class TokenBucket:
+    """Бюджет на минуту, пополняется равномерно"""
+
+    def __init__(self, per_minute: float, burst: float = BURST_SECONDS, timer=time.monotonic):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst)
+        self.timer = timer
+        self.available = self.capacity
+        self.updated = timer()
+
+    def _refill(self):
+        now = self.timer()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Через сколько секунд хватит на amount (0 - уже хватает)"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.available) / self.rate)
+
+    def take(self, amount: float):
+        self._refill()
+        self.available -= min(amount, self.capacity)
+
+
+class LlmScheduler:
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, max_queue: int,
+                 burst: float = BURST_SECONDS, timer=time.monotonic):
+        self.requests = TokenBucket(requests_per_minute, burst, timer)
+        self.tokens = TokenBucket(tokens_per_minute, burst, timer)
+        self.max_queue = max_queue
+        self.timer = timer
+        # приоритет -> пользователь -> очередь (future, токены, время постановки)
+        self._queues = {}
+        self._queued = 0
+        self._wakeup = None
+        self._dispatcher = None
+        self.waits = deque(maxlen=WAIT_WINDOW)
+        self.dispatched = 0
+        self.rejected = 0
+        self.charged = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queued
+
+    async def acquire(self, user_id, tokens: int, priority: int = PRIORITY_INTERACTIVE) -> float:
+        """Ждет своей очереди и бюджета. Возвращает, сколько секунд пришлось ждать"""
+        if self._queued >= self.max_queue:
+            self.rejected += 1
+            raise SchedulerOverloaded(f"LLM queue is full ({self._queued} requests)")
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        entry = (waiter, tokens, self.timer())
+        users = self._queues.setdefault(priority, OrderedDict())
+        users.setdefault(user_id, deque()).append(entry)
+        self._queued += 1
+        self._wake(loop)
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            # Отмененный запрос убираем из очереди, бюджет на него не тратится
+            waiters = users.get(user_id)
+            if waiters is not None and entry in waiters:
+                waiters.remove(entry)
+                self._queued -= 1
+                if not waiters:
+                    del users[user_id]
+            raise
+
+    def _wake(self, loop):
+        if self._dispatcher is None or self._dispatcher.done() or self._dispatcher.get_loop() is not loop:
+            self._wakeup = asyncio.Event()
+            self._dispatcher = loop.create_task(self._dispatch())
+        self._wakeup.set()
+
+    def _next(self):
+        """Первый ждущий запрос: самый срочный приоритет, пользователи по кругу"""
+        for priority in sorted(self._queues):
+            users = self._queues[priority]
+            if users:
+                user_id, waiters = next(iter(users.items()))
+                return users, user_id, waiters
+        return None
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            found = self._next()
+            if found is None:
+                return
+            users, user_id, waiters = found
+            waiter, tokens, queued_at = waiters[0]
+            if waiter.done():
+                # Отменен, а задача еще не успела убрать его из очереди
+                waiters.popleft()
+                self._queued -= 1
+                if not waiters:
+                    del users[user_id]
+                continue
+            delay = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+            if delay > 0:
+                # Пока ждем бюджет, может прийти запрос поважнее - просыпаемся и на него
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            waiters.popleft()
+            self._queued -= 1
+            # Пользователь уходит в конец круга
+            users.move_to_end(user_id)
+            if not waiters:
+                del users[user_id]
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            wait = self.timer() - queued_at
+            self.waits.append(wait)
+            self.dispatched += 1
+            waiter.set_result(wait)
+
+    def charge(self, tokens: int):
+        """
+        Списывает бюджет за дополнительную отправку уже допущенного запроса (повтор,
+        хедж) без очереди. Бюджет может уйти в минус - тогда дольше ждут следующие
+        """
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.charged += 1
+
+    def has_budget(self, tokens: int) -> bool:
+        """Хватает ли бюджета прямо сейчас и никто не ждет в очереди"""
+        return self._queued == 0 and self.requests.wait_time(1) == 0 and self.tokens.wait_time(tokens) == 0
+
+    def stats(self) -> dict:
+        waits = sorted(self.waits)
+        return {
+            "queue_depth": self._queued,
+            "dispatched": self.dispatched,
+            "rejected": self.rejected,
+            "charged": self.charged,
+            "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+            "p95_wait": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0
+        }
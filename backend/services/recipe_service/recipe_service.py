@@ -0,0 +1,166 @@
+"""
+Поиск уже сгенерированных рецептов по похожему запросу (MinHash + LSH).
+
+"Борщ на две порции", "борщ на 2 порции!" и "борщик на 2 порции" - почти
+одно и то же, и рецепт из MongoDB можно отдать без запроса к YandexGPT.
+Название и запрос нормализуются, режутся на символьные триграммы, по ним
+считается MinHash-подпись. LSH раскладывает подписи по корзинам полос -
+кандидатами становятся только рецепты с совпавшей полосой, а их сходство
+потом проверяется точно по Жаккару.
+
+Число порций должно совпадать точно, а рецепт - не содержать продуктов,
+на которые у пользователя аллергия или которые он не любит
+"""
+import re
+import zlib
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from backend.services.ai_service.ai import normalize_recipe_query
+
+NUM_PERM = 64  # длина MinHash-подписи
+BANDS = 16  # полос LSH, по NUM_PERM // BANDS значений в каждой
+SHINGLE_SIZE = 3
+SIMILARITY_THRESHOLD = 0.7  # минимальное сходство по Жаккару, чтобы отдать рецепт
+
+_PRIME = (1 << 31) - 1
+_rnd = np.random.default_rng(20240901)
+_HASH_A = _rnd.integers(1, _PRIME, NUM_PERM, dtype=np.int64)
+_HASH_B = _rnd.integers(0, _PRIME, NUM_PERM, dtype=np.int64)
+
+# Порции после normalize_recipe_query: "на 2 порц", "на 2", "2 порц"
+PORTIONS_RE = re.compile(r"\bна (\d+)\b(?: порц)?|\b(\d+) порц")
+_WORD_RE = re.compile(r"[а-яёa-z]+")
+_ENDINGS = "аяоеиыуюйь"
+
+
+class IndexEntry(NamedTuple):
+    recipe_id: str
+    portions: Optional[int]
+    shingles: frozenset
+    words: frozenset  # основы слов из ингредиентов и текста - для проверки ограничений
+
+
+def split_portions(query: str) -> tuple[str, Optional[int]]:
+    """'Борщ на две порции' -> ('борщ', 2). Порции без числа - None"""
+    normalized = normalize_recipe_query(query)
+    match = PORTIONS_RE.search(normalized)
+    if not match:
+        return normalized, None
+    portions = int(match.group(1) or match.group(2))
+    text = (normalized[:match.start()] + normalized[match.end():]).replace(" порц", "")
+    return " ".join(text.split()), portions
+
+
+def strip_portions(name: str) -> str:
+    """Название рецепта без 'на N порций'"""
+    return re.sub(r'\s+на \d+ порци[юией]+$', '', name)
+
+
+def shingles(text: str) -> frozenset:
+    text = f" {text} "
+    if len(text) <= SHINGLE_SIZE:
+        return frozenset([text])
+    return frozenset(text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1))
+
+
+def minhash(shingle_set: frozenset) -> np.ndarray:
+    values = np.fromiter((zlib.crc32(s.encode()) for s in shingle_set), dtype=np.int64, count=len(shingle_set))
+    # a * x + b по модулю простого; x < 2^32 и a < 2^31 - в int64 без переполнения
+    return ((_HASH_A[:, None] * values[None, :] + _HASH_B[:, None]) % _PRIME).min(axis=1)
+
+
+def band_keys(signature: np.ndarray) -> list:
+    rows = NUM_PERM // BANDS
+    return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(BANDS)]
+
+
+def stem(word: str) -> str:
+    """Грубая основа: 'яйца' и 'яйцо' -> 'яйц', 'бекона' -> 'бекон'"""
+    word = word.lower().replace("ё", "е")
+    for _ in range(2):
+        if len(word) > 3 and word[-1] in _ENDINGS:
+            word = word[:-1]
+    return word
+
+
+def stems(text: str) -> frozenset:
+    return frozenset(stem(word) for word in _WORD_RE.findall(text.lower()))
+
+
+def is_compatible(words: frozenset, user_dict: dict) -> bool:
+    """Нет ни одного продукта из аллергий и нелюбимых - ни в ингредиентах, ни в тексте"""
+    restrictions = list(user_dict.get('allergies') or []) + list(user_dict.get('unliked_products') or [])
+    for restriction in restrictions:
+        for restricted in stems(str(restriction)):
+            if any(word.startswith(restricted) for word in words):
+                return False
+    return True
+
+
+class RecipeIndex:
+    def __init__(self, threshold: float = SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        self.entries = []
+        self.buckets = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _add_text(self, recipe_id: str, text: str, portions: Optional[int], words: frozenset):
+        if not text:
+            return
+        entry = IndexEntry(recipe_id, portions, shingles(text), words)
+        index = len(self.entries)
+        self.entries.append(entry)
+        for key in band_keys(minhash(entry.shingles)):
+            self.buckets.setdefault(key, []).append(index)
+
+    def add(self, recipe: dict):
+        """Документ рецепта из MongoDB: индексируются название и исходный запрос"""
+        # Без ингредиентов - ошибка генерации или ответ не по формату, такое не переиспользуем
+        if not recipe.get("products"):
+            return
+        recipe_id = str(recipe["_id"])
+        base_portions = recipe.get("base_portions") or recipe.get("portions")
+        words = stems(" ".join(str(name).replace("+", " ") for name in (recipe.get("products") or {}))
+                      + " " + (recipe.get("recipe") or ""))
+
+        # Название всегда с порциями, но после пересчета порций в нем уже не исходное
+        # число - берем base_portions, под которое написан текст рецепта
+        if recipe.get("name"):
+            name, name_portions = split_portions(strip_portions(recipe["name"]))
+            self._add_text(recipe_id, name, int(base_portions or name_portions or 1), words)
+        if recipe.get("query"):
+            query, query_portions = split_portions(recipe["query"])
+            self._add_text(recipe_id, query, query_portions, words)
+
+    def build(self, recipes) -> "RecipeIndex":
+        for recipe in recipes:
+            try:
+                self.add(recipe)
+            except Exception as e:
+                print(f"Error indexing recipe {recipe.get('_id')}: {e}")
+        return self
+
+    def find(self, query: str, user_dict: dict) -> Optional[str]:
+        """id самого похожего подходящего пользователю рецепта или None"""
+        text, portions = split_portions(query)
+        if not text:
+            return None
+        query_shingles = shingles(text)
+
+        candidates = set()
+        for key in band_keys(minhash(query_shingles)):
+            candidates.update(self.buckets.get(key, ()))
+
+        best_id, best_similarity = None, self.threshold
+        for index in candidates:
+            entry = self.entries[index]
+            if entry.portions != portions:
+                continue
+            similarity = len(query_shingles & entry.shingles) / len(query_shingles | entry.shingles)
+            if similarity >= best_similarity and is_compatible(entry.words, user_dict):
+                best_id, best_similarity = entry.recipe_id, similarity
+        return best_id
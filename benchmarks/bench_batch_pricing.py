@@ -0,0 +1,51 @@
+"""
+Бенчмарк пакетного пересчета корзин: цикл по knapsack против NumPy-фильтра
+(самая дешевая корзина и укладывается ли она в бюджет)
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_batch_pricing
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from backend.parser.batch_pricing import reprice_baskets
+from backend.parser.parser import knapsack
+from benchmarks.bench_knapsack import synthetic_basket, cheapest_total
+
+
+async def knapsack_loop(baskets, budgets):
+    return [await knapsack(products_data, quantities, budget)
+            for (products_data, quantities), budget in zip(baskets, budgets)]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--baskets", type=int, default=2000)
+    arg_parser.add_argument("--ingredients", type=int, default=12)
+    arg_parser.add_argument("--offers", type=int, default=10)
+    arg_parser.add_argument("--seed", type=int, default=42)
+    args = arg_parser.parse_args()
+    rnd = random.Random(args.seed)
+
+    baskets = [synthetic_basket(rnd, args.ingredients, args.offers) for _ in range(args.baskets)]
+    budgets = [cheapest_total(products_data) * rnd.uniform(0.8, 1.5) for products_data, _ in baskets]
+
+    start = time.perf_counter()
+    asyncio.run(knapsack_loop(baskets, budgets))
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = reprice_baskets(baskets, budgets)
+    batch_time = time.perf_counter() - start
+
+    feasible = sum(1 for _, fits in results if fits)
+    print(f"{args.baskets} baskets x {args.ingredients} ingredients x {args.offers} offers")
+    print(f"knapsack loop: {loop_time:.3f} s")
+    print(f"numpy batch:   {batch_time:.3f} s ({loop_time / batch_time:.1f}x)")
+    print(f"within budget: {feasible}/{args.baskets}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Нагрузочный прогон get_recipe против локального mock-сервера YandexGPT:
+сколько рецептов в секунду, насколько при этом подтормаживает event loop
+и (с --stream) через сколько пользователь видит первый текст.
+С --slow-fraction часть ответов зависает на --slow-delay секунд - видно,
+как хеджирование срезает хвост (сравнить с --no-hedge)
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_gpt_client
+"""
+import argparse
+import asyncio
+import random
+import time
+from unittest.mock import patch
+
+from backend.services.ai_service.ai import GptClient, get_recipe
+from backend.services.ai_service.mock_server import start_mock_server
+from backend.services.ai_service.scheduler import LlmScheduler
+
+
+async def measure_lag(stop: asyncio.Event, interval: float = 0.01) -> float:
+    """Максимальная задержка пробуждения задачи относительно interval"""
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - start - interval)
+    return worst
+
+
+async def run(args):
+    # Задержка сервера делится между ожиданием первого токена и генерацией остального
+    rnd = random.Random(args.seed)
+    # Хеджирование добавляет запросы, поэтому задержек с запасом
+    delays = [args.slow_delay if rnd.random() < args.slow_fraction else args.first_token
+              for _ in range(args.requests * 2)]
+    runner, url = await start_mock_server(delay=args.first_token, chunk_delay=args.chunk_delay, delays=delays)
+    # По умолчанию без бюджета - меряем сам клиент; с --rpm видно очередь
+    scheduler = LlmScheduler(args.rpm or 10 ** 9, 10 ** 12, max_queue=args.requests)
+    client = GptClient(url=url, concurrency=args.concurrency, scheduler=scheduler,
+                       hedge_percentile=None if args.no_hedge else args.hedge_percentile)
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_lag(stop))
+    first_text = []
+
+    async def one(i: int):
+        start = time.perf_counter()
+        on_text = None
+        if args.stream:
+            async def on_text(text):
+                if not seen:
+                    seen.append(time.perf_counter() - start)
+        seen = []
+        result = await get_recipe(f"блюдо {i} на 2 порции", {}, on_text=on_text)
+        first_text.append(seen[0] if seen else time.perf_counter() - start)
+        return result
+
+    try:
+        with patch("backend.services.ai_service.ai.gpt_client", client), \
+                patch("backend.services.ai_service.ai.llm_scheduler", scheduler):
+            start = time.perf_counter()
+            results = await asyncio.gather(*(one(i) for i in range(args.requests)))
+            elapsed = time.perf_counter() - start
+    finally:
+        stop.set()
+        worst_lag = await lag_task
+        await client.close()
+        await runner.cleanup()
+
+    failed = sum(1 for _, ingredients in results if not ingredients)
+    first_text.sort()
+    print(f"{args.requests} requests, concurrency {args.concurrency}, stream: {args.stream}")
+    print(f"total: {elapsed:.2f} s, {args.requests / elapsed:.1f} recipes/s, failed: {failed}")
+    print(f"time to first text: median {first_text[len(first_text) // 2]:.2f} s, "
+          f"p99 {first_text[int(len(first_text) * 0.99)]:.2f} s, max {first_text[-1]:.2f} s")
+    print(f"client: {client.stats()}")
+    print(f"queue: {scheduler.stats()}")
+    print(f"max event loop lag: {worst_lag * 1000:.1f} ms")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--requests", type=int, default=200)
+    arg_parser.add_argument("--concurrency", type=int, default=10)
+    arg_parser.add_argument("--first-token", type=float, default=0.3, help="секунд до первого куска ответа")
+    arg_parser.add_argument("--chunk-delay", type=float, default=0.05, help="секунд между кусками ответа")
+    arg_parser.add_argument("--stream", action="store_true")
+    arg_parser.add_argument("--slow-fraction", type=float, default=0.0, help="доля зависающих ответов")
+    arg_parser.add_argument("--slow-delay", type=float, default=5.0)
+    arg_parser.add_argument("--hedge-percentile", type=float, default=95)
+    arg_parser.add_argument("--no-hedge", action="store_true")
+    arg_parser.add_argument("--rpm", type=float, default=0, help="бюджет запросов в минуту, 0 - без ограничения")
+    arg_parser.add_argument("--seed", type=int, default=42)
+    asyncio.run(run(arg_parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Бенчмарк http-движка парсера на локальных сохраненных страницах av.ru
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_http_engine --requests 500 --concurrency 20
+"""
+import argparse
+import asyncio
+import time
+
+from backend.parser.fixture_server import load_pages, start_fixture_server
+from backend.parser.http_engine import HttpSearchEngine, parse_search_page
+
+
+def bench_parse(pages: dict[str, str], rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for page in pages.values():
+            parse_search_page(page)
+    return (time.perf_counter() - start) / (rounds * len(pages))
+
+
+async def bench_search(requests: int, concurrency: int, delay: float) -> float:
+    runner, search_url = await start_fixture_server(delay=delay)
+    engine = HttpSearchEngine(search_url=search_url, max_connections=concurrency)
+    queries = list(load_pages().keys())
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            parse_search_page(await engine.fetch(queries[i % len(queries)]))
+
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(requests)))
+        return time.perf_counter() - start
+    finally:
+        await engine.close()
+        await runner.cleanup()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--requests", type=int, default=300)
+    arg_parser.add_argument("--concurrency", type=int, default=10)
+    arg_parser.add_argument("--delay", type=float, default=0.0, help="искусственная задержка сервера, сек")
+    args = arg_parser.parse_args()
+
+    per_page = bench_parse(load_pages(), rounds=2000)
+    print(f"parse_search_page: {per_page * 1e6:.1f} us/page")
+
+    elapsed = asyncio.run(bench_search(args.requests, args.concurrency, args.delay))
+    print(f"search: {args.requests} requests in {elapsed:.2f} s, {args.requests / elapsed:.0f} req/s")
+
+
+if __name__ == "__main__":
+    main()
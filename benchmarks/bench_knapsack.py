@@ -0,0 +1,81 @@
+"""
+Бенчмарк подбора корзины на синтетических данных:
+корзины от 10 до 200 ингредиентов, от 5 до 50 предложений на ингредиент
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_knapsack
+"""
+import argparse
+import random
+import time
+
+from backend.parser.optimizer import optimize_basket, solve_mckp, greedy_mckp, COVERAGE_WEIGHT
+
+SIZES = [(10, 5), (10, 50), (50, 5), (50, 20), (100, 10), (200, 5), (200, 50)]
+
+
+def synthetic_basket(rnd: random.Random, ingredients: int, offers: int) -> tuple[dict, dict]:
+    products_data = {}
+    for i in range(ingredients):
+        base = rnd.uniform(30, 600)
+        products_data[f"ингредиент {i}"] = [
+            {"name": f"товар {i}-{j}", "price": round(base * rnd.uniform(0.6, 2.5), 2), "link": f"https://av.ru/i/{i}{j}"}
+            for j in range(offers)
+        ]
+    quantities = {name: 1 for name in products_data}
+    return products_data, quantities
+
+
+def cheapest_total(products_data: dict) -> float:
+    return sum(min(p["price"] for p in offers) for offers in products_data.values())
+
+
+def old_knapsack(products_data: dict, quantities: dict, budget: float) -> dict:
+    # Прежний алгоритм: самый дешевый товар на каждый ингредиент
+    selected = {}
+    for ingredient in quantities:
+        selected[ingredient] = [min(products_data[ingredient], key=lambda x: x["price"])]
+    return selected
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--baskets", type=int, default=20, help="корзин на каждый размер")
+    arg_parser.add_argument("--budget-ratio", type=float, default=0.8,
+                            help="бюджет как доля от самой дешевой полной корзины")
+    arg_parser.add_argument("--seed", type=int, default=42)
+    args = arg_parser.parse_args()
+    rnd = random.Random(args.seed)
+
+    print(f"{'size':>10} {'old ms':>8} {'bnb ms':>8} {'exact':>6} {'covered':>8} {'greedy gap':>11}")
+    for ingredients, offers in SIZES:
+        old_time = new_time = 0.0
+        exact = 0
+        covered = 0
+        gap = 0.0
+        for _ in range(args.baskets):
+            products_data, quantities = synthetic_basket(rnd, ingredients, offers)
+            budget = cheapest_total(products_data) * args.budget_ratio
+
+            start = time.perf_counter()
+            old_knapsack(products_data, quantities, budget)
+            old_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            result = optimize_basket(products_data, quantities, budget)
+            new_time += time.perf_counter() - start
+            covered += sum(1 for name in quantities if "price" in result[name][0])
+
+            groups = [[(p["price"], COVERAGE_WEIGHT + 1) for p in products_data[name]] for name in quantities]
+            _, value, is_exact = solve_mckp(groups, budget)
+            _, greedy_value = greedy_mckp(groups, budget)
+            exact += is_exact
+            gap += (value - greedy_value) / max(value, 1)
+
+        print(f"{ingredients:>4}x{offers:<5} {old_time / args.baskets * 1000:>8.2f} "
+              f"{new_time / args.baskets * 1000:>8.2f} {exact / args.baskets:>6.0%} "
+              f"{covered / (args.baskets * ingredients):>8.0%} {gap / args.baskets:>11.4%}")
+
+
+if __name__ == "__main__":
+    main()
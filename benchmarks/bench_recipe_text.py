@@ -0,0 +1,112 @@
+"""
+Бенчмарк разбора текста рецепта: прежние parse_ingredients/format_recipe и
+цепочка replace из обработчика бота против parse_recipe_text
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_recipe_text
+"""
+import argparse
+import re
+import time
+
+from backend.services.ai_service.ai import format_recipe
+from backend.services.ai_service.mock_server import DEFAULT_RECIPE
+from backend.services.ai_service.recipe_text import parse_recipe_text
+from benchmarks.recipe_corpus import text_corpus
+
+
+def old_parse_ingredients(recipe: str) -> dict:
+    # Прежний разбор: несколько split по всему тексту и регулярка на каждую строку
+    ingredients_dict = {}
+    ingredients_section = ""
+    if "Ингредиенты:" in recipe:
+        sections = recipe.split("Приготовление:")
+        if len(sections) > 0:
+            parts = sections[0].split("Ингредиенты:")
+            ingredients_section = parts[1].strip() if len(parts) > 1 else ""
+    else:
+        sections = recipe.split("\n\n")
+        if len(sections) > 0:
+            ingredients_section = sections[0]
+    if not ingredients_section:
+        return ingredients_dict
+
+    for line in ingredients_section.split('\n'):
+        line = line.strip()
+        if not line or line == "**":
+            continue
+        line = line.strip('*., ;')
+        pattern = r'^(.*?)(?:[-—–]\s*)([\d.,]+\s*(?:г|кг|мл|л|шт|ст\.|ч\.|ст\.л\.|ч\.л\.|штук|грамм|грамма|граммов|литр|литра|литров|зубчик|зубчика|штуки|пучок|пучка|банка|упаковка|стакан|стакана)|\s*по\s*вкусу)'
+        match = re.match(pattern, line, re.IGNORECASE)
+        if match:
+            name, amount = match.groups()
+            name = name.strip('* ')
+            if 'по вкусу' in amount.lower():
+                continue
+            ingredients_dict[name.lower()] = amount.strip()
+    return ingredients_dict
+
+
+def old_pipeline(raw_recipe: str) -> tuple:
+    # format_recipe и затем обработчик бота: название, порции и цепочка replace
+    recipe_text = raw_recipe.replace('\n\n', '\n')
+    if "Ингредиенты" not in recipe_text:
+        recipe_text = "🥘 Ингредиенты:\n" + recipe_text
+    ingredients = old_parse_ingredients(raw_recipe)
+
+    title_match = re.match(r'\[(.*?)\]', recipe_text)
+    title = title_match.group(1) if title_match else None
+    portions_match = re.search(r'Порций — (\d+)', recipe_text)
+    portions = int(portions_match.group(1)) if portions_match else None
+
+    recipe_text = recipe_text.replace('**', '')
+    recipe_text = recipe_text.replace('*', '•')
+    if title:
+        recipe_text = recipe_text.replace('[' + title + ']', title)
+    recipe_text = recipe_text.replace('Ингредиенты:', '\n\nИнгредиенты:')
+    recipe_text = recipe_text.replace('Приготовление:', '\n\nПриготовление:')
+    recipe_text = recipe_text.replace('Порций —', f"\nПорций —")
+    return title, portions, ingredients, recipe_text
+
+
+def new_pipeline(raw_recipe: str) -> tuple:
+    formatted, ingredients = format_recipe(raw_recipe)
+    parsed = parse_recipe_text(formatted, with_ingredients=False)
+    return parsed.title, parsed.portions, ingredients, parsed.display
+
+
+def timed(pipeline, texts: list[str]) -> tuple[float, list]:
+    start = time.perf_counter()
+    results = [pipeline(text) for text in texts]
+    return time.perf_counter() - start, results
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--recipes", type=int, default=5000)
+    arg_parser.add_argument("--seed", type=int, default=42)
+    args = arg_parser.parse_args()
+
+    texts = [DEFAULT_RECIPE] + text_corpus(args.recipes - 1, args.seed)
+    old_time, old_results = timed(old_pipeline, texts)
+    new_time, new_results = timed(new_pipeline, texts)
+    single_time, _ = timed(parse_recipe_text, texts)
+
+    same_ingredients = sum(
+        1 for old, new in zip(old_results, new_results)
+        if {name.lstrip("•-* "): amount for name, amount in old[2].items()} == new[2]
+    )
+    same_title = sum(1 for old, new in zip(old_results, new_results) if old[0] == new[0])
+    portions = (sum(1 for old in old_results if old[1]), sum(1 for new in new_results if new[1]))
+
+    print(f"{len(texts)} recipes")
+    print(f"old pipeline:       {old_time / len(texts) * 1e6:8.1f} us/recipe")
+    print(f"new pipeline:       {new_time / len(texts) * 1e6:8.1f} us/recipe ({old_time / new_time:.1f}x)")
+    print(f"parse_recipe_text:  {single_time / len(texts) * 1e6:8.1f} us/recipe")
+    print(f"same ingredients (without list markers): {same_ingredients}/{len(texts)}")
+    print(f"same title: {same_title}/{len(texts)}")
+    print(f"portions found: old {portions[0]}, new {portions[1]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Бенчмарк DatabaseManager: get_user и update_user_preferences через пул
+долгоживущих соединений с WAL против прежнего aiosqlite.connect на каждый вызов,
+и отдельно поток одних только изменений предпочтений: по UPDATE на поле с
+коммитом на каждый вызов против одного UPDATE и групповых коммитов
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_user_db
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+from backend.database.sql_db import DatabaseManager
+
+
+class SeparateUpdates(DatabaseManager):
+    """Прежняя запись предпочтений: отдельный UPDATE на каждое поле и коммит на каждый вызов"""
+
+    async def update_user_preferences(self, user_id: int, allergies: list = None,
+                                      max_price: int = None, unliked_products: list = None):
+        async with self._connection() as db:
+            if allergies is not None:
+                await db.execute('UPDATE users SET allergies = ? WHERE user_id = ?', (json.dumps(allergies), user_id))
+            if max_price is not None:
+                await db.execute('UPDATE users SET max_price = ? WHERE user_id = ?', (max_price, user_id))
+            if unliked_products is not None:
+                await db.execute('UPDATE users SET unliked_products = ? WHERE user_id = ?',
+                                 (json.dumps(unliked_products), user_id))
+            await db.commit()
+
+
+class ConnectPerCall(SeparateUpdates):
+    """Как было до пула: новое соединение (и поток) на каждый вызов, журнал по умолчанию"""
+
+    async def start(self):
+        async with aiosqlite.connect(self.db_name) as db:
+            await self._create_tables(db)
+
+    async def close(self):
+        pass
+
+    @asynccontextmanager
+    async def _connection(self):
+        async with aiosqlite.connect(self.db_name) as db:
+            yield db
+
+
+async def run_workload(manager: DatabaseManager, args) -> dict:
+    await manager.start()
+    for user_id in range(args.users):
+        await manager.add_user(user_id, f"user{user_id}", "ru")
+
+    rnd = random.Random(args.seed)
+    operations = [(rnd.random() < args.write_fraction, rnd.randrange(args.users)) for _ in range(args.operations)]
+    queue = asyncio.Queue()
+    for operation in operations:
+        queue.put_nowait(operation)
+
+    async def worker():
+        while not queue.empty():
+            is_write, user_id = queue.get_nowait()
+            if is_write:
+                await manager.update_user_preferences(user_id, allergies=["орехи"], max_price=rnd.randrange(10000))
+            else:
+                await manager.get_user(user_id)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    await manager.close()
+    writes = sum(1 for is_write, _ in operations if is_write)
+    return {"elapsed": elapsed, "writes": writes, "reads": len(operations) - writes}
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"mixed workload, {args.write_fraction:.0%} writes:")
+        for title, manager_class in (("connect per call", ConnectPerCall), ("pool + WAL", DatabaseManager)):
+            result = await run_workload(manager_class(os.path.join(directory, f"mixed_{manager_class.__name__}.db")), args)
+            print(f"{title:>20}: {result['elapsed']:.2f} s, "
+                  f"{args.operations / result['elapsed']:.0f} ops/s "
+                  f"({result['reads']} get_user, {result['writes']} update_user_preferences)")
+
+        print("update_user_preferences only:")
+        args.write_fraction = 1.0
+        managers = (
+            ("connect per call", lambda path: ConnectPerCall(path)),
+            ("UPDATE per field", lambda path: SeparateUpdates(path)),
+            ("group commit", lambda path: DatabaseManager(path, wait_for_commit=True)),
+            ("write-behind", lambda path: DatabaseManager(path, wait_for_commit=False)),
+        )
+        for number, (title, make_manager) in enumerate(managers):
+            manager = make_manager(os.path.join(directory, f"writes_{number}.db"))
+            result = await run_workload(manager, args)
+            batches = getattr(manager, "preference_batches", 0)
+            print(f"{title:>20}: {result['elapsed']:.2f} s, {args.operations / result['elapsed']:.0f} writes/s"
+                  + (f", {batches} commits" if batches else ""))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--users", type=int, default=1000)
+    arg_parser.add_argument("--operations", type=int, default=5000)
+    arg_parser.add_argument("--concurrency", type=int, default=20)
+    arg_parser.add_argument("--write-fraction", type=float, default=0.2)
+    arg_parser.add_argument("--seed", type=int, default=42)
+    asyncio.run(run(arg_parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
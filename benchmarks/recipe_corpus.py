@@ -0,0 +1,67 @@
+"""
+Синтетические рецепты для бенчмарков разбора текста.
+
+Модель не всегда держит формат из промпта, поэтому text_corpus смешивает
+варианты, которые встречаются в ответах YandexGPT: markdown-заголовки,
+разные маркеры списка и тире, рецепты без заголовков и лишние пустые строки
+"""
+import random
+
+DISHES = ["Борщ", "Паста карбонара", "Плов", "Омлет", "Салат цезарь", "Сырники", "Гречка с грибами",
+          "Куриный суп", "Блины", "Рагу из овощей", "Шакшука", "Лазанья"]
+PRODUCTS = ["картофель", "морковь", "лук репчатый", "говядина", "куриное филе", "спагетти", "сливки 20%",
+            "яйца", "сыр пармезан", "рис", "гречка", "шампиньоны", "мука", "молоко", "творог", "сахар",
+            "масло сливочное", "масло подсолнечное", "томатная паста", "чеснок", "капуста", "свекла"]
+UNITS = [("г", 50, 800), ("мл", 50, 1000), ("шт", 1, 6), ("ст. л.", 1, 4), ("ч. л.", 1, 3), ("зубчик", 1, 4)]
+STEPS = ["Нарезать овощи", "Разогреть сковороду с маслом", "Обжарить до золотистого цвета",
+         "Добавить остальные ингредиенты и перемешать", "Тушить под крышкой 15 минут", "Посолить и поперчить",
+         "Подавать горячим, посыпав зеленью"]
+
+
+def synthetic_recipe(rnd: random.Random) -> dict:
+    ingredients = []
+    for name in rnd.sample(PRODUCTS, rnd.randint(4, 12)):
+        if rnd.random() < 0.1:
+            ingredients.append([name, None, "по вкусу"])
+            continue
+        unit, low, high = rnd.choice(UNITS)
+        ingredients.append([name, rnd.randint(low, high), unit])
+    return {
+        "t": rnd.choice(DISHES),
+        "p": rnd.randint(1, 6),
+        "i": ingredients,
+        "s": rnd.sample(STEPS, rnd.randint(3, len(STEPS)))
+    }
+
+
+BULLETS = ["• ", "- ", "* ", ""]
+DASHES = ["-", "—", "–"]
+
+
+def recipe_text_variant(recipe: dict, rnd: random.Random) -> str:
+    """Тот же рецепт, но в одном из форматов, которые модель выдает на самом деле"""
+    bullet = rnd.choice(BULLETS)
+    dash = rnd.choice(DASHES)
+    bold = "**" if rnd.random() < 0.3 else ""
+    gap = "\n" * rnd.choice([1, 2, 2, 3])
+
+    title = f"[{recipe['t']}]:" if rnd.random() < 0.8 else f"{bold}{recipe['t']}{bold}"
+    ingredients = [f"{bullet}{name} {dash} {unit if quantity is None else f'{quantity} {unit}'}"
+                   for name, quantity, unit in recipe["i"]]
+    steps = [f"{number}. {step}" for number, step in enumerate(recipe["s"], start=1)]
+    portions = f"{rnd.choice(['Порций', 'порций'])} {dash} {recipe['p']}"
+
+    if rnd.random() < 0.1:
+        # Без заголовков: ингредиенты первым абзацем
+        return gap.join(["\n".join(ingredients), "\n".join(steps), portions])
+    return gap.join([
+        title,
+        f"{bold}Ингредиенты:{bold}\n" + "\n".join(ingredients),
+        f"{bold}Приготовление:{bold}\n" + "\n".join(steps),
+        portions
+    ])
+
+
+def text_corpus(n: int, seed: int = 42) -> list[str]:
+    rnd = random.Random(seed)
+    return [recipe_text_variant(synthetic_recipe(rnd), rnd) for _ in range(n)]
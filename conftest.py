@@ -0,0 +1,19 @@
+"""
+Локальные настройки (токен бота, ключ YandexGPT, адрес MongoDB) в репозитории не хранятся.
+Для тестов, если их нет, подставляем заглушки
+"""
+import importlib.util
+import sys
+import types
+
+TEST_SETTINGS = {
+    "bot.settings": {"BOT_TOKEN": "123:test"},
+    "backend.services.ai_service.settings": {"GPT_API_KEY": "test"},
+    "backend.database.setting": {"connection": "mongodb://localhost:27017"},
+}
+
+for name, values in TEST_SETTINGS.items():
+    if importlib.util.find_spec(name) is None:
+        module = types.ModuleType(name)
+        module.__dict__.update(values)
+        sys.modules[name] = module
@@ -8,22 +8,76 @@ from aiogram.enums import ParseMode  #type: ignore
 from aiogram.filters.callback_data import CallbackData  #type: ignore
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery #type: ignore
 from aiogram.fsm.state import State #type: ignore
+from aiogram.exceptions import TelegramRetryAfter #type: ignore
 
 
 from bot.keyboards.main_keyboard import get_main_keyboard
 from bot import texts
 from bot.settings import BOT_TOKEN
-from backend.services.ai_service.ai import get_recipe
+from backend.services.ai_service.ai import get_recipe, close_gpt_client, IngredientStreamParser
+from backend.services.ai_service.recipe_text import parse_recipe_text
+from backend.services.recipe_service.recipe_service import strip_portions
 from backend.handler import Handler
-from backend.parser.parser import data_parser, knapsack, standardize_ingredients
+from backend.parser.parser import IngredientSearch, knapsack, standardize_ingredients, start_driver_pool, close_parser, PARSER_ENGINE
+from backend.parser.stores import store_title
 from bot.keyboards.preferences_keyboard import get_preferences_keyboard
 from bot.paste import RecipeCallback
 import asyncio
 from bot.loading_messages import get_random_loading_message
-import re
 from aiogram.filters import Filter
 
 
+# Не чаще раза в столько секунд правим сообщение, пока рецепт генерируется
+STREAM_EDIT_INTERVAL = 1.0
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+class StreamingMessageRenderer:
+    """
+    Показывает рецепт в сообщении по мере генерации. Первая правка - сразу,
+    дальше правки склеиваются: не чаще раза в min_interval секунд,
+    и в сообщение всегда попадает последний текст
+    """
+
+    def __init__(self, message: types.Message, min_interval: float = STREAM_EDIT_INTERVAL):
+        self.message = message
+        self.min_interval = min_interval
+        self.text = ""
+        self.shown = ""
+        self.next_edit_at = 0.0
+        self.task = None
+
+    async def update(self, text: str):
+        self.text = text[:TELEGRAM_MESSAGE_LIMIT]
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        loop = asyncio.get_running_loop()
+        while self.text != self.shown and self.text.strip():
+            delay = self.next_edit_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            text = self.text
+            try:
+                await self.message.edit_text(text)
+                self.shown = text
+                self.next_edit_at = loop.time() + self.min_interval
+            except TelegramRetryAfter as e:
+                self.next_edit_at = loop.time() + e.retry_after
+            except Exception as e:
+                print(f"Error rendering streamed recipe: {e}")
+                return
+
+    async def stop(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+
 class MenuButtonFilter(Filter):
     async def __call__(self, message: types.Message, state: FSMContext) -> bool:
         if message.text and message.text.startswith('/'):
@@ -175,8 +229,12 @@ async def generate_products_message(data, portions):
                     products_message += (
                         f"{product.get('name', 'Название не указано')}\n"
                         f"Цена: {product.get('price', 'Цена не указана')}\n"
-                        f"Ссылка: {product.get('link', 'Ссылка отсутствует')}\n\n"
                     )
+                    if product.get('packs', 1) > 1:
+                        products_message += f"Количество: {product['packs']} уп.\n"
+                    if product.get('store'):
+                        products_message += f"Магазин: {store_title(product['store'])}\n"
+                    products_message += f"Ссылка: {product.get('link', 'Ссылка отсутствует')}\n\n"
     
     if "total_cost" in data:
         portions_in_russian = "порций"
@@ -184,7 +242,7 @@ async def generate_products_message(data, portions):
             portions_in_russian = "порции"
         if int(portions) == 1:
             portions_in_russian = "порцию"
-        products_message += f"\n💰 Приблизительная итоговая стоимость на {int(portions)} {portions_in_russian}: {int(portions) * float(data['total_cost'])} RUB"
+        products_message += f"\n💰 Приблизительная итоговая стоимость на {int(portions)} {portions_in_russian}: {float(data['total_cost']):.2f} RUB"
     
     if "message" in data:
         products_message += f"\n\n⚠️ {data['message']}"
@@ -203,6 +261,10 @@ async def process_recipe_request(message: types.Message, state: FSMContext):
 
     loading_message = await message.answer("🔍 Начинаю поиск рецепта...")
     loading_manager = LoadingMessageManager(loading_message)
+    renderer = StreamingMessageRenderer(loading_message)
+    # Магазины ищем, пока рецепт еще дописывается
+    ingredient_search = IngredientSearch()
+    ingredient_extractor = IngredientStreamParser()
     
     try:
         loading_task = await loading_manager.start()
@@ -210,13 +272,40 @@ async def process_recipe_request(message: types.Message, state: FSMContext):
 
         preferences = await handler.get_user_preferences(user_id)        
 
-        recipe_text, ingredients = await get_recipe(message.text, preferences)
-        
-        title_match = re.match(r'\[(.*?)\]', recipe_text)
-        title = title_match.group(1) if title_match else message.text
-        
-        portions_match = re.search(r'Порций — (\d+)', recipe_text)
-        portions = portions_match.group(1) if portions_match else "1"
+        async def show_partial_recipe(text: str):
+            # С первым куском рецепта шуточные сообщения о загрузке больше не нужны
+            if loading_manager.is_running:
+                await loading_manager.stop()
+            for name, _ in ingredient_extractor.update(text):
+                ingredient_search.prefetch(name.replace(' ', "+"))
+            await renderer.update(parse_recipe_text(text, with_ingredients=False).display)
+
+        # Почти такой же запрос уже был - отдаем готовый рецепт без YandexGPT
+        similar_recipe = None
+        try:
+            similar_recipe = await handler.find_similar_recipe(message.text, preferences)
+        except Exception as e:
+            print(f"Error finding similar recipe: {e}")
+
+        try:
+            if similar_recipe:
+                recipe_text = similar_recipe['recipe']
+                ingredients = {name.replace('+', ' '): value for name, value in similar_recipe['products'].items()}
+                await show_partial_recipe(recipe_text)
+            else:
+                recipe_text, ingredients = await get_recipe(message.text, preferences, on_text=show_partial_recipe,
+                                                            user_id=user_id)
+        finally:
+            await renderer.stop()
+        if renderer.text:
+            await renderer.update(f"{renderer.text}\n\n🛒 Подбираю продукты...")
+        
+        parsed_recipe = parse_recipe_text(recipe_text, with_ingredients=False)
+        title = parsed_recipe.title or message.text
+        if similar_recipe and not parsed_recipe.title:
+            # В сохраненном тексте квадратных скобок уже нет, название - из документа
+            title = strip_portions(similar_recipe['name'])
+        portions = str(parsed_recipe.portions or 1)
         portions_in_russian = "порций"
         if 2 <= int(portions) <= 4:
             portions_in_russian = "порции"
@@ -229,7 +318,7 @@ async def process_recipe_request(message: types.Message, state: FSMContext):
 
         raw_links = {}
         try:
-            raw_links = await data_parser(ingredients)
+            raw_links = await ingredient_search.results(ingredients)
         except Exception as e:
             print(f"Error getting product links: {e}")
         
@@ -238,17 +327,16 @@ async def process_recipe_request(message: types.Message, state: FSMContext):
 
         print(links)
 
-        recipe_text = recipe_text.replace('**', '')
-        recipe_text = recipe_text.replace('*', '•')
-        recipe_text = recipe_text.replace('[' + title + ']', title)
-        recipe_text = recipe_text.replace('Ингредиенты:', '\n\nИнгредиенты:')
-        recipe_text = recipe_text.replace('Приготовление:', '\n\nПриготовление:')
-        recipe_text = recipe_text.replace('Порций —', f"\nПорций —")
+        recipe_text = parsed_recipe.display
         recipe_data = {
             'text': recipe_text,
             'ingredients': ingredients,
             'request': full_title,
-            'links': links
+            'links': links,
+            'raw_offers': raw_links,
+            'portions': portions,
+            'query': message.text,
+            'reused': similar_recipe is not None
         }
         
         recipe_id = await handler.new_recipe_handler(user_id, recipe_data)
@@ -256,9 +344,10 @@ async def process_recipe_request(message: types.Message, state: FSMContext):
         products_message = await generate_products_message(links, portions)
         result_message = f"{recipe_text}\n\nСсылки на продукты:\n\n{products_message}"
         
-        keyboard = handler.create_recipe_keyboard(recipe_id, user_id, show_full=False)
+        keyboard = await handler.create_recipe_keyboard(recipe_id, user_id, show_full=False)
         
         await loading_manager.stop()
+        await renderer.stop()
         
         await loading_message.edit_text(result_message, reply_markup=keyboard)
         
@@ -267,7 +356,9 @@ async def process_recipe_request(message: types.Message, state: FSMContext):
         
     except Exception as e:
         print(f"Error processing recipe request: {e}")
+        ingredient_search.cancel()
         await loading_manager.stop()
+        await renderer.stop()
         
         error_keyboard = InlineKeyboardMarkup(
             inline_keyboard=[[
@@ -293,6 +384,15 @@ async def try_again(callback: CallbackQuery, state: FSMContext):
     await state.set_state(RecipeStates.waiting_for_recipe_request)
     await callback.answer()
 
+def basket_estimate_text(estimate) -> str:
+    """Строка под избранным рецептом: самая дешевая корзина под текущий бюджет"""
+    if estimate is None:
+        return ""
+    total_cost, feasible = estimate
+    text = f"💰 от {total_cost:.2f} RUB"
+    return f"{text}\n" if feasible else f"{text} - больше вашего бюджета\n"
+
+
 @router.message(lambda msg: msg.text == texts.buttons["favorite_recipes"])
 async def favorite_recipes(message: types.Message):
     user_id = message.from_user.id
@@ -306,8 +406,9 @@ async def favorite_recipes(message: types.Message):
     keyboard_buttons = []
     
     current_recipes = favorites[:3]
-    for i, recipe in enumerate(current_recipes, start=1):
-        recipes_text += f"🍳 {recipe['name']}\n\n"
+    estimates = await handler.estimate_baskets(user_id, current_recipes)
+    for i, (recipe, estimate) in enumerate(zip(current_recipes, estimates), start=1):
+        recipes_text += f"🍳 {recipe['name']}\n{basket_estimate_text(estimate)}\n"
         keyboard_buttons.append([InlineKeyboardButton(
             text=f"Рецепт {i}",
             callback_data=RecipeCallback(action="get_full", id=recipe["_id"]).pack()
@@ -376,11 +477,11 @@ async def handle_pagination(callback: CallbackQuery, callback_data: PaginationCa
 async def get_full_recipe(callback: CallbackQuery, callback_data: RecipeCallback):
     recipe_id = callback_data.id
     user_id = callback.from_user.id
-    recipe = handler.recipe_db.get_recipe(recipe_id)
+    recipe = await handler.get_recipe_by_id(recipe_id)
     
     if recipe:
         formatted_recipe = await handler.format_recipe_with_links(recipe)
-        keyboard = handler.create_recipe_keyboard(recipe_id, user_id, show_full=False)
+        keyboard = await handler.create_recipe_keyboard(recipe_id, user_id, show_full=False)
         await callback.message.answer(
             formatted_recipe,
             reply_markup=keyboard
@@ -493,11 +594,12 @@ async def show_more_favorites(callback: CallbackQuery, callback_data: Pagination
         await callback.message.delete()
         
         current_recipes = favorites[offset:offset+3]
+        estimates = await handler.estimate_baskets(user_id, current_recipes)
         recipes_text = ""
         keyboard_buttons = []
         
-        for i, recipe in enumerate(current_recipes, start=offset+1):
-            recipes_text += f"🍳 {recipe['name']}\n\n"
+        for i, (recipe, estimate) in enumerate(zip(current_recipes, estimates), start=offset+1):
+            recipes_text += f"🍳 {recipe['name']}\n{basket_estimate_text(estimate)}\n"
             keyboard_buttons.append([InlineKeyboardButton(
                 text=f"Рецепт {i}",
                 callback_data=RecipeCallback(action="get_full", id=recipe["_id"]).pack()
@@ -530,6 +632,26 @@ async def show_more_favorites(callback: CallbackQuery, callback_data: Pagination
     await callback.answer()
 
 
+PORTION_ACTIONS = {"reoptimize": 0, "add_portion": 1, "remove_portion": -1}
+
+@router.callback_query(RecipeCallback.filter(F.action.in_(PORTION_ACTIONS)))
+async def reoptimize_recipe(callback: CallbackQuery, callback_data: RecipeCallback):
+    user_id = callback.from_user.id
+    recipe = await handler.reoptimize_recipe(user_id, callback_data.id, PORTION_ACTIONS[callback_data.action])
+
+    if not recipe:
+        await callback.answer("Для этого рецепта нет сохраненных цен, запросите его заново")
+        return
+
+    formatted_recipe = await handler.format_recipe_with_links(recipe)
+    keyboard = await handler.create_recipe_keyboard(callback_data.id, user_id, show_full=False)
+    try:
+        await callback.message.edit_text(formatted_recipe, reply_markup=keyboard)
+    except Exception as e:
+        # Telegram не дает отредактировать сообщение на тот же текст
+        print(f"Error updating recipe message: {e}")
+    await callback.answer("Корзина пересчитана")
+
 @router.callback_query(RecipeCallback.filter(F.action == "toggle_favorite"))
 async def toggle_favorite(callback: CallbackQuery, callback_data: RecipeCallback):
     user_id = callback.from_user.id
@@ -538,7 +660,7 @@ async def toggle_favorite(callback: CallbackQuery, callback_data: RecipeCallback
     is_favorite = await handler.toggle_favorite_recipe(user_id, recipe_id)
     
 
-    new_keyboard = handler.create_recipe_keyboard(
+    new_keyboard = await handler.create_recipe_keyboard(
         recipe_id, 
         user_id, 
         show_full="Получить полный рецепт" in callback.message.reply_markup.inline_keyboard[0][0].text
@@ -745,6 +867,28 @@ async def handle_non_menu_message(message: types.Message, state: FSMContext):
             "Пожалуйста, используйте кнопки меню для навигации по боту.",
             reply_markup=get_main_keyboard()
         )
+async def on_startup():
+    await handler.user_db.start()
+    try:
+        await handler.recipe_db.ensure_indexes()
+    except Exception as e:
+        print(f"Error creating MongoDB indexes: {e}")
+    # Для http-движка браузеры нужны только запасным вариантом - создаются по первому запросу
+    if PARSER_ENGINE == "selenium":
+        try:
+            await asyncio.to_thread(start_driver_pool)
+        except Exception as e:
+            print(f"Error warming up driver pool: {e}")
+    try:
+        await handler.build_recipe_index()
+    except Exception as e:
+        print(f"Error building recipe index: {e}")
+
+async def on_shutdown():
+    await close_parser()
+    await close_gpt_client()
+    await handler.user_db.close()
+
 async def main():
     default = DefaultBotProperties(parse_mode=ParseMode.HTML)
 
@@ -752,6 +896,8 @@ async def main():
     dp = Dispatcher()
     
     dp.include_router(router)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
     
     await dp.start_polling(bot)
 
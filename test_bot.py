@@ -1,4 +1,5 @@
 import pytest
+import asyncio
 from unittest.mock import AsyncMock, MagicMock, patch
 from aiogram import Bot, types
 from aiogram.fsm.context import FSMContext
@@ -6,6 +7,7 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import InlineKeyboardMarkup, Message, User, Chat
 
 from bot.paste import RecipeCallback
+from backend.utils.ttl_cache import TTLCache
 from bot.keyboards.main_keyboard import get_main_keyboard
 from bot.keyboards.preferences_keyboard import get_preferences_keyboard
 from main import (
@@ -18,7 +20,8 @@ from main import (
     favorite_recipes,
     recipe_history,
     cmd_start,
-    Handler
+    Handler,
+    StreamingMessageRenderer
 )
 
 @pytest.fixture
@@ -102,4 +105,90 @@ async def test_handle_allergies_cancel(message, state):
         reply_markup=get_preferences_keyboard()
     )
     current_state = await state.get_state()
-    assert current_state == PreferenceStates.waiting_for_menu_choice.state
\ No newline at end of file
+    assert current_state == PreferenceStates.waiting_for_menu_choice.state
+
+@pytest.mark.asyncio
+async def test_reoptimize_recipe_uses_stored_offers():
+    handler = Handler.__new__(Handler)
+    handler.recipe_db = AsyncMock()
+    handler.user_db = AsyncMock()
+    handler.user_db.get_user.return_value = {"max_price": 1000}
+    handler.preferences_cache = TTLCache()
+    handler._preferences_writes = 0
+    handler.recipe_db.get_recipe.return_value = {
+        "_id": "123456",
+        "user_id": 12345,
+        "name": "Блины на 1 порцию",
+        "portions": 1,
+        "products": {"молоко": "0,5 л"},
+        "raw_offers": {"молоко": [{"name": "Молоко 1 л", "price": 100.0, "link": "1"}]},
+    }
+
+    recipe = await handler.reoptimize_recipe(12345, "123456", portions_delta=2)
+
+    assert recipe["name"] == "Блины на 3 порции"
+    assert recipe["product_links"]["Молоко 1 л"]["packs"] == 2
+    assert recipe["product_links"]["total_cost"] == 200.0
+    handler.recipe_db.update_product_links.assert_awaited_once()
+
+
+# Избранное оценивается одной пачкой, рецепты без сохраненных предложений пропускаются
+@pytest.mark.asyncio
+async def test_estimate_baskets_for_favorites():
+    handler = Handler.__new__(Handler)
+    handler.recipe_db = AsyncMock()
+    handler.user_db = AsyncMock()
+    handler.user_db.get_user.return_value = {"max_price": 150}
+    handler.preferences_cache = TTLCache()
+    handler._preferences_writes = 0
+    offers = {"молоко": [{"name": "Молоко 1 л", "price": 100.0, "link": "1"}]}
+    recipes = [
+        {"products": {"молоко": "0,5 л"}, "portions": 1, "raw_offers": offers},
+        {"products": {"молоко": "0,5 л"}},
+        {"products": {"молоко": "0,5 л"}, "portions": 3, "base_portions": 1, "raw_offers": offers},
+    ]
+
+    estimates = await handler.estimate_baskets(12345, recipes)
+
+    assert estimates == [(100.0, True), None, (200.0, False)]
+
+
+@pytest.mark.asyncio
+async def test_user_preferences_are_cached_until_update():
+    handler = Handler.__new__(Handler)
+    handler.user_db = AsyncMock()
+    handler.user_db.get_user.return_value = {"allergies": ["орехи"], "unliked_products": [], "max_price": 0}
+    handler.preferences_cache = TTLCache()
+    handler._preferences_writes = 0
+
+    await handler.get_user_preferences(12345)
+    formatted = await handler.get_formatted_preferences(12345)
+    assert await handler.get_formatted_preferences(12345) == formatted
+    assert "Аллергия:\nорехи" in formatted
+    handler.user_db.get_user.assert_awaited_once()
+
+    handler.user_db.get_user.return_value = {"allergies": [], "unliked_products": [], "max_price": 500}
+    await handler.update_price_limit(12345, 500)
+    assert (await handler.get_user_preferences(12345))["max_price"] == 500
+    assert "500 руб." in await handler.get_formatted_preferences(12345)
+    assert handler.user_db.get_user.await_count == 2
+
+
+# Первая правка сразу, дальше правки склеиваются, последний текст не теряется
+@pytest.mark.asyncio
+async def test_streaming_renderer_coalesces_edits():
+    message = AsyncMock(spec=Message)
+    renderer = StreamingMessageRenderer(message, min_interval=0.2)
+
+    text = ""
+    for _ in range(20):
+        text += "ингредиент "
+        await renderer.update(text)
+        await asyncio.sleep(0.02)
+    await asyncio.sleep(0.3)
+    await renderer.stop()
+
+    edits = [call.args[0] for call in message.edit_text.call_args_list]
+    assert edits[0] == "ингредиент "
+    assert edits[-1] == text
+    assert len(edits) <= 4